@@ -0,0 +1,96 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from traffic_signal import DEFAULT_OPTIMIZER, OPTIMIZER_BUDGET, TrafficOptimizer
+
+class LinkCounts:
+    # Stands in for city.vehicles, which backends only ask for link counts
+    __slots__ = ('link_count',)
+
+    def __init__(self, link_count):
+        self.link_count = link_count
+
+class ApproachCounts:
+    # Stands in for city.metrics, of which backends only ask for the
+    # vehicles per approach
+    __slots__ = ('counts',)
+
+    def __init__(self, counts):
+        self.counts = counts
+
+    def approach_counts(self):
+        return self.counts
+
+class CitySnapshot:
+    # The parts of a CityGrid the backends read, copied on the main thread so
+    # a solve never sees the city change under it. Topology and intersection
+    # names are never modified in place and are shared, not copied.
+    __slots__ = ('tick', 'topology', 'intersections', 'emergency_route', 'vehicles', 'metrics')
+
+    def __init__(self, city):
+        self.tick = city.tick
+        self.topology = city.topology
+        self.intersections = city.intersections
+        self.emergency_route = list(city.emergency_route)
+        self.vehicles = LinkCounts(city.vehicles.link_count.copy())
+        self.metrics = None
+        if city.metrics is not None:
+            self.metrics = ApproachCounts(city.metrics.approach_counts().copy())
+
+class AsyncTrafficOptimizer(TrafficOptimizer):
+    # Runs the backend on a worker thread against a snapshot of the city.
+    # optimize_lights() only hands the snapshot over and returns at once;
+    # poll(), called every tick, applies a finished plan in one step, so the
+    # simulation and the GUI never wait on a solve. While a solve is running
+    # further requests are dropped and the lights in force stay as they are.
+    def __init__(self, city, backend=DEFAULT_OPTIMIZER, budget=OPTIMIZER_BUDGET):
+        super().__init__(city, backend)
+        self.budget = budget
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='optimizer')
+        self.future = None
+        self.requested = 0  # Snapshots handed to the worker
+        self.skipped = 0  # Requests dropped while a solve was running
+        self.applied = 0
+        self.late = 0  # Solves that overran the budget
+        self.lag = 0  # Ticks between the snapshot and the last applied plan
+
+    def optimize_lights(self):
+        applied = self.poll()
+        if self.future is not None:
+            self.skipped += 1
+            return applied
+        snapshot = CitySnapshot(self.city)
+        deadline = time.perf_counter() + self.budget
+        self.future = self.executor.submit(self.solve, snapshot, deadline)
+        self.requested += 1
+        return applied
+
+    def solve(self, snapshot, deadline):
+        # Worker thread: the backend's state is only touched here while a
+        # future is pending, and only by the main thread otherwise
+        plan = self.backend.solve(snapshot, deadline)
+        if time.perf_counter() > deadline:
+            self.late += 1
+        return snapshot.tick, plan
+
+    def poll(self):
+        future = self.future
+        if future is None or not future.done():
+            return False
+        self.future = None
+        tick, plan = future.result()
+        if not self.apply(plan):
+            return False
+        self.applied += 1
+        self.lag = self.city.tick - tick
+        return True
+
+    def wait(self, timeout=None):
+        # Block until the running solve is applied, e.g. before a checkpoint
+        # reads the backend state or when a first plan is needed at start-up
+        if self.future is not None:
+            self.future.result(timeout)
+        return self.poll()
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,160 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import traffic_signal
+from traffic_signal import DEFAULT_OPTIMIZER, SimulationEngine
+
+OPERATIONS = ('vehicles', 'lights', 'optimize', 'emergency', 'step', 'draw')
+TIME_BUDGET = 2.0  # Seconds of measurement per case at most
+MIN_SAMPLES = 5
+MEMORY_SAMPLES = 3
+
+def build_engine(grid_size, vehicles, optimizer=DEFAULT_OPTIMIZER, seed=0):
+    # A city with `vehicles` spread uniformly over the intersections and the
+    # lights already optimized, so every case starts from the same state
+    engine = SimulationEngine(grid_size, optimizer, seed=seed, setup=False)
+    city = engine.city
+    rng = np.random.default_rng(seed)
+    city.spawn_vehicles(rng.integers(0, city.topology.num_nodes, vehicles),
+                        rng.integers(0, 3, vehicles))
+    engine.optimizer.optimize_lights()
+    return engine
+
+def operation(name, engine, simulation=None):
+    city = engine.city
+    if name == 'vehicles':
+        return city.update_vehicle_positions
+    if name == 'lights':
+        return city.update_traffic_lights
+    if name == 'optimize':
+        return engine.optimizer.optimize_lights
+    if name == 'emergency':
+        rng = np.random.default_rng(1)
+        def emergency():
+            start, end = rng.choice(len(city.intersections), 2, replace=False)
+            city.set_emergency_route(city.intersections[start], city.intersections[end])
+        return emergency
+    if name == 'step':
+        return engine.step
+    if name == 'draw':
+        return simulation.draw
+    raise ValueError(f"Unknown operation: {name}")
+
+def measure(fn, max_samples, budget=TIME_BUDGET):
+    samples = []
+    deadline = time.perf_counter() + budget
+    while len(samples) < max_samples and (len(samples) < MIN_SAMPLES or time.perf_counter() < deadline):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return np.array(samples)
+
+def peak_memory(fn):
+    # Peak Python and NumPy allocation while running the operation, measured
+    # in a separate pass because tracemalloc slows the timed samples
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    for _ in range(MEMORY_SAMPLES):
+        fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return max(peak - baseline, 0)
+
+def run_case(grid_size, vehicles, name, samples, optimizer=DEFAULT_OPTIMIZER):
+    engine = build_engine(grid_size, vehicles, optimizer)
+    simulation = None
+    if name == 'draw':
+        # Render into the SDL dummy driver's offscreen surface
+        os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+        simulation = traffic_signal.Simulation(grid_size, optimizer, engine=engine)
+    fn = operation(name, engine, simulation)
+    fn()  # Warm up lazy imports and the render caches before timing
+    timings = measure(fn, samples)
+    memory = peak_memory(fn)
+    engine.close()
+    return {
+        'operation': name,
+        'grid_size': grid_size,
+        'vehicles': vehicles,
+        'optimizer': optimizer,
+        'samples': len(timings),
+        'ticks_per_sec': float(1.0 / timings.mean()),
+        'p50_ms': float(np.percentile(timings, 50) * 1000),
+        'p99_ms': float(np.percentile(timings, 99) * 1000),
+        'peak_mb': memory / 2**20,
+    }
+
+def case_key(result):
+    return (result['operation'], result['grid_size'], result['vehicles'], result['optimizer'])
+
+def compare(results, baseline, tolerance):
+    # Slowdowns beyond the tolerance compared with a stored baseline run,
+    # judged on median latency since the mean is skewed by scheduler noise
+    previous = {case_key(result): result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        old = previous.get(case_key(result))
+        if old is None:
+            continue
+        ratio = old['p50_ms'] / result['p50_ms']
+        result['baseline_ratio'] = ratio
+        if ratio < 1 - tolerance:
+            regressions.append(result)
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark simulation and rendering throughput")
+    parser.add_argument('--grid-sizes', type=int, nargs='+', default=[4, 16, 64])
+    parser.add_argument('--vehicles', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--ops', nargs='+', choices=OPERATIONS, default=list(OPERATIONS))
+    parser.add_argument('--optimizer', default=DEFAULT_OPTIMIZER)
+    parser.add_argument('--samples', type=int, default=200,
+                        help="timed calls per case, cut short by the per-case time budget")
+    parser.add_argument('--out', default=None, help="write results as JSON")
+    parser.add_argument('--baseline', default=None, help="JSON results to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help="allowed slowdown against the baseline before failing")
+    args = parser.parse_args(argv)
+
+    results = []
+    print(f"{'operation':<10} {'grid':>5} {'vehicles':>9} {'ticks/s':>10} {'p50 ms':>9} {'p99 ms':>9} {'peak MB':>8}")
+    for grid_size in args.grid_sizes:
+        for vehicles in args.vehicles:
+            for name in args.ops:
+                result = run_case(grid_size, vehicles, name, args.samples, args.optimizer)
+                results.append(result)
+                print(f"{name:<10} {grid_size:>5} {vehicles:>9} {result['ticks_per_sec']:>10.1f} "
+                      f"{result['p50_ms']:>9.3f} {result['p99_ms']:>9.3f} {result['peak_mb']:>8.2f}")
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for result in regressions:
+            print(f"REGRESSION {result['operation']} grid={result['grid_size']} "
+                  f"vehicles={result['vehicles']}: {result['baseline_ratio']:.2f}x baseline speed")
+
+    if args.out:
+        report = {
+            'meta': {
+                'timestamp': time.time(),
+                'python': sys.version.split()[0],
+                'numpy': np.__version__,
+                'platform': platform.platform(),
+            },
+            'results': results,
+        }
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,186 @@
+import os
+from collections import defaultdict
+
+import numpy as np
+
+from section_file import read_sections, write_sections
+from signal_plan import SignalPlan
+from traffic_signal import engine_class
+from vehicle_store import FIELDS as FLEET_FIELDS
+
+# Checkpoints use the section file layout (see section_file), so the arrays
+# can be memory-mapped straight from the file
+MAGIC = b'TRAFCKPT'
+VERSION = 6  # 6: rolling traffic metrics
+
+class CheckpointError(ValueError):
+    pass
+
+def engine_sections(engine):
+    if engine.mode == 'sharded':
+        raise CheckpointError("Sharded runs keep their vehicles in the workers and cannot be checkpointed")
+    city = engine.city
+    fleet = city.fleet
+    size = city.size
+    if not isinstance(size, int):
+        # Networks are checkpointed by path and reloaded on resume, which may
+        # run from another directory
+        size = size if isinstance(size, str) else city.topology.path
+        if size is None:
+            raise CheckpointError("Save the road network with road_network.save_network to checkpoint it")
+        size = os.path.abspath(size)
+    spawn_version, spawn_state, spawn_gauss = city.random.getstate()
+    engine.optimizer.wait()  # A background solve still owns the backend state
+    backend_meta, backend_arrays = engine.optimizer.backend.state()
+
+    meta = {
+        'engine': {
+            'mode': engine.mode,
+            'time': engine.time,
+            'light_interval': engine.light_interval,
+            'optimizer': engine.optimizer.backend.name,
+            'optimizer_state': backend_meta,
+            'signal_plan': city.signal_plan is not None,
+            'demand': None,
+        },
+        'city': {
+            'size': size,
+            'vehicle_speed': city.vehicle_speed,
+            'spawn_probability': city.spawn_probability,
+            'seed': city.seed,
+            'tick': city.tick,
+            'emergency_route': list(city.emergency_route),
+            'emergency_vehicle_pos': city.emergency_vehicle_pos,
+            'emergency_started': city.emergency_started,
+            'stats': city.stats,
+        },
+        'rng': {
+            'spawn_version': spawn_version,
+            'spawn_gauss': spawn_gauss,
+            'route': city.np_random.bit_generator.state,
+            'draw_key': city.draw_key,
+        },
+        'fleet_count': fleet.count,
+    }
+    arrays = {
+        'city.light_ns': city.light_ns,
+        'city.light_ew': city.light_ew,
+        'city.light_timer': city.light_timer,
+        'city.pedestrians': np.array([city.pedestrians.get(name, 0) for name in city.intersections],
+                                     dtype=np.int32),
+        'rng.spawn_state': np.array(spawn_state, dtype=np.uint32),
+        'fleet.free': np.array(fleet.free, dtype=np.int64),
+    }
+    # Cached route trees follow from the costs and are rebuilt on demand
+    for name, array in city.router.state().items():
+        arrays[f'router.{name}'] = array
+    if city.metrics is not None:
+        for name, array in city.metrics.state().items():
+            arrays[f'metrics.{name}'] = array
+    for field in FLEET_FIELDS:
+        arrays[f'fleet.{field}'] = getattr(fleet, field)[:fleet.count]
+    for name, array in backend_arrays.items():
+        arrays[f'optimizer.{name}'] = array
+    if city.signal_plan is not None:
+        for name, array in city.signal_plan.arrays().items():
+            arrays[f'plan.{name}'] = array
+    if engine.demand is not None:
+        demand = engine.demand
+        meta['engine']['demand'] = {'period_ticks': demand.period_ticks, 'start_tick': demand.start_tick,
+                                    'batch': demand.batch}
+        for name, array in demand.arrays().items():
+            arrays[f'demand.{name}'] = array
+    if engine.mode == 'meso':
+        meta['flow'] = {'arrivals': engine.arrivals, 'travel_ticks': engine.travel_ticks}
+        for name, array in engine.flow.state().items():
+            arrays[f'flow.{name}'] = array
+    return meta, arrays
+
+def save_checkpoint(engine, path):
+    meta, arrays = engine_sections(engine)
+    write_sections(path, MAGIC, VERSION, meta, arrays)
+
+def read_checkpoint(path, mmap=True):
+    # Returns (metadata, arrays). With mmap the arrays are copy-on-write views
+    # of the file, so many branches can share one snapshot in the page cache.
+    return read_sections(path, MAGIC, VERSION, "traffic simulation checkpoint", CheckpointError, mmap)
+
+def load_checkpoint(path, mmap=True, reseed=None, engine=None):
+    # Rebuilds an engine at the checkpointed tick. reseed replaces the RNG
+    # streams so experiments can branch from one warmed-up state. engine is
+    # the class to rebuild, by default the one that wrote the checkpoint; tick
+    # and event mode can resume each other's checkpoints.
+    meta, arrays = read_checkpoint(path, mmap)
+    engine_meta = meta['engine']
+    city_meta = meta['city']
+    saved_mode = engine_meta.get('mode', 'tick')
+    if engine is None:
+        engine = engine_class(saved_mode)
+    elif engine.mode == 'sharded':
+        raise CheckpointError("Checkpoints cannot resume in sharded mode")
+    elif (engine.mode == 'meso') != (saved_mode == 'meso'):
+        raise CheckpointError(f"A {saved_mode} mode checkpoint cannot resume in {engine.mode} mode")
+
+    engine = engine(city_meta['size'], engine_meta['optimizer'],
+                    light_interval=engine_meta['light_interval'],
+                    spawn_probability=city_meta['spawn_probability'],
+                    vehicle_speed=city_meta['vehicle_speed'],
+                    seed=city_meta['seed'], setup=False)
+    engine.time = engine_meta['time']
+    city = engine.city
+    city.tick = city_meta['tick']
+    city.emergency_route = city_meta['emergency_route']
+    city.emergency_vehicle_pos = city_meta['emergency_vehicle_pos']
+    city.emergency_started = city_meta['emergency_started']
+    city.stats = city_meta['stats']
+
+    city.light_ns[:] = arrays['city.light_ns']
+    city.light_ew[:] = arrays['city.light_ew']
+    city.light_timer[:] = arrays['city.light_timer']
+    city.pedestrians = defaultdict(int, {
+        city.intersections[node]: int(count)
+        for node, count in enumerate(arrays['city.pedestrians']) if count
+    })
+
+    fleet = city.fleet
+    for field in FLEET_FIELDS:
+        setattr(fleet, field, arrays[f'fleet.{field}'])
+    fleet.count = meta['fleet_count']
+    fleet.free = arrays['fleet.free'].tolist()
+    ids = fleet.live_ids()
+    if len(ids):
+        city.vehicles.insert_many(ids, fleet.current[ids], fleet.link[ids])
+
+    city.router.load_state({name.split('.', 1)[1]: array for name, array in arrays.items()
+                            if name.startswith('router.')})
+    metrics_arrays = {name.split('.', 1)[1]: array for name, array in arrays.items()
+                      if name.startswith('metrics.')}
+    if city.metrics is not None and metrics_arrays:
+        city.metrics.load_state(metrics_arrays)
+    backend_arrays = {name.split('.', 1)[1]: array for name, array in arrays.items()
+                      if name.startswith('optimizer.')}
+    engine.optimizer.backend.load_state(city.topology, engine_meta['optimizer_state'], backend_arrays)
+    if engine_meta.get('signal_plan'):
+        city.signal_plan = SignalPlan.from_arrays({name.split('.', 1)[1]: array for name, array in arrays.items()
+                                                   if name.startswith('plan.')})
+    demand = engine_meta['demand']
+    if demand is not None:
+        from demand import DemandModel
+        engine.demand = DemandModel.from_arrays(city.topology,
+                                                {name.split('.', 1)[1]: array for name, array in arrays.items()
+                                                 if name.startswith('demand.')},
+                                                demand['period_ticks'], demand['start_tick'], demand['batch'])
+    if engine.mode == 'meso':
+        engine.flow.load_state({name.split('.', 1)[1]: array for name, array in arrays.items()
+                                if name.startswith('flow.')})
+        engine.arrivals = meta['flow']['arrivals']
+        engine.travel_ticks = meta['flow']['travel_ticks']
+
+    rng = meta['rng']
+    city.random.setstate((rng['spawn_version'], tuple(arrays['rng.spawn_state'].tolist()),
+                          rng['spawn_gauss']))
+    city.np_random.bit_generator.state = rng['route']
+    city.draw_key = rng['draw_key']
+    if reseed is not None:
+        city.seed_rng(reseed)
+    return engine
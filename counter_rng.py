@@ -0,0 +1,59 @@
+import numpy as np
+
+# Streams of counter-based draws; each stream keys its draws differently
+SPAWN, VEHICLE, ROUTE, PEDESTRIANS, BULK, DEMAND = range(6)
+POISSON_EXACT_LIMIT = 64  # Larger means use the normal approximation
+
+def mix64(x):
+    # splitmix64 finalizer, a bijection on uint64 that spreads every input
+    # bit over the whole output
+    x = x ^ (x >> np.uint64(30))
+    x *= np.uint64(0xBF58476D1CE4E5B9)
+    x ^= x >> np.uint64(27)
+    x *= np.uint64(0x94D049BB133111EB)
+    x ^= x >> np.uint64(31)
+    return x
+
+def hash64(key, *counters):
+    # One uint64 per element of the broadcast counters. The result depends
+    # only on the key and the counter values, not on how many draws were made
+    # before or in what order, so any subset of the city draws the same
+    # numbers for its own nodes and vehicles.
+    counters = np.broadcast_arrays(*[np.atleast_1d(np.asarray(c)) for c in counters])
+    h = np.full(counters[0].shape, key, dtype=np.uint64)
+    for counter in counters:
+        h = mix64(h ^ mix64(counter.astype(np.uint64)))
+    return h
+
+def uniform(key, *counters):
+    # Floats in [0, 1) from the top 53 bits of hash64
+    return (hash64(key, *counters) >> np.uint64(11)) * (1.0 / (1 << 53))
+
+def poisson(key, lam, *counters):
+    # Poisson counts with means `lam`, one per element of the broadcast
+    # counters (shaped like lam). Small means invert the CDF with one uniform
+    # each; large ones, where exp(-lam) loses precision, use a rounded normal
+    # draw from two uniforms (Box-Muller).
+    lam = np.asarray(lam, dtype=np.float64)
+    u = uniform(key, *counters, 0).reshape(lam.shape)
+    counts = np.zeros(lam.shape, dtype=np.int64)
+    exact = (lam > 0) & (lam < POISSON_EXACT_LIMIT)
+    if exact.any():
+        mean, left = lam[exact], u[exact]
+        k = np.zeros(len(mean), dtype=np.int64)
+        p = np.exp(-mean)
+        cdf = p.copy()
+        going = left > cdf
+        while going.any():
+            k[going] += 1
+            p[going] *= mean[going] / k[going]
+            cdf[going] += p[going]
+            # Stop once the tail is below float precision
+            going &= (left > cdf) & (p > 0)
+        counts[exact] = k
+    large = lam >= POISSON_EXACT_LIMIT
+    if large.any():
+        v = uniform(key, *counters, 1).reshape(lam.shape)[large]
+        normal = np.sqrt(-2 * np.log1p(-u[large])) * np.cos(2 * np.pi * v)
+        counts[large] = np.maximum(np.rint(lam[large] + np.sqrt(lam[large]) * normal), 0)
+    return counts
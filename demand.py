@@ -0,0 +1,186 @@
+import os
+
+import numpy as np
+
+from counter_rng import DEMAND, hash64, poisson, uniform
+from traffic_signal import FPS, SPAWN_INTERVAL
+
+HOUR_TICKS = FPS * 3600
+DEMAND_PROFILES = ('uniform', 'peak')
+DEMAND_BATCH = SPAWN_INTERVAL  # Ticks of trips drawn at once
+DEFAULT_ZONES = 64
+# Trips into a zone end at one of this many of its intersections, so that
+# vehicles share route trees (see routing)
+DESTINATIONS_PER_ZONE = 4
+TYPE_WEIGHTS = np.array([5, 2, 1]) / 8  # Same mix as CityGrid.add_random_vehicles
+# Hourly demand of the 'peak' profile relative to the daily mean, with
+# morning and evening rush hours
+PEAK_HOURS = np.array([0.2, 0.1, 0.1, 0.1, 0.2, 0.5, 1.2, 2.2, 2.5, 1.6, 1.0, 1.0,
+                       1.1, 1.0, 1.0, 1.3, 2.0, 2.6, 2.2, 1.4, 1.0, 0.8, 0.5, 0.3])
+MORNING, EVENING = range(6, 11), range(15, 20)
+CENTRE_PULL = 3.0  # Extra attraction of central zones in the rush hours
+
+class DemandModel:
+    # Trips from origin-destination matrices by time of day. Nodes are
+    # grouped into zones; od[p] gives the vehicles per hour from every zone
+    # to every zone in period p. Periods last period_ticks, repeat, and tick
+    # 0 falls start_tick into the first one. Every `batch` ticks the trips
+    # of the whole batch are drawn at once: a Poisson count per zone pair,
+    # then for every trip its origin intersection within the zone, one of
+    # the zone's few destination intersections, its vehicle type, first
+    # link and a release tick spread evenly over the batch, so vehicles
+    # trickle in instead of arriving in one spike.
+    # All draws are counter-based, keyed by batch and trip, so any part of
+    # the city (see sharded_engine) sees the same trips.
+    def __init__(self, topology, zones, od, period_ticks=HOUR_TICKS, start_tick=0, batch=DEMAND_BATCH):
+        self.topology = topology
+        self.zones = np.asarray(zones, dtype=np.int32)
+        num_zones = int(self.zones.max()) + 1 if len(self.zones) else 0
+        self.od = np.asarray(od, dtype=np.float64).reshape(-1, num_zones, num_zones)
+        self.period_ticks = period_ticks
+        self.start_tick = start_tick
+        self.batch = batch
+        # Trips start and end at intersections with roads, listed by zone
+        on_road = np.flatnonzero(topology.degree > 0)
+        self.zone_nodes = on_road[np.argsort(self.zones[on_road], kind='stable')]
+        sizes = np.bincount(self.zones[on_road], minlength=num_zones)
+        self.zone_start = np.concatenate([[0], np.cumsum(sizes)])
+        # Destinations spread evenly over each zone's list of intersections
+        wanted = np.minimum(sizes, DESTINATIONS_PER_ZONE)
+        self.destination_start = np.concatenate([[0], np.cumsum(wanted)])
+        zone = np.repeat(np.arange(num_zones), wanted)
+        rank = np.arange(wanted.sum()) - self.destination_start[zone]
+        self.destination_nodes = self.zone_nodes[self.zone_start[zone] + (2 * rank + 1) * sizes[zone] // (2 * wanted[zone])]
+        self.rates = self.od * (sizes[:, None] > 0) * (sizes[None, :] > 0) / HOUR_TICKS
+        self.cached = None
+        self.trips = None
+
+    def period(self, tick):
+        return (self.start_tick + tick) // self.period_ticks % len(self.od)
+
+    def vehicles_per_tick(self, tick):
+        return float(self.rates[self.period(tick)].sum())
+
+    def draw_batch(self, key, number):
+        # Trips released on ticks number*batch .. (number+1)*batch - 1, in
+        # release order
+        start = number * self.batch
+        counts = poisson(key, self.rates[self.period(start)] * self.batch, DEMAND, number,
+                         np.arange(self.rates.shape[1])[:, None], np.arange(self.rates.shape[2]))
+        pairs = np.repeat(np.arange(counts.size), counts.ravel())
+        trips = np.arange(len(pairs))
+        draws = uniform(key, DEMAND, number, trips[:, None], 2 + np.arange(5))
+        ticks = start + (draws[:, 0] * self.batch).astype(np.int64)
+        order = np.argsort(ticks, kind='stable')
+        pairs, trips, draws, ticks = pairs[order], trips[order], draws[order], ticks[order]
+
+        zone_start = self.zone_start
+        origin_zone, destination_zone = np.divmod(pairs, self.rates.shape[2])
+        sizes = zone_start[1:] - zone_start[:-1]
+        origins = self.zone_nodes[zone_start[origin_zone] + (draws[:, 1] * sizes[origin_zone]).astype(np.int64)]
+        destination_start = self.destination_start
+        choices = destination_start[destination_zone + 1] - destination_start[destination_zone]
+        destinations = self.destination_nodes[destination_start[destination_zone]
+                                              + (draws[:, 2] * choices).astype(np.int64)]
+        type_codes = np.searchsorted(np.cumsum(TYPE_WEIGHTS)[:-1], draws[:, 3], side='right').astype(np.int8)
+        return {
+            'tick': ticks,
+            'origin': origins,
+            'destination': destinations,
+            'link': self.topology.pick_links(origins, draws[:, 4]),
+            'type_code': type_codes,
+            'key': hash64(key, DEMAND, number, trips),
+        }
+
+    def release(self, key, tick, nodes=None):
+        # Trips due on `tick`, optionally only those leaving `nodes` (a mask)
+        number = tick // self.batch
+        if self.cached != (key, number):
+            self.trips = self.draw_batch(key, number)
+            self.cached = (key, number)
+        ticks = self.trips['tick']
+        due = slice(np.searchsorted(ticks, tick), np.searchsorted(ticks, tick, side='right'))
+        trips = {name: array[due] for name, array in self.trips.items()}
+        if nodes is not None:
+            mine = nodes[trips['origin']]
+            trips = {name: array[mine] for name, array in trips.items()}
+        return trips
+
+    def next_release(self, key, tick, horizon):
+        # First tick after `tick` and before `horizon` with trips due, or
+        # None; batches without trips are skipped
+        while tick + 1 < horizon:
+            self.release(key, tick + 1)
+            ticks = self.trips['tick']
+            later = ticks[ticks > tick]
+            if len(later):
+                return int(later[0]) if later[0] < horizon else None
+            tick = ((tick + 1) // self.batch + 1) * self.batch - 1
+        return None
+
+    def arrays(self):
+        return {'zones': self.zones, 'od': self.od}
+
+    @classmethod
+    def from_arrays(cls, topology, arrays, period_ticks, start_tick, batch=DEMAND_BATCH):
+        return cls(topology, arrays['zones'], arrays['od'], period_ticks, start_tick, batch)
+
+def zone_weights(topology, zones, num_zones):
+    # 1 at the edge of the network rising to 1 + CENTRE_PULL at its centre,
+    # by the distance of each zone's centroid from the centre
+    xy = topology.node_xy
+    centroid = np.stack([np.bincount(zones, weights=xy[:, axis], minlength=num_zones) for axis in (0, 1)], axis=1)
+    centroid /= np.maximum(np.bincount(zones, minlength=num_zones), 1)[:, None]
+    centre = (xy.min(axis=0) + xy.max(axis=0)) / 2
+    reach = max(float(np.abs(xy - centre).max()), 1e-9)
+    distance = np.linalg.norm(centroid - centre, axis=1) / reach
+    return 1 + CENTRE_PULL * np.exp(-4 * distance ** 2)
+
+def profile_od(kind, topology, zones, vehicles_per_hour):
+    # Built-in profiles; vehicles_per_hour is the mean demand of one
+    # intersection, so demand grows with the size of the network.
+    # 'uniform' sends every zone's trips to all zones by their size around
+    # the clock. 'peak' follows PEAK_HOURS and pulls trips into the centre
+    # in the morning and back out in the evening.
+    on_road = topology.degree > 0
+    sizes = np.bincount(zones[on_road], minlength=int(zones.max()) + 1).astype(np.float64)
+    total = vehicles_per_hour * sizes.sum()
+    share = sizes / sizes.sum()
+    if kind == 'uniform':
+        return total * np.outer(share, share)[None]
+    centre = zone_weights(topology, zones, len(sizes)) * share
+    centre /= centre.sum()
+    od = np.empty((len(PEAK_HOURS), len(sizes), len(sizes)))
+    for hour, level in enumerate((PEAK_HOURS / PEAK_HOURS.mean()).tolist()):
+        origins = centre if hour in EVENING else share
+        destinations = centre if hour in MORNING else share
+        od[hour] = level * total * np.outer(origins, destinations)
+    return od
+
+def make_demand(demand, city, hour=0):
+    # A DemandModel, a built-in profile name or the path of an .npz file
+    # with 'od' (vehicles per hour, periods x zones x zones or zones x zones)
+    # and optionally 'zones' (zone of every intersection, by default one
+    # zone per intersection) and 'period_ticks' (default one hour). hour is
+    # the time of day at tick 0.
+    if isinstance(demand, DemandModel):
+        return demand
+    topology = city.topology
+    if demand in DEMAND_PROFILES:
+        zones = topology.tiles(min(DEFAULT_ZONES, topology.num_nodes))
+        # The legacy spawn rate: one or two vehicles per spawn interval with
+        # the spawn probability
+        vehicles_per_hour = city.spawn_probability * 1.5 * HOUR_TICKS / SPAWN_INTERVAL
+        od = profile_od(demand, topology, zones, vehicles_per_hour)
+        period_ticks = HOUR_TICKS
+    elif isinstance(demand, (str, os.PathLike)) and os.path.exists(demand):
+        with np.load(demand) as data:
+            od = data['od']
+            zones = data['zones'] if 'zones' in data else np.arange(topology.num_nodes)
+            period_ticks = int(data['period_ticks']) if 'period_ticks' in data else HOUR_TICKS
+        if len(zones) != topology.num_nodes:
+            raise ValueError(f"{demand} has zones for {len(zones)} intersections, the network has {topology.num_nodes}")
+    else:
+        raise ValueError(f"Unknown demand {demand!r}: use one of {', '.join(DEMAND_PROFILES)} or an .npz file")
+    # Periods follow each other from midnight
+    return DemandModel(topology, zones, od, period_ticks, round(hour * HOUR_TICKS))
@@ -0,0 +1,304 @@
+import heapq
+
+import numpy as np
+
+from topology import EW
+from traffic_signal import SPAWN_INTERVAL, SimulationEngine
+from vehicle_store import ARRIVAL_PROGRESS
+
+# Order of the phases within one tick, as in SimulationEngine.step
+LIGHTS, ROUTES, EMERGENCY, ARRIVALS, DEMAND, SPAWN, TELEMETRY = range(7)
+NEVER = np.iinfo(np.int64).max
+
+class ProgressTables:
+    # The progress of a vehicle after j moving ticks is the float sum of j
+    # additions of its speed, exactly as VehicleStore.advance accumulates it.
+    # Tables of those sums per speed turn "moving ticks so far" into progress
+    # and give the number of moving ticks a segment takes.
+    def __init__(self):
+        self.tables = {}
+
+    def table(self, speed):
+        table = self.tables.get(speed)
+        if table is None:
+            sums = [0.0]
+            if speed > 0:
+                while sums[-1] < ARRIVAL_PROGRESS:
+                    sums.append(sums[-1] + speed)
+            table = self.tables[speed] = np.array(sums)
+        return table
+
+    def steps_needed(self, speeds):
+        needed = np.full(len(speeds), NEVER, dtype=np.int64)
+        for speed in np.unique(speeds).tolist():
+            if speed > 0:
+                needed[speeds == speed] = len(self.table(speed)) - 1
+        return needed
+
+    def steps_taken(self, speeds, progress):
+        steps = np.zeros(len(speeds), dtype=np.int64)
+        for speed in np.unique(speeds).tolist():
+            if speed > 0:
+                same = speeds == speed
+                steps[same] = np.searchsorted(self.table(speed), progress[same])
+        return steps
+
+    def progress(self, speeds, steps):
+        progress = np.zeros(len(speeds))
+        for speed in np.unique(speeds).tolist():
+            if speed > 0:
+                same = speeds == speed
+                progress[same] = self.table(speed)[steps[same]]
+        return progress
+
+class EventDrivenEngine(SimulationEngine):
+    # Same model as SimulationEngine, but time jumps from event to event:
+    # vehicle arrivals at a node, light phase changes, route cost updates,
+    # spawns, demand releases, emergency completion and telemetry records, kept in a priority queue. Between
+    # light changes every vehicle's gate is fixed, so its arrival tick is
+    # known in advance and nothing has to happen on the ticks in between.
+    # Events of one tick run in the same order as the phases of step(), so
+    # the results match tick mode tick for tick.
+    mode = 'event'
+    reports_ticks = True
+    tables = ProgressTables()
+
+    def __init__(self, *args, **kwargs):
+        # Arrival events are scheduled from the lights, so plans have to land
+        # on the light-change ticks rather than whenever a worker finishes
+        if kwargs.get('optimizer_budget') is not None:
+            raise ValueError("the event engine needs the synchronous optimizer")
+        super().__init__(*args, **kwargs)
+
+    def run(self, ticks):
+        end = self.time + ticks
+        self._start(end)
+        while self.queue and self.queue[0][0] <= end:
+            tick = self.queue[0][0]
+            kinds = set()
+            while self.queue and self.queue[0][0] == tick:
+                kinds.add(heapq.heappop(self.queue)[1])
+            if self.profiler is None:
+                self._process(tick, kinds)
+            else:
+                # Ticks without events take no work, so they are all
+                # counted with the next tick that has some
+                self.profiler.time_ticks(tick - self.time, self._process, tick, kinds)
+        if self.profiler is None:
+            self._finish(end)
+        else:
+            self.profiler.time_ticks(end - self.time, self._finish, end)
+        return self.city.stats
+
+    def step(self):
+        self.run(1)
+
+    def _start(self, end):
+        # Rebuild the event state from the city, so the engine can be driven
+        # alternately with other code that changes the city between runs
+        city = self.city
+        fleet = city.fleet
+        capacity = len(fleet.current)
+        self.steps = np.zeros(capacity, dtype=np.int64)  # Moving ticks before `since`
+        self.since = np.zeros(capacity, dtype=np.int64)
+        self.green = np.zeros(capacity, dtype=bool)
+        self.needed = np.full(capacity, NEVER, dtype=np.int64)
+        self.stamp = np.zeros(capacity, dtype=np.int64)  # Invalidates queued arrivals
+        self.arrivals = {}
+        self.queue = []
+        self.emergency_tick = self.time
+        self.end = end
+
+        ids = fleet.live_ids()
+        self.steps[ids] = self.tables.steps_taken(fleet.speed[ids], fleet.progress[ids])
+        self.needed[ids] = self.tables.steps_needed(fleet.speed[ids])
+        self.next_light = self._next_light_change(self.time)
+        self._gate(ids, self.time + 1)
+
+        self._push(self.next_light, LIGHTS)
+        self._push(self._next_multiple(self.light_interval), ROUTES)
+        self._push(self._next_multiple(SPAWN_INTERVAL), SPAWN)
+        self._schedule_demand(self.time)
+        if self.telemetry is not None:
+            self._push(self._next_multiple(self.telemetry.interval), TELEMETRY)
+        self._schedule_emergency()
+
+    def _push(self, tick, kind):
+        if tick is not None and tick != NEVER:
+            heapq.heappush(self.queue, (tick, kind))
+
+    def _next_multiple(self, interval):
+        return (self.time // interval + 1) * interval
+
+    def _next_light_change(self, tick):
+        # First tick after `tick` whose lights can differ from the tick before
+        plan = self.city.signal_plan
+        if plan is None:
+            return (tick // self.light_interval + 1) * self.light_interval
+        # Step t evaluates the plan at city tick t - 1, so phase boundaries b
+        # (phase 0 or split) take effect on step b + 1
+        first = [(start - plan.offset - tick) % plan.cycle + tick + 1 for start in (0, plan.split)]
+        return int(np.minimum(*first).min())
+
+    def _gate(self, ids, tick):
+        # Vehicles in `ids` start a run of constant gate on `tick`; queue the
+        # arrivals that happen before the next light change
+        city = self.city
+        fleet = city.fleet
+        self.since[ids] = tick
+        current = fleet.current[ids]
+        moving_ew = city.topology.link_axis[fleet.link[ids]] == EW
+        self.green[ids] = np.where(moving_ew, city.light_ew[current], city.light_ns[current])
+        self.stamp[ids] += 1
+        moving = ids[self.green[ids]]
+        arrive = tick + self.needed[moving] - self.steps[moving] - 1
+        soon = arrive < self.next_light
+        moving, arrive = moving[soon], arrive[soon]
+        if not len(moving):
+            return
+        if len(moving) == 1:
+            # Most events move a single vehicle; skip the grouping below
+            self._queue_arrivals(int(arrive[0]), moving)
+            return
+        order = np.argsort(arrive, kind='stable')
+        moving, arrive = moving[order], arrive[order]
+        ticks, starts = np.unique(arrive, return_index=True)
+        for tick, group in zip(ticks.tolist(), np.split(moving, starts[1:])):
+            self._queue_arrivals(tick, group)
+
+    def _queue_arrivals(self, tick, group):
+        # Groups keep ascending vehicle ids, the order tick mode moves them in
+        queued = self.arrivals.get(tick)
+        if queued is None:
+            queued = self.arrivals[tick] = []
+            self._push(tick, ARRIVALS)
+        queued.append((group, self.stamp[group]))
+
+    def _schedule_demand(self, tick):
+        # Next tick in this run with demand trips due
+        if self.demand is not None:
+            self._push(self.demand.next_release(self.city.draw_key, tick, self.end + 1), DEMAND)
+
+    def _grow(self):
+        capacity = len(self.city.fleet.current)
+        if capacity <= len(self.steps):
+            return
+        for name, fill in (('steps', 0), ('since', 0), ('green', False), ('needed', NEVER), ('stamp', 0)):
+            old = getattr(self, name)
+            new = np.full(capacity, fill, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def _schedule_emergency(self):
+        # Tick on which the emergency vehicle completes its route
+        city = self.city
+        route = city.emergency_route
+        if not route or city.emergency_vehicle_pos >= len(route) - 1:
+            return
+        step = city.emergency_step
+        if step <= 0:
+            return
+        # The positions update_emergency_vehicle reaches, added up in the
+        # same order so the float sums match tick for tick
+        moves = int(np.ceil((len(route) - 1 - city.emergency_vehicle_pos) / step)) + 2
+        positions = np.add.accumulate(np.concatenate([[city.emergency_vehicle_pos], np.full(moves, step)]))
+        self._push(self.emergency_tick + int(np.argmax(positions >= len(route) - 1)), EMERGENCY)
+
+    def _catch_up_emergency(self, tick):
+        # Replay the emergency vehicle's per-tick moves up to `tick`; they stop
+        # as soon as it completes its route
+        city = self.city
+        saved = city.tick
+        while self.emergency_tick < tick:
+            route = city.emergency_route
+            if not route or city.emergency_vehicle_pos >= len(route) - 1:
+                break
+            self.emergency_tick += 1
+            city.tick = self.emergency_tick - 1
+            city.update_emergency_vehicle()
+        self.emergency_tick = tick
+        city.tick = saved
+
+    def _process(self, tick, kinds):
+        city = self.city
+        fleet = city.fleet
+        self.time = tick
+        city.tick = tick - 1
+
+        if LIGHTS in kinds:
+            if city.signal_plan is not None:
+                city.update_traffic_lights()
+            elif tick % self.light_interval == 0:
+                city.update_traffic_lights(self.light_interval)
+                self.optimizer.optimize_lights()
+            # Bank the moving ticks of the run that ends here, then re-gate
+            ids = fleet.live_ids()
+            self.steps[ids] += np.where(self.green[ids], tick - self.since[ids], 0)
+            self.next_light = self._next_light_change(tick)
+            self._gate(ids, tick)
+            self._push(self.next_light, LIGHTS)
+
+        if ROUTES in kinds:
+            city.update_route_costs()
+            self._push(tick + self.light_interval, ROUTES)
+
+        self._catch_up_emergency(tick)
+
+        city.tick = tick
+        # Re-gating at a light change can queue arrivals for this very tick,
+        # so look them up rather than relying on the popped event kinds
+        queued = self.arrivals.pop(tick, None)
+        if queued:
+            self.move_arrivals(tick, queued)
+
+        if DEMAND in kinds:
+            count = fleet.count
+            was_alive = fleet.alive[:count].copy()
+            self.release_demand()
+            self._start_spawned(count, was_alive, tick)
+            self._schedule_demand(tick)
+
+        if SPAWN in kinds:
+            count = fleet.count
+            was_alive = fleet.alive[:count].copy()
+            self.spawn_traffic()
+            self._start_spawned(count, was_alive, tick)
+            self._push(tick + SPAWN_INTERVAL, SPAWN)
+
+        if TELEMETRY in kinds and self.telemetry is not None:
+            self.telemetry.record(self)
+            self._push(tick + self.telemetry.interval, TELEMETRY)
+
+    def move_arrivals(self, tick, queued):
+        # Vehicles of the queued groups still due on `tick` reach their node
+        fleet = self.city.fleet
+        arrived = [group[self.stamp[group] == stamps] for group, stamps in queued]
+        arrived = arrived[0] if len(arrived) == 1 else np.sort(np.concatenate(arrived))
+        if len(arrived):
+            self.city.complete_segments(arrived)
+            # Vehicles that reached their destination are gone
+            arrived = arrived[fleet.alive[arrived]]
+            self.steps[arrived] = 0
+            self._gate(arrived, tick + 1)
+
+    def _start_spawned(self, count, was_alive, tick):
+        # New vehicles, in fresh or recycled slots, start like rerouted ones
+        fleet = self.city.fleet
+        self._grow()
+        new = np.ones(fleet.count, dtype=bool)
+        new[:count] = ~was_alive
+        spawned = np.flatnonzero(fleet.alive[:fleet.count] & new)
+        self.steps[spawned] = 0
+        self.needed[spawned] = self.tables.steps_needed(fleet.speed[spawned])
+        self._gate(spawned, tick + 1)
+
+    def _finish(self, end):
+        # Bring the emergency vehicle and the clock to the end of tick `end`
+        # and write the progress of every live vehicle there
+        self._catch_up_emergency(end)
+        self.time = end
+        self.city.tick = end
+        fleet = self.city.fleet
+        ids = fleet.live_ids()
+        steps = self.steps[ids] + np.where(self.green[ids], end + 1 - self.since[ids], 0)
+        fleet.progress[ids] = self.tables.progress(fleet.speed[ids], steps)
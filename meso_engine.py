@@ -0,0 +1,312 @@
+import numpy as np
+
+from counter_rng import ROUTE
+from routing import NO_LINK
+from topology import EW
+from traffic_signal import SimulationEngine
+from vehicle_store import ARRIVAL_PROGRESS, VEHICLE_TYPES
+
+CELLS_PER_LINK = 5
+JAM_DENSITY = 4.0  # Vehicles a cell holds when traffic is at a standstill
+CELL_CAPACITY = 1.0  # Most vehicles that can leave a cell in one update
+SPAWN_TYPE_WEIGHTS = np.array([5, 2, 1]) / 8  # Same mix as CityGrid.add_random_vehicles
+WAITING = -1.0  # Position of a trip still queued at the start of its link
+
+class CellTransmissionModel:
+    # Every directed link is a row of cells holding a vehicle density. Each
+    # update a cell sends min(density, capacity) downstream, limited by what
+    # the next cell can receive (capacity, or the space left scaled by the
+    # backward wave speed once it fills up), so queues form and spill back
+    # instead of vehicles passing through each other. At a node the vehicles
+    # leaving the incoming links split evenly over the outgoing links, as in
+    # the per-vehicle model, and only enter links whose axis shows green.
+    # Spawned vehicles wait at the start of their link until it has room.
+    # Capacity and jam density are per lane and scale with each link's lanes.
+    #
+    # An empty link sends nothing and can take a full cell's capacity, so
+    # updates only visit occupied links, and the node model only the links
+    # leaving nodes that vehicles arrive at. Densities are stored column by
+    # column, so each cell position is one contiguous run over the links.
+    #
+    # Demand trips ride along as one vehicle of the densities each, at a
+    # position in cells along their link. A trip moves on by the share of its
+    # cell's vehicles that left it, so it keeps pace with the traffic around
+    # it, and follows its route from node to node (see MesoscopicEngine).
+    # When a trip finishes, its destination owes one vehicle and takes it off
+    # the traffic arriving there, so the densities keep matching the vehicle
+    # counts.
+    def __init__(self, topology, cells=CELLS_PER_LINK, jam_density=JAM_DENSITY,
+                 capacity=CELL_CAPACITY):
+        self.topology = topology
+        self.density = np.zeros((topology.num_links, cells), order='F')
+        self.waiting = np.zeros(topology.num_links)  # Spawned, not yet on the road
+        self.occupied = np.zeros(topology.num_links, dtype=bool)  # Links with vehicles in a cell
+        # Scratch cells for the occupied links, one row per cell position,
+        # reused by every update
+        self.scratch = [np.empty((cells, topology.num_links)) for _ in range(3)]
+        self.jam_density = jam_density * topology.link_lanes
+        self.capacity = capacity * topology.link_lanes
+        self.wave = capacity / (jam_density - capacity)
+        self.east_west = topology.link_axis == EW
+        self.slot = np.zeros(topology.num_links, dtype=np.int64)  # Scratch index of links in a subset
+        self.finishing = np.zeros(topology.num_nodes)  # Vehicles of finished trips still to leave
+        self.trips = {
+            'link': np.zeros(0, dtype=np.int64),
+            'position': np.zeros(0),
+            'destination': np.zeros(0, dtype=np.int64),
+            'type_code': np.zeros(0, dtype=np.int8),
+            'key': np.zeros(0, dtype=np.uint64),
+        }
+        self.new_trips = []  # Released since the last update, merged in one go
+
+    @property
+    def link_count(self):
+        # Rounded vehicles per link, the same view VehicleIndex gives the
+        # optimizer and telemetry
+        return np.rint(self.density.sum(axis=1) + self.waiting).astype(np.int32)
+
+    @property
+    def node_count(self):
+        totals = np.bincount(self.topology.link_source, weights=self.density.sum(axis=1) + self.waiting,
+                             minlength=self.topology.num_nodes)
+        return np.rint(totals).astype(np.int32)
+
+    def total(self):
+        return float(self.density.sum() + self.waiting.sum())
+
+    def inject(self, links, vehicles=1.0):
+        np.add.at(self.waiting, links, vehicles)
+
+    def add_trips(self, trips):
+        # Trips join their first link's queue and keep their destination
+        self.inject(trips['link'])
+        self.new_trips.append(dict(trips, position=np.full(len(trips['link']), WAITING)))
+
+    def merge_trips(self):
+        if self.new_trips:
+            self.trips = {name: np.concatenate([array] + [trips[name].astype(array.dtype) for trips in self.new_trips])
+                          for name, array in self.trips.items()}
+            self.new_trips = []
+
+    def retire(self, finished):
+        # Drops finished trips (a mask); their destinations take their
+        # vehicles off the traffic arriving there from the next update on
+        np.add.at(self.finishing, self.trips['destination'][finished], 1.0)
+        self.trips = {name: array[~finished] for name, array in self.trips.items()}
+
+    def state(self):
+        self.merge_trips()
+        arrays = {'density': self.density, 'waiting': self.waiting, 'finishing': self.finishing}
+        for name, array in self.trips.items():
+            arrays[f'trips.{name}'] = array
+        return arrays
+
+    def load_state(self, arrays):
+        self.density[:] = arrays['density']
+        self.waiting[:] = arrays['waiting']
+        self.finishing[:] = arrays['finishing']
+        self.occupied[:] = self.density.any(axis=1)
+        self.trips = {name: np.array(arrays[f'trips.{name}'], dtype=array.dtype)
+                      for name, array in self.trips.items()}
+        self.new_trips = []
+
+    def space(self, links):
+        # Vehicles the first cell of each link can receive
+        room = self.jam_density[links] - self.density[links, 0]
+        room *= self.wave
+        np.maximum(room, 0, out=room)
+        return np.minimum(room, self.capacity[links], out=room)
+
+    def green(self, links, light_ns, light_ew):
+        source = self.topology.link_source[links]
+        return np.where(self.east_west[links], light_ew[source], light_ns[source])
+
+    def advance_trips(self, rows, density, inner, leaving, queued, joining):
+        # Share of the vehicles in each trip's cell (or queue) that moved on
+        # this update, from the flows before they are applied; a trip whose
+        # cell holds no vehicles moves freely
+        link, position = self.trips['link'], self.trips['position']
+        cell = np.floor(position).astype(np.int64)
+        share = np.ones(len(link))
+        slot = self.slot
+        trips = np.flatnonzero(cell >= 0)
+        trips = trips[self.occupied[link[trips]]]
+        if len(trips):
+            slot[rows] = np.arange(len(rows))
+            index, at = slot[link[trips]], cell[trips]
+            stock = density[at, index]
+            outflow = leaving[index]
+            inside = at < len(inner)
+            outflow[inside] = inner[at[inside], index[inside]]
+            held = stock > 0
+            share[trips[held]] = outflow[held] / stock[held]
+        trips = np.flatnonzero(cell < 0)
+        stock = self.waiting[link[trips]]
+        held = stock > 0
+        trips, stock = trips[held], stock[held]
+        if len(trips):
+            slot[queued] = np.arange(len(queued))
+            share[trips] = joining[slot[link[trips]]] / stock
+        position += share
+
+    def update(self, light_ns, light_ew):
+        # One update of every cell; returns the vehicles that completed a link
+        topology = self.topology
+        self.merge_trips()
+        cells = self.density.T
+        rows = np.flatnonzero(self.occupied)
+        count = len(rows)
+        density, sending, receiving = (buffer[:, :count] for buffer in self.scratch)
+        for cell, row in zip(cells, density):
+            np.take(cell, rows, out=row, mode='clip')
+        capacity = self.capacity[rows]
+        np.minimum(density, capacity, out=sending)
+        np.subtract(self.jam_density[rows], density, out=receiving)
+        receiving *= self.wave
+        np.maximum(receiving, 0, out=receiving)
+        np.minimum(receiving, capacity, out=receiving)
+        # Only the first cells' room is needed past this point, and space()
+        # reads it from the densities
+        inner = np.minimum(sending[:-1], receiving[1:], out=receiving[1:])
+
+        # Node model: demand arriving at each node, split over its outgoing
+        # links, admitted on green up to what each first cell can take. The
+        # outgoing links of a node are one run in the CSR order, so per-node
+        # values spread over them by repeat.
+        exiting = sending[-1]
+        targets = topology.link_target[rows]
+        node_demand = np.bincount(targets, weights=exiting, minlength=topology.num_nodes)
+        # Destinations owing vehicles of finished trips absorb them first
+        sinks = np.flatnonzero(self.finishing)
+        arriving = node_demand[sinks]
+        absorbed = np.clip(arriving, 0, self.finishing[sinks])
+        self.finishing[sinks] -= absorbed
+        node_demand[sinks] = arriving - absorbed
+        nodes = np.flatnonzero(node_demand)
+        nodes = nodes[topology.degree[nodes] > 0]
+        degree = topology.degree[nodes]
+        start = np.cumsum(degree) - degree
+        links = np.repeat(topology.indptr[nodes] - start, degree) + np.arange(degree.sum())
+        source = np.repeat(nodes, degree)
+        green = np.flatnonzero(np.where(self.east_west[links], light_ew[source], light_ns[source]))
+        links, source = links[green], source[green]
+        demand = np.repeat(node_demand[nodes] / degree, degree)[green]
+        entering = np.minimum(demand, self.space(links))
+        admitted = np.divide(entering, demand, out=np.ones_like(demand), where=demand != 0)
+        accepted = np.zeros(topology.num_nodes)
+        accepted += np.bincount(source, weights=admitted, minlength=topology.num_nodes)
+        accepted[nodes] /= degree
+        held = arriving > 0
+        sinks, arriving, absorbed = sinks[held], arriving[held], absorbed[held]
+        accepted[sinks] = (absorbed + node_demand[sinks] * accepted[sinks]) / arriving
+        leaving = exiting * accepted[targets]
+
+        # Waiting vehicles take whatever room through traffic left, on green
+        # like everyone else entering a link
+        queued = np.flatnonzero(self.waiting)
+        through = np.zeros(len(queued))
+        found = np.zeros(len(queued), dtype=bool)
+        position = np.zeros(len(queued), dtype=np.intp)
+        if len(links):
+            position = np.searchsorted(links, queued).clip(max=len(links) - 1)
+            found = links[position] == queued
+            through[found] = entering[position[found]]
+        joining = np.where(self.green(queued, light_ns, light_ew),
+                           np.minimum(self.waiting[queued], self.space(queued) - through), 0.0)
+        if len(self.trips['link']):
+            self.advance_trips(rows, density, inner, leaving, queued, joining)
+
+        density[:-1] -= inner
+        density[1:] += inner
+        density[-1] -= leaving
+        for cell, row in zip(cells, density):
+            cell[rows] = row
+        self.occupied[rows] = density.any(axis=0)
+        # Through traffic and waiting vehicles together into each first cell
+        entering[position[found]] += joining[found]
+        cells[0][links] += entering
+        cells[0][queued[~found]] += joining[~found]
+        self.occupied[links[entering != 0]] = True
+        self.occupied[queued[joining != 0]] = True
+        self.waiting[queued] -= joining
+        return float(leaving.sum())
+
+class MesoscopicEngine(SimulationEngine):
+    # Drop-in replacement for SimulationEngine that tracks link densities
+    # instead of individual vehicles. Lights, the optimizer, emergency
+    # routes, pedestrians and the stats dict are shared with the per-vehicle
+    # engine; the flow model is updated once per cell traversal time.
+    mode = 'meso'
+    track_metrics = False  # Queues live in the densities, not per vehicle
+
+    def __init__(self, *args, cells=CELLS_PER_LINK, jam_density=JAM_DENSITY,
+                 capacity=CELL_CAPACITY, **kwargs):
+        setup = kwargs.pop('setup', True)
+        super().__init__(*args, setup=False, **kwargs)
+        city = self.city
+        self.flow = CellTransmissionModel(city.topology, cells, jam_density, capacity)
+        # Occupancy queries (optimizer demand, telemetry) read the densities
+        city.vehicles = self.flow
+        self.update_interval = max(1, round(ARRIVAL_PROGRESS / city.vehicle_speed / cells))
+        self.arrivals = 0.0
+        self.travel_ticks = 0.0
+        if setup:
+            self.setup_simulation()
+
+    def advance_traffic(self):
+        city = self.city
+        city.tick += 1
+        if city.tick % self.update_interval:
+            return
+        self.travel_ticks += self.flow.total() * self.update_interval
+        self.arrivals += self.flow.update(city.light_ns, city.light_ew)
+        if len(self.flow.trips['link']):
+            self.move_trips()
+        city.stats['arrivals'] = int(round(self.arrivals))
+        city.stats['travel_ticks'] = int(round(self.travel_ticks))
+
+    def spawn_traffic(self):
+        # Same spawn rates as the per-vehicle model: each intersection adds one
+        # or two vehicles with the spawn probability, on random outgoing links
+        city = self.city
+        if self.demand is None:
+            topology = city.topology
+            rng = city.np_random
+            spawning = np.flatnonzero((rng.random(topology.num_nodes) < city.spawn_probability)
+                                      & (topology.degree > 0))
+            nodes = np.repeat(spawning, rng.integers(1, 3, len(spawning)))
+            if len(nodes):
+                self.flow.inject(city.random_links(nodes))
+                city.count_vehicles(rng.choice(len(VEHICLE_TYPES), len(nodes), p=SPAWN_TYPE_WEIGHTS))
+        city.add_random_pedestrians()
+
+    def add_trips(self, trips):
+        self.flow.add_trips(trips)
+        self.city.count_vehicles(trips['type_code'])
+
+    def move_trips(self):
+        # Trips that reached the last cell of the link into their destination
+        # leave the map, as finished vehicles do in CityGrid.complete_segments.
+        # Trips that left a link take the next one on their route, or a random
+        # one while the destination cannot be reached.
+        city = self.city
+        topology = city.topology
+        flow = self.flow
+        last = flow.density.shape[1] - 1
+        trips = flow.trips
+        finished = (trips['position'] >= last) & (topology.link_target[trips['link']] == trips['destination'])
+        if finished.any():
+            type_codes = trips['type_code'][finished]
+            flow.retire(finished)
+            city.stats['trips'] += len(type_codes)
+            city.count_vehicles(type_codes, -1)
+            trips = flow.trips
+        left = np.flatnonzero(trips['position'] >= last + 1)
+        if len(left):
+            nodes = topology.link_target[trips['link'][left]]
+            links = topology.pick_links(nodes, city.draws(ROUTE, trips['key'][left], city.tick))
+            next_links = city.router.next_links(nodes, trips['destination'][left])
+            known = next_links != NO_LINK
+            links[known] = next_links[known]
+            trips['link'][left] = links
+            trips['position'][left] -= last + 1
@@ -0,0 +1,240 @@
+import numpy as np
+
+from topology import EW
+from vehicle_store import TYPE_CODES
+
+METRICS_BUCKET = 300  # Ticks per bucket of the rolling window, five simulated seconds
+METRICS_BUCKETS = 12  # Buckets per window, one simulated minute
+TICKS_PER_MINUTE = 3600
+AMBULANCE = TYPE_CODES['ambulance']
+
+class GroupedCounts:
+    # Per-item counts kept together with their sums per group and overall, so
+    # reading any of the three costs nothing
+    def __init__(self, groups, num_groups):
+        self.groups = groups
+        self.items = np.zeros(len(groups), dtype=np.int64)
+        self.by_group = np.zeros(num_groups, dtype=np.int64)
+        self.total = 0
+
+    def add(self, items, amounts):
+        np.add.at(self.items, items, amounts)
+        np.add.at(self.by_group, self.groups[items], amounts)
+        self.total += int(amounts.sum())
+
+    def state(self):
+        return {'items': self.items, 'by_group': self.by_group, 'total': np.array(self.total)}
+
+    def load_state(self, arrays):
+        self.items[:] = arrays['items']
+        self.by_group[:] = arrays['by_group']
+        self.total = int(arrays['total'])
+
+class RollingWindow(GroupedCounts):
+    # GroupedCounts over the last `buckets` buckets of time. The buckets form
+    # a ring of per-item counts: additions go to the newest bucket and to the
+    # window sums, and rotating takes the oldest bucket out of the sums and
+    # reuses it, so the window slides without adding anything up again.
+    def __init__(self, groups, num_groups, buckets):
+        super().__init__(groups, num_groups)
+        self.ring = np.zeros((buckets, len(groups)), dtype=np.int64)
+        self.head = 0
+
+    def add(self, items, amounts):
+        super().add(items, amounts)
+        np.add.at(self.ring[self.head], items, amounts)
+
+    def add_counts(self, counts, factor):
+        # `factor` times every item of a GroupedCounts, in one step
+        items = counts.items * factor
+        by_group = counts.by_group * factor
+        self.items += items
+        self.by_group += by_group
+        self.total += counts.total * factor
+        self.ring[self.head] += items
+
+    def rotate(self):
+        # Group sums of the oldest bucket are only needed here, once per
+        # bucket, so they are not kept per addition
+        self.head = (self.head + 1) % len(self.ring)
+        oldest = self.ring[self.head]
+        self.items -= oldest
+        np.subtract.at(self.by_group, self.groups, oldest)
+        self.total -= int(oldest.sum())
+        oldest[:] = 0
+
+    def state(self):
+        return dict(super().state(), ring=self.ring, head=np.array(self.head))
+
+    def load_state(self, arrays):
+        super().load_state(arrays)
+        self.ring[:] = arrays['ring']
+        self.head = int(arrays['head'])
+
+class TrafficMetrics:
+    # Rolling measures of the traffic on every link: vehicles held at a red
+    # light, the ticks they spent held there, vehicles that completed the
+    # link, and the same red-light delay for ambulances alone. The city
+    # reports vehicles entering and leaving links and every light change,
+    # and each report only touches the links involved, so nothing here ever
+    # scans the fleet or the intersections. Vehicles wait at the
+    # intersection they are leaving, so links are grouped by approach, node
+    # * 2 + axis, the unit the signal optimizer decides on; intersection and
+    # road figures are sums over approaches and links.
+    #
+    # Waits are integrated without visiting waiting vehicles every tick: a
+    # vehicle held from tick t adds -t and one released at tick u adds u, so
+    # a finished wait counts u - t and waits still going on count up to the
+    # tick the window is read at. Bucket ends close the waits still going on
+    # in the old bucket and reopen them in the new one. Ticks given to the
+    # methods are the first tick a change affects, i.e. city.tick + 1.
+    def __init__(self, topology, bucket=METRICS_BUCKET, buckets=METRICS_BUCKETS, tick=0):
+        self.topology = topology
+        self.bucket = bucket
+        self.buckets = buckets
+        self.link_ew = topology.link_axis == EW
+        approaches = topology.link_source.astype(np.int64) * 2 + topology.link_axis
+        groups = 2 * topology.num_nodes
+        self.occupancy = GroupedCounts(approaches, groups)  # Vehicles on each link
+        self.queued = GroupedCounts(approaches, groups)  # Of those, held by a red light
+        self.emergency_queued = GroupedCounts(approaches, groups)
+        self.ambulances = np.zeros(topology.num_links, dtype=np.int64)  # Ambulances on each link
+        self.red = np.ones(topology.num_links, dtype=bool)  # Lights start red
+        self.served = RollingWindow(approaches, groups, buckets)  # Vehicles that completed the link
+        self.wait = RollingWindow(approaches, groups, buckets)  # Vehicle ticks held at red
+        self.emergency_wait = RollingWindow(approaches, groups, buckets)  # Ambulance ticks held at red
+        self.origin = tick
+        self.boundary = tick + bucket  # Where the newest bucket ends
+
+    def advance(self, tick):
+        # Rotate past every bucket that ended by `tick`
+        while tick >= self.boundary:
+            for window, level in ((self.wait, self.queued), (self.emergency_wait, self.emergency_queued)):
+                window.add_counts(level, self.boundary)
+                window.rotate()
+                window.add_counts(level, -self.boundary)
+            self.served.rotate()
+            self.boundary += self.bucket
+
+    def enter(self, links, type_codes, tick):
+        # Vehicles starting on links, spawned or turning
+        self.advance(tick)
+        ones = np.ones(len(links), dtype=np.int64)
+        ambulance = type_codes == AMBULANCE
+        self.occupancy.add(links, ones)
+        if ambulance.any():
+            np.add.at(self.ambulances, links[ambulance], 1)
+        held = self.red[links]
+        self._hold(links[held], ones[held], ambulance[held].astype(np.int64), tick)
+
+    def leave(self, links, type_codes, tick, completed=True):
+        # Vehicles leaving links, at the end of the link or taken off the map
+        self.advance(tick)
+        ones = np.ones(len(links), dtype=np.int64)
+        ambulance = type_codes == AMBULANCE
+        self.occupancy.add(links, -ones)
+        if ambulance.any():
+            np.subtract.at(self.ambulances, links[ambulance], 1)
+        if completed:
+            self.served.add(links, ones)
+        held = self.red[links]
+        self._hold(links[held], -ones[held], -ambulance[held].astype(np.int64), tick)
+
+    def set_lights(self, light_ns, light_ew, tick):
+        # Every vehicle on a link that turns red is held from `tick` on, and
+        # every vehicle on one that turns green is released
+        self.advance(tick)
+        source = self.topology.link_source
+        red = ~np.where(self.link_ew, light_ew[source], light_ns[source])
+        changed = np.flatnonzero(red != self.red)
+        if not len(changed):
+            return
+        self.red[changed] = red[changed]
+        sign = np.where(red[changed], 1, -1)
+        self._hold(changed, sign * self.occupancy.items[changed], sign * self.ambulances[changed], tick)
+
+    def _hold(self, links, vehicles, ambulances, tick):
+        # `vehicles` more vehicles held on each link from `tick` on, fewer
+        # when negative, `ambulances` of them ambulances
+        if not len(links):
+            return
+        self.queued.add(links, vehicles)
+        self.wait.add(links, vehicles * -tick)
+        some = ambulances != 0
+        if some.any():
+            links, ambulances = links[some], ambulances[some]
+            self.emergency_queued.add(links, ambulances)
+            self.emergency_wait.add(links, ambulances * -tick)
+
+    def window_ticks(self, tick):
+        # Ticks covered by the window when read at `tick`
+        self.advance(tick)
+        return tick - max(self.origin, self.boundary - self.bucket * self.buckets)
+
+    def approach_counts(self):
+        # Vehicles on the links leaving every node, (nodes, 2) by axis
+        return self.occupancy.by_group.reshape(-1, 2)
+
+    def summary(self, tick):
+        # City totals over the window: vehicles held at red now and on
+        # average, ticks waited at red per vehicle served, vehicles served
+        # per simulated minute, and ambulance ticks lost at red lights
+        return self._figures(*self._sums('total'), tick)
+
+    def approach(self, node, axis, tick):
+        # The same figures for one approach; lookups, not sums
+        group = 2 * node + axis
+        return self._figures(*[int(values[group]) for values in self._sums('by_group')], tick)
+
+    # The figures as arrays, mean_wait being NaN where nothing was served
+    def per_approach(self, tick):
+        return self._figures(*self._sums('by_group'), tick)
+
+    def per_node(self, tick):
+        return self._figures(*[values.reshape(-1, 2).sum(axis=1) for values in self._sums('by_group')], tick)
+
+    def per_link(self, tick):
+        return self._figures(*self._sums('items'), tick)
+
+    def per_edge(self, tick):
+        # Both directions of every road
+        topology = self.topology
+        return self._figures(*[np.bincount(topology.link_edge, weights=values, minlength=topology.num_edges)
+                               for values in self._sums('items')], tick)
+
+    def _sums(self, part):
+        return [getattr(counts, part) for counts in (self.queued, self.wait, self.served,
+                                                     self.emergency_queued, self.emergency_wait)]
+
+    def _figures(self, queued, wait, served, emergency_queued, emergency_wait, tick):
+        span = self.window_ticks(tick)
+        wait = wait + queued * tick
+        if np.ndim(served):
+            with np.errstate(divide='ignore', invalid='ignore'):
+                mean_wait = np.where(served > 0, wait / served, np.nan)
+        else:
+            mean_wait = wait / served if served else None
+        return {
+            'queued': queued,
+            'mean_queue': wait / span if span else wait * 0.0,
+            'mean_wait': mean_wait,
+            'throughput_per_min': served * TICKS_PER_MINUTE / span if span else served * 0.0,
+            'emergency_delay': emergency_wait + emergency_queued * tick,
+        }
+
+    def state(self):
+        arrays = {'ambulances': self.ambulances, 'red': self.red,
+                  'clock': np.array([self.origin, self.boundary])}
+        for name in ('occupancy', 'queued', 'emergency_queued', 'served', 'wait', 'emergency_wait'):
+            for key, array in getattr(self, name).state().items():
+                arrays[f'{name}.{key}'] = array
+        return arrays
+
+    def load_state(self, arrays):
+        self.ambulances[:] = arrays['ambulances']
+        self.red[:] = arrays['red']
+        self.origin, self.boundary = arrays['clock'].tolist()
+        for name in ('occupancy', 'queued', 'emergency_queued', 'served', 'wait', 'emergency_wait'):
+            prefix = f'{name}.'
+            getattr(self, name).load_state({key[len(prefix):]: array for key, array in arrays.items()
+                                            if key.startswith(prefix)})
@@ -0,0 +1,203 @@
+import cProfile
+import time
+from functools import wraps
+
+import numpy as np
+
+PROFILE_WINDOW = 600  # Frames kept per phase, ten seconds at 60 FPS
+
+# (engine attribute, method, phase) timed inside SimulationEngine.step, None
+# standing for the engine itself; attributes an engine does not have are
+# skipped
+ENGINE_PHASES = (
+    ('city', 'update_traffic_lights', 'lights'),
+    ('optimizer', 'optimize_lights', 'optimize'),
+    ('city', 'update_emergency_vehicle', 'emergency'),
+    ('city', 'update_vehicle_positions', 'vehicles'),
+    ('city', 'add_random_vehicles', 'spawn'),
+    ('city', 'add_random_pedestrians', 'pedestrians'),
+    ('flow', 'update', 'vehicles'),  # Mesoscopic engine
+    ('flow', 'inject', 'spawn'),
+    (None, 'move_arrivals', 'vehicles'),  # Event engine
+    (None, 'advance_shards', 'vehicles'),  # Sharded engine, timed from the coordinator
+    (None, 'solve_lights', 'optimize'),
+    (None, 'exchange', 'exchange'),
+)
+# Methods of Simulation timed while drawing a frame
+DRAW_PHASES = (
+    ('draw', 'draw'),
+    ('draw_emergency_route', 'route'),
+    ('draw_details', 'details'),
+    ('draw_heatmap', 'heatmap'),
+    ('draw_stats_panel', 'stats_panel'),
+)
+
+class PhaseTimer:
+    # Durations of the last `window` calls of one phase, with the frame each
+    # call happened in
+    def __init__(self, window=PROFILE_WINDOW):
+        self.durations = np.zeros(window)
+        self.frames = np.full(window, -1, dtype=np.int64)
+        self.calls = 0
+
+    def add(self, frame, duration):
+        slot = self.calls % len(self.durations)
+        self.durations[slot] = duration
+        self.frames[slot] = frame
+        self.calls += 1
+
+    def recent(self):
+        held = min(self.calls, len(self.durations))
+        return self.durations[:held], self.frames[:held]
+
+class Profiler:
+    # Times each phase of a tick and of a frame by wrapping the methods on the
+    # instances it is attached to. Nothing is wrapped until attach() is called
+    # and detach() restores the plain methods, so an unprofiled run pays nothing.
+    def __init__(self, window=PROFILE_WINDOW):
+        self.window = window
+        self.timers = {}
+        self.frame = 0  # Engine ticks seen since attaching
+        self.display_frame = 0  # Frames drawn since attaching
+        self.display_phases = set()  # Phases counted per drawn frame, not per tick
+        self.patched = []
+        self.trace = None
+        self.trace_path = None
+        self.trace_ticks = 0
+
+    def timer(self, phase):
+        if phase not in self.timers:
+            self.timers[phase] = PhaseTimer(self.window)
+        return self.timers[phase]
+
+    def wrap(self, owner, attribute, phase, display=False):
+        method = getattr(owner, attribute)
+        timer = self.timer(phase)
+        clock = time.perf_counter
+        if display:
+            self.display_phases.add(phase)
+
+        @wraps(method)
+        def timed(*args, **kwargs):
+            start = clock()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                timer.add(self.display_frame if display else self.frame, clock() - start)
+
+        setattr(owner, attribute, timed)
+        self.patched.append((owner, attribute))
+
+    def attach(self, engine):
+        for owner, attribute, phase in ENGINE_PHASES:
+            target = engine if owner is None else getattr(engine, owner, None)
+            if target is not None and hasattr(target, attribute):
+                self.wrap(target, attribute, phase)
+        if engine.reports_ticks:
+            return self
+
+        # The step wrapper also counts frames and drives the cProfile trace
+        step = engine.step
+
+        @wraps(step)
+        def timed_step():
+            self.time_ticks(1, step)
+
+        engine.step = timed_step
+        self.patched.append((engine, 'step'))
+        return self
+
+    def time_ticks(self, ticks, work, *args):
+        # `work` takes the engine through the next `ticks` ticks; it is timed
+        # as the update phase of the last of them. Engines whose run() does
+        # not go through step() report their ticks here themselves.
+        self.frame += ticks
+        start = time.perf_counter()
+        work(*args)
+        self.timer('update').add(self.frame, time.perf_counter() - start)
+        if self.trace is not None:
+            self.trace_ticks -= ticks
+            if self.trace_ticks <= 0:
+                self.stop_trace()
+
+    def attach_simulation(self, simulation):
+        for attribute, phase in DRAW_PHASES:
+            self.wrap(simulation, attribute, phase, display=True)
+
+        # Frames are counted apart from ticks: the engine steps on its own
+        # thread, any number of ticks per frame depending on the speed
+        draw = simulation.draw
+
+        @wraps(draw)
+        def counted_draw():
+            self.display_frame += 1
+            return draw()
+
+        simulation.draw = counted_draw
+        self.patched.append((simulation, 'draw'))
+        return self
+
+    def detach(self):
+        # Drop the wrappers so the instances use their class methods again
+        for owner, attribute in self.patched:
+            vars(owner).pop(attribute, None)
+        self.patched = []
+
+    def start_trace(self, path, ticks):
+        # Record a cProfile trace of the next `ticks` engine ticks to `path`.
+        # The .prof file opens in pstats, snakeviz or flameprof.
+        if self.trace is not None:
+            self.stop_trace()
+        self.trace_path = path
+        self.trace_ticks = ticks
+        self.trace = cProfile.Profile()
+        self.trace.enable()
+
+    def stop_trace(self):
+        if self.trace is None:
+            return None
+        self.trace.disable()
+        self.trace.dump_stats(self.trace_path)
+        self.trace = None
+        return self.trace_path
+
+    def per_frame(self):
+        # Milliseconds each phase took per frame, averaged over the window:
+        # per drawn frame for the drawing phases, per tick for the engine's
+        result = {}
+        for phase, timer in self.timers.items():
+            count = self.display_frame if phase in self.display_phases else self.frame
+            frames = min(count, self.window)
+            durations, call_frames = timer.recent()
+            if len(durations):
+                in_window = durations[call_frames > count - self.window]
+                result[phase] = float(in_window.sum() * 1000 / frames) if frames else 0.0
+        return result
+
+    def summary(self):
+        # Per-phase timings over the rolling window, in milliseconds
+        result = {}
+        for phase, ms_per_frame in self.per_frame().items():
+            timer = self.timers[phase]
+            durations, _ = timer.recent()
+            result[phase] = {
+                'calls': timer.calls,
+                'mean_ms': float(durations.mean() * 1000),
+                'p50_ms': float(np.percentile(durations, 50) * 1000),
+                'p99_ms': float(np.percentile(durations, 99) * 1000),
+                'max_ms': float(durations.max() * 1000),
+                'ms_per_frame': ms_per_frame,
+            }
+        return result
+
+    def histogram(self, phase, bins=20):
+        # (counts, bin edges in ms) of the phase's recent durations
+        durations, _ = self.timer(phase).recent()
+        return np.histogram(durations * 1000, bins=bins)
+
+    def report(self):
+        lines = [f"{'phase':<12} {'calls':>8} {'ms/frame':>9} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}"]
+        for phase, entry in sorted(self.summary().items(), key=lambda item: -item[1]['ms_per_frame']):
+            lines.append(f"{phase:<12} {entry['calls']:>8} {entry['ms_per_frame']:>9.3f} "
+                         f"{entry['p50_ms']:>8.3f} {entry['p99_ms']:>8.3f} {entry['max_ms']:>8.3f}")
+        return "\n".join(lines)
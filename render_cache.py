@@ -0,0 +1,46 @@
+from collections import OrderedDict
+
+GLYPH_CACHE_SIZE = 1024
+
+class GlyphCache:
+    # Rendered text surfaces keyed by font, text and colour with LRU eviction,
+    # so icons, labels and stat values are rasterized once instead of per frame
+    def __init__(self, maxsize=GLYPH_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.surfaces = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, font, text, color):
+        key = (font, text, color)
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.surfaces.move_to_end(key)
+            self.hits += 1
+            return surface
+        self.misses += 1
+        surface = font.render(text, True, color)
+        self.surfaces[key] = surface
+        if len(self.surfaces) > self.maxsize:
+            self.surfaces.popitem(last=False)
+        return surface
+
+    def clear(self):
+        self.surfaces.clear()
+
+class CachedLayer:
+    # A surface that is only redrawn when its key changes, e.g. the background
+    # is keyed by topology and emergency route
+    def __init__(self, build):
+        self.build = build
+        self.key = None
+        self.surface = None
+
+    def get(self, key):
+        if self.surface is None or key != self.key:
+            self.surface = self.build()
+            self.key = key
+        return self.surface
+
+    def invalidate(self):
+        self.surface = None
@@ -0,0 +1,176 @@
+import queue
+import threading
+import time
+
+import numpy as np
+
+from traffic_signal import FPS
+from vehicle_store import ARRIVAL_PROGRESS
+
+SIMULATION_SPEEDS = (0.25, 0.5, 1, 2, 4, 8, 16, 32, 64)  # Multiples of real time, UP/DOWN in the GUI
+
+class FrameSnapshot:
+    # Everything a frame draws, copied from the city between two ticks.
+    # Snapshots are never changed once made, so the renderer reads them
+    # without locks while the simulation carries on. Topology and
+    # intersection names are never modified in place and are shared, not
+    # copied. Vehicles are listed by handle, which stays the same for as long
+    # as the vehicle is on the map, so consecutive snapshots can be matched.
+    # They are also indexed by link, as in VehicleIndex, so a frame finds the
+    # vehicles and counts of the roads in view without scanning the city.
+    __slots__ = ('time', 'stamp', 'topology', 'intersections', 'light_ns', 'light_ew', 'pedestrians',
+                 'stats', 'metrics', 'emergency_route', 'emergency_vehicle_pos', 'handles', 'type_code',
+                 'current', 'next', 'link', 'progress', 'link_count', 'by_link', 'sorted_links')
+
+    def __init__(self, engine, stamp):
+        city = engine.city
+        self.time = engine.time
+        self.stamp = stamp  # perf_counter() when published
+        self.topology = city.topology
+        self.intersections = city.intersections
+        self.light_ns = city.light_ns.copy()
+        self.light_ew = city.light_ew.copy()
+        self.pedestrians = dict(city.pedestrians)
+        self.stats = dict(city.stats, active_signals=list(city.stats['active_signals']))
+        # City totals of the rolling traffic metrics, read off running sums
+        self.metrics = None if city.metrics is None else city.metrics.summary(city.tick + 1)
+        self.emergency_route = tuple(city.emergency_route)
+        self.emergency_vehicle_pos = city.emergency_vehicle_pos
+        fleet = city.fleet
+        ids = fleet.live_ids()
+        handles = fleet.handles(ids)
+        order = np.argsort(handles)
+        ids = ids[order]
+        self.handles = handles[order]
+        self.type_code = fleet.type_code[ids]
+        self.current = fleet.current[ids]
+        self.next = fleet.next[ids]
+        self.link = fleet.link[ids]
+        self.progress = fleet.progress[ids]
+        self.link_count = city.vehicles.link_count.copy()
+        # Vehicles (indices into the arrays above) grouped by link, with the
+        # link of each entry
+        self.by_link = np.argsort(self.link)
+        self.sorted_links = self.link[self.by_link]
+
+    def vehicle_progress(self, previous=None, alpha=1.0, vehicles=slice(None)):
+        # Progress of the vehicles (all, or the given indices) `alpha` of the
+        # way from `previous` to this snapshot. A vehicle still on the same
+        # link slides along it, one that turned since starts from the
+        # intersection it turned at, and one that was not there yet shows
+        # where it is now.
+        progress = self.progress[vehicles]
+        if previous is None or alpha >= 1 or not len(previous.handles) or not len(progress):
+            return progress
+        handles = self.handles[vehicles]
+        found = np.minimum(np.searchsorted(previous.handles, handles), len(previous.handles) - 1)
+        known = previous.handles[found] == handles
+        start = np.where(previous.link[found] == self.link[vehicles], previous.progress[found], 0.0)
+        start = np.where(known, start, progress)
+        return start + (progress - start) * alpha
+
+    def vehicle_positions(self, positions, previous=None, alpha=1.0, vehicles=slice(None)):
+        # Position of the vehicles along their links; positions is a
+        # (nodes, 2) array of node positions
+        share = (self.vehicle_progress(previous, alpha, vehicles) / ARRIVAL_PROGRESS)[:, None]
+        start = positions[self.current[vehicles]]
+        return start + (positions[self.next[vehicles]] - start) * share
+
+    def on_links(self, links):
+        # Indices of the vehicles on the given links, ascending
+        starts = np.searchsorted(self.sorted_links, links)
+        counts = np.searchsorted(self.sorted_links, links, side='right') - starts
+        vehicles = self.by_link[np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())]
+        return np.sort(vehicles)
+
+    def edge_counts(self, edges):
+        # Vehicles on the given roads, both directions
+        return self.link_count[self.topology.edge_links[edges]].sum(axis=1)
+
+    def emergency_position(self, previous=None, alpha=1.0):
+        position = self.emergency_vehicle_pos
+        if previous is not None and previous.emergency_route == self.emergency_route:
+            position = previous.emergency_vehicle_pos + (position - previous.emergency_vehicle_pos) * alpha
+        return position
+
+class SimulationLoop:
+    # Steps an engine on its own thread at `speed` times real time and
+    # publishes a FrameSnapshot once per display frame in which ticks ran.
+    # The two latest snapshots are a double buffer: publishing swaps a new
+    # one in under a lock and the renderer interpolates between the pair, so
+    # the display stays smooth however many ticks run per frame, or however
+    # few. A loop that cannot keep up runs slower than asked instead of
+    # piling up ticks. Anything that touches the engine while the loop runs
+    # goes through call(), which runs it on the simulation thread between
+    # two ticks.
+    def __init__(self, engine, speed=1, frame_rate=FPS):
+        self.engine = engine
+        self.speed = speed
+        self.frame_interval = 1 / frame_rate
+        self.paused = False
+        self.error = None  # Exception that stopped the thread
+        self.ticks = 0
+        self.commands = queue.SimpleQueue()
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.previous = self.current = FrameSnapshot(engine, time.perf_counter())
+        self.thread = threading.Thread(target=self.run, name='simulation', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def call(self, function, *args):
+        self.commands.put((function, args))
+
+    def latest(self):
+        # (previous, current) snapshots and how far the display is between
+        # them: the renderer trails the simulation by one publish interval
+        with self.lock:
+            previous, current = self.previous, self.current
+        interval = current.stamp - previous.stamp
+        alpha = (time.perf_counter() - current.stamp) / interval if interval > 0 else 1.0
+        return previous, current, min(max(alpha, 0.0), 1.0)
+
+    def publish(self):
+        snapshot = FrameSnapshot(self.engine, time.perf_counter())
+        with self.lock:
+            self.previous, self.current = self.current, snapshot
+
+    def run(self):
+        try:
+            self.loop()
+        except BaseException as error:
+            self.error = error
+
+    def loop(self):
+        clock = time.perf_counter
+        owed = 0.0  # Ticks due but not run yet
+        next_frame = clock()
+        while not self.stopping.is_set():
+            while not self.commands.empty():
+                function, args = self.commands.get()
+                function(*args)
+            next_frame += self.frame_interval
+            if not self.paused:
+                per_frame = self.speed * FPS * self.frame_interval
+                owed += per_frame
+                stepped = 0
+                while owed >= 1 and (not stepped or clock() < next_frame):
+                    self.engine.step()
+                    owed -= 1
+                    stepped += 1
+                owed = min(owed, max(per_frame, 1))
+                self.ticks += stepped
+                if stepped:
+                    self.publish()
+            delay = next_frame - clock()
+            if delay > 0:
+                self.stopping.wait(delay)
+            else:
+                next_frame = clock()
@@ -0,0 +1,191 @@
+import argparse
+import csv
+import json
+import math
+import os
+import time
+
+import numpy as np
+
+from section_file import read_sections, write_sections
+from topology import RoadTopology
+
+# Compact binary road network: the topology arrays in the section file layout
+# (see section_file), memory-mapped on load so large networks start without
+# parsing or building per-road Python objects
+MAGIC = b'TRAFGRPH'
+VERSION = 1
+EARTH_RADIUS = 6371008.8  # Metres
+COORDINATE_DIGITS = 7  # GeoJSON line ends closer than ~1 cm are one intersection
+DEFAULT_LANES = 1
+
+class NetworkError(ValueError):
+    pass
+
+def project(lon, lat):
+    # Equirectangular projection to metres around the network's centre;
+    # y grows south like screen and grid rows
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    lon0, lat0 = lon.mean(), lat.mean()
+    x = np.radians(lon - lon0) * math.cos(math.radians(lat0)) * EARTH_RADIUS
+    y = -np.radians(lat - lat0) * EARTH_RADIUS
+    return np.stack([x, y], axis=-1)
+
+def build_topology(names, node_xy, edges, edge_length=None, edge_lanes=None):
+    # Every edge becomes a two-way road; self loops and repeated roads
+    # between the same two intersections are dropped (the first one is kept)
+    edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+    keep = edges[:, 0] != edges[:, 1]
+    pairs = np.sort(edges, axis=1)
+    _, first = np.unique(pairs, axis=0, return_index=True)
+    unique = np.zeros(len(edges), dtype=bool)
+    unique[first] = True
+    keep &= unique
+    if edge_length is not None:
+        edge_length = np.asarray(edge_length, dtype=np.float64)[keep]
+    if edge_lanes is not None:
+        edge_lanes = np.clip(np.asarray(edge_lanes), 1, np.iinfo(np.int8).max)[keep]
+    return RoadTopology(names, node_xy, edges[keep], edge_length, edge_lanes)
+
+def read_csv(path):
+    # Edge list with columns source, target, source_x, source_y, target_x,
+    # target_y and optionally length and lanes. Node ids become the names of
+    # the intersections; y grows north as on a map.
+    index = {}
+    xy = []
+    edges = []
+    lengths = []
+    lanes = []
+    with open(path, newline='') as f:
+        reader = csv.DictReader(f)
+        missing = {'source', 'target', 'source_x', 'source_y', 'target_x', 'target_y'} - set(reader.fieldnames or ())
+        if missing:
+            raise NetworkError(f"{path} lacks the column(s) {', '.join(sorted(missing))}")
+        for row in reader:
+            ends = []
+            for end in ('source', 'target'):
+                name = row[end]
+                if name not in index:
+                    index[name] = len(xy)
+                    xy.append((float(row[f'{end}_x']), -float(row[f'{end}_y'])))
+                ends.append(index[name])
+            edges.append(ends)
+            lengths.append(float(row['length']) if row.get('length') else math.nan)
+            lanes.append(int(row['lanes']) if row.get('lanes') else DEFAULT_LANES)
+    node_xy = np.array(xy, dtype=np.float64).reshape(-1, 2)
+    edges = np.array(edges, dtype=np.int64).reshape(-1, 2)
+    lengths = np.array(lengths)
+    straight = np.linalg.norm(node_xy[edges[:, 1]] - node_xy[edges[:, 0]], axis=1)
+    lengths = np.where(np.isnan(lengths), straight, lengths)
+    return build_topology(list(index), node_xy, edges, lengths, lanes)
+
+def _lines(geometry):
+    if geometry is None:
+        return []
+    if geometry['type'] == 'LineString':
+        return [geometry['coordinates']]
+    if geometry['type'] == 'MultiLineString':
+        return geometry['coordinates']
+    return []
+
+def read_geojson(path):
+    # LineString or MultiLineString features; the two ends of every line are
+    # intersections (ends at the same coordinates are merged) and the shape
+    # in between only counts towards the road length. Optional properties:
+    # length in metres and lanes. Intersections are named I1..In.
+    with open(path) as f:
+        data = json.load(f)
+    features = data['features'] if data.get('type') == 'FeatureCollection' else [data]
+    index = {}
+    ends = []
+    lanes = []
+    shapes = []
+    given = []
+    for feature in features:
+        properties = feature.get('properties') or {}
+        for line in _lines(feature.get('geometry')):
+            if len(line) < 2:
+                continue
+            pair = []
+            for lon, lat, *_ in (line[0], line[-1]):
+                key = (round(lon, COORDINATE_DIGITS), round(lat, COORDINATE_DIGITS))
+                if key not in index:
+                    index[key] = len(index)
+                pair.append(index[key])
+            ends.append(pair)
+            shapes.append(line)
+            lanes.append(int(properties.get('lanes') or DEFAULT_LANES))
+            given.append(float(properties['length']) if properties.get('length') else math.nan)
+    if not index:
+        raise NetworkError(f"{path} has no LineString features")
+
+    coordinates = np.array(list(index), dtype=np.float64)
+    lon0, lat0 = coordinates.mean(axis=0)
+    node_xy = project(coordinates[:, 0], coordinates[:, 1])
+    # Length along each line's shape, in the same projection
+    lengths = np.array(given)
+    for i in np.flatnonzero(np.isnan(lengths)).tolist():
+        points = np.array([point[:2] for point in shapes[i]], dtype=np.float64)
+        x = np.radians(points[:, 0] - lon0) * math.cos(math.radians(lat0)) * EARTH_RADIUS
+        y = np.radians(points[:, 1] - lat0) * EARTH_RADIUS
+        lengths[i] = np.hypot(np.diff(x), np.diff(y)).sum()
+    names = [f'I{i+1}' for i in range(len(index))]
+    return build_topology(names, node_xy, ends, lengths, lanes)
+
+def import_network(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension in ('.geojson', '.json'):
+        return read_geojson(path)
+    if extension == '.csv':
+        return read_csv(path)
+    raise NetworkError(f"Unknown road network format: {path}")
+
+def save_network(topology, path):
+    arrays = topology.arrays()
+    grid_names = topology.names == [f'I{i+1}' for i in range(topology.num_nodes)]
+    if not grid_names:
+        # Names as one NUL-separated UTF-8 blob
+        arrays['names'] = np.frombuffer('\0'.join(topology.names).encode(), dtype=np.uint8)
+    meta = {'nodes': topology.num_nodes, 'roads': topology.num_edges, 'grid_names': grid_names}
+    write_sections(path, MAGIC, VERSION, meta, arrays)
+
+def load_network(path, mmap=True):
+    # Topology from a road network file, memory-mapped by default; GeoJSON
+    # and CSV edge lists are imported on the fly
+    with open(path, 'rb') as f:
+        binary = f.read(len(MAGIC)) == MAGIC
+    if not binary:
+        topology = import_network(path)
+        topology.path = path
+        return topology
+    meta, arrays = read_sections(path, MAGIC, VERSION, "road network", NetworkError, mmap)
+    if meta['grid_names']:
+        names = [f'I{i+1}' for i in range(meta['nodes'])]
+    else:
+        names = arrays.pop('names').tobytes().decode().split('\0')
+    return RoadTopology.from_arrays(names, arrays, path)
+
+def make_topology(network):
+    # A square grid of the given size, a topology, or a road network file
+    if isinstance(network, RoadTopology):
+        return network
+    if isinstance(network, (str, os.PathLike)):
+        return load_network(os.fspath(network))
+    return RoadTopology.grid(network)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert a GeoJSON or CSV edge list into a road network file")
+    parser.add_argument('source', help="GeoJSON (.geojson/.json) or CSV edge list (.csv)")
+    parser.add_argument('output', help="road network file to write (.graph)")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    topology = import_network(args.source)
+    save_network(topology, args.output)
+    print(f"{topology.num_nodes} intersections, {topology.num_edges} roads "
+          f"({topology.edge_length.sum() / 1000:.1f} km) written to {args.output} "
+          f"in {time.perf_counter() - start:.2f}s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+from collections import OrderedDict
+
+import numpy as np
+
+NO_LINK = -1
+ROUTE_CACHE_BYTES = 256 << 20  # Memory for cached trees; at least MIN_TREES are kept
+MIN_TREES = 16
+BUILD_BYTES = 64 << 20  # Scratch memory for building trees together
+CONGESTION_WEIGHT = 0.1  # Extra cost per vehicle and lane, relative to the free-flow cost
+COST_THRESHOLD = 0.25  # Relative cost change that counts as a change
+# Weight of the latest link counts in the moving average costs follow, so
+# queues that come and go with the lights do not reroute everyone
+LOAD_SMOOTHING = 0.2
+# Load samples per cost refresh; trees stay valid between refreshes
+SAMPLES_PER_REFRESH = 6
+
+class RouteCache:
+    # Shortest-path trees towards destinations, shared by every vehicle
+    # heading for the same one. A tree is two arrays over the nodes: the cost
+    # to the destination and the link to take next (NO_LINK at the
+    # destination and where it cannot be reached), so routing a vehicle is
+    # one lookup. Trees are built on first use and the least recently used
+    # ones are evicted.
+    #
+    # Link costs are the free-flow road length scaled up with the average
+    # vehicles per lane on the link; update_costs() only takes over links
+    # whose cost moved by more than the threshold and repairs or drops the
+    # cached trees they affect. Next links are picked from the final costs
+    # alone, the lowest link id winning ties, so a kept tree is exactly what
+    # a rebuild would give and routes never depend on which trees were
+    # cached.
+    def __init__(self, topology, cache_bytes=ROUTE_CACHE_BYTES, threshold=COST_THRESHOLD):
+        self.topology = topology
+        self.threshold = threshold
+        self.free_flow = topology.link_length.astype(np.float64)
+        self.cost = self.free_flow.copy()
+        self.load = np.zeros(topology.num_links)  # Moving average of vehicles per link
+        self.samples = 0
+        tree_bytes = max(topology.num_nodes, 1) * 12
+        self.capacity = max(MIN_TREES, cache_bytes // tree_bytes)
+        # Building a tree takes a float and a slot per node and a float per link
+        self.batch = max(1, BUILD_BYTES // (12 * topology.num_nodes + 8 * topology.num_links or 1))
+        self.trees = OrderedDict()
+        # Links arriving at each node, for searching backwards from a destination
+        self.in_links = np.argsort(topology.link_target, kind='stable')
+        self.in_indptr = np.zeros(topology.num_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(topology.link_target, minlength=topology.num_nodes), out=self.in_indptr[1:])
+        self.built = 0  # Trees built, including rebuilds after invalidation
+        self.invalidated = 0
+
+    def tree(self, destination):
+        trees = self.trees
+        tree = trees.get(destination)
+        if tree is None:
+            tree = self.build_many([destination])[0]
+            self.insert(destination, tree)
+        else:
+            trees.move_to_end(destination)
+        return tree
+
+    def insert(self, destination, tree):
+        self.trees[destination] = tree
+        self.built += 1
+        if len(self.trees) > self.capacity:
+            self.trees.popitem(last=False)
+
+    def prefetch(self, destinations):
+        # Build the missing trees, a batch at a time; no more than the cache
+        # holds, or the first would be evicted before they are used
+        missing = [destination for destination in destinations if destination not in self.trees]
+        missing = missing[:self.capacity]
+        for start in range(0, len(missing), self.batch):
+            chunk = missing[start:start + self.batch]
+            for destination, tree in zip(chunk, self.build_many(chunk)):
+                self.insert(destination, tree)
+
+    def build_many(self, destinations):
+        # Label-correcting search backwards from the destinations, one
+        # vectorized relaxation of the links into the frontier per round.
+        # The trees of all destinations are searched together, node n of
+        # tree k at k * num_nodes + n.
+        topology = self.topology
+        num_nodes = topology.num_nodes
+        cost = self.cost
+        in_indptr = self.in_indptr
+        destinations = np.asarray(destinations, dtype=np.int64)
+        dist = np.full(len(destinations) * num_nodes, np.inf)
+        frontier = np.arange(len(destinations)) * num_nodes + destinations
+        dist[frontier] = 0.0
+        slot = np.empty(len(dist), dtype=np.int32)
+        while len(frontier):
+            tree, node = np.divmod(frontier, num_nodes)
+            starts = in_indptr[node]
+            counts = in_indptr[node + 1] - starts
+            offsets = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+            links = self.in_links[offsets]
+            candidate = np.repeat(dist[frontier], counts) + cost[links]
+            sources = np.repeat(tree * num_nodes, counts) + topology.link_source[links]
+            better = candidate < dist[sources]
+            candidate, sources = candidate[better], sources[better]
+            np.minimum.at(dist, sources, candidate)
+            # Every improved node once: the last entry written for it wins
+            entries = np.arange(len(sources), dtype=np.int32)
+            slot[sources] = entries
+            frontier = sources[slot[sources] == entries]
+        dist = dist.reshape(len(destinations), num_nodes)
+        next_link = self.next_links_from(dist, destinations)
+        return [(dist[i].copy(), next_link[i].copy()) for i in range(len(destinations))]
+
+    def next_links_from(self, dist, destinations):
+        # Lowest-id link of every node whose cost plus the cost beyond it is
+        # the node's cost to the destination, for every row of dist
+        topology = self.topology
+        num_nodes = topology.num_nodes
+        through = self.cost + dist[:, topology.link_target]
+        on_path = (through == dist[:, topology.link_source]) & np.isfinite(through)
+        tree, links = np.nonzero(on_path)
+        sources = tree * num_nodes + topology.link_source[links]
+        first = np.ones(len(links), dtype=bool)
+        first[1:] = sources[1:] != sources[:-1]
+        next_link = np.full(dist.shape, NO_LINK, dtype=np.int32)
+        next_link.reshape(-1)[sources[first]] = links[first]
+        next_link[np.arange(len(destinations)), destinations] = NO_LINK
+        return next_link
+
+    def next_links(self, nodes, destinations):
+        # Link to take next from each node towards the matching destination
+        links = np.empty(len(nodes), dtype=np.int64)
+        order = np.argsort(destinations, kind='stable')
+        targets, starts = np.unique(destinations[order], return_index=True)
+        targets = targets.tolist()
+        self.prefetch(targets)
+        for destination, group in zip(targets, np.split(order, starts[1:])):
+            links[group] = self.tree(destination)[1][nodes[group]]
+        return links
+
+    def route(self, start, end):
+        # Nodes from start to end, or [] when end cannot be reached
+        next_link = self.tree(end)[1]
+        target = self.topology.link_target
+        route = [start]
+        while route[-1] != end:
+            link = next_link[route[-1]]
+            if link == NO_LINK:
+                return []
+            route.append(int(target[link]))
+        return route
+
+    def update_costs(self, link_count):
+        # Samples the vehicles on each link; every SAMPLES_PER_REFRESH
+        # samples the congestion-weighted costs are refreshed. Only links
+        # whose cost moved beyond the threshold change, and a cached
+        # tree stays exact as long as every node those links leave keeps its
+        # cost to the destination: then all other nodes keep theirs too and
+        # only the next link of those nodes is picked again. Trees where one
+        # of them gets closer or further are dropped.
+        topology = self.topology
+        self.load += LOAD_SMOOTHING * (link_count - self.load)
+        self.samples += 1
+        if self.samples % SAMPLES_PER_REFRESH:
+            return 0
+        new = self.free_flow * (1 + CONGESTION_WEIGHT * self.load / topology.link_lanes)
+        changed = np.flatnonzero(np.abs(new - self.cost) > self.threshold * self.cost)
+        if not len(changed):
+            return 0
+        self.cost[changed] = new[changed]
+        # All links leaving the nodes a changed link leaves
+        sources = np.unique(topology.link_source[changed])
+        starts = topology.indptr[sources]
+        counts = topology.degree[sources]
+        heads = np.cumsum(counts) - counts
+        links = np.repeat(starts - heads, counts) + np.arange(counts.sum())
+        segment = np.repeat(np.arange(len(sources)), counts)
+        cost, targets = self.cost[links], topology.link_target[links]
+        stale = []
+        for destination, (dist, next_link) in self.trees.items():
+            through = cost + dist[targets]
+            best = np.minimum.reduceat(through, heads)
+            if not ((best == dist[sources]) | (sources == destination)).all():
+                stale.append(destination)
+                continue
+            tight = np.flatnonzero((through == best[segment]) & np.isfinite(through))
+            first = tight[np.concatenate([[True], segment[tight[1:]] != segment[tight[:-1]]])] if len(tight) else tight
+            next_link[sources] = NO_LINK
+            next_link[sources[segment[first]]] = links[first]
+            next_link[destination] = NO_LINK
+        for destination in stale:
+            del self.trees[destination]
+        self.invalidated += len(stale)
+        return len(stale)
+
+    def clear(self):
+        self.trees.clear()
+
+    def state(self):
+        return {'cost': self.cost, 'load': self.load, 'samples': np.array(self.samples)}
+
+    def load_state(self, arrays):
+        self.cost[:] = arrays['cost']
+        self.load[:] = arrays['load']
+        self.samples = int(arrays['samples'])
+        self.clear()
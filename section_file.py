@@ -0,0 +1,60 @@
+import json
+import os
+import struct
+
+import numpy as np
+
+# File layout shared by checkpoints and road network graphs: fixed header,
+# JSON metadata, then one 64-byte aligned raw section per array. Sections
+# can be memory-mapped straight from the file.
+ALIGNMENT = 64
+HEADER = struct.Struct('<8sIQ')  # magic, format version, metadata length
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def write_sections(path, magic, version, meta, arrays):
+    table = {}
+    offset = 0
+    for name, array in arrays.items():
+        table[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset = _align(offset + array.nbytes)
+    header = json.dumps({'meta': meta, 'arrays': table}).encode()
+    data_start = _align(HEADER.size + len(header))
+
+    # Write to a temporary file first so a crash never leaves a torn file
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(magic, version, len(header)))
+        f.write(header)
+        for name, array in arrays.items():
+            f.seek(data_start + table[name]['offset'])
+            f.write(np.ascontiguousarray(array).tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+def read_sections(path, magic, version, kind, error=ValueError, mmap=True):
+    # Returns (metadata, arrays). With mmap the arrays are copy-on-write views
+    # of the file, so many readers share one copy in the page cache.
+    with open(path, 'rb') as f:
+        file_magic, file_version, header_length = HEADER.unpack(f.read(HEADER.size))
+        if file_magic != magic:
+            raise error(f"{path} is not a {kind}")
+        if file_version != version:
+            raise error(f"Unsupported {kind} version {file_version}")
+        header = json.loads(f.read(header_length))
+    data_start = _align(HEADER.size + header_length)
+
+    arrays = {}
+    for name, info in header['arrays'].items():
+        dtype = np.dtype(info['dtype'])
+        shape = tuple(info['shape'])
+        offset = data_start + info['offset']
+        if not np.prod(shape):
+            arrays[name] = np.zeros(shape, dtype=dtype)
+        elif mmap:
+            arrays[name] = np.memmap(path, dtype=dtype, mode='c', offset=offset, shape=shape)
+        else:
+            arrays[name] = np.fromfile(path, dtype=dtype, count=int(np.prod(shape)),
+                                       offset=offset).reshape(shape)
+    return header['meta'], arrays
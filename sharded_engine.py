@@ -0,0 +1,423 @@
+import gc
+import multiprocessing
+import os
+import weakref
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from signal_plan import make_plan
+from signal_solver import NO_REQUIREMENT
+from topology import ARRAYS, EW, NS, RoadTopology
+from traffic_signal import (DEFAULT_OPTIMIZER, DEMAND_HOUR, SPAWN_INTERVAL, SPAWN_PROBABILITY,
+                            TRAFFIC_LIGHT_CHANGE_INTERVAL, CityGrid, SimulationEngine)
+
+OUTBOX_CAPACITY = 1 << 16  # Vehicles one shard hands over per exchange round
+# A vehicle on its way from one shard to another
+TRANSFER = np.dtype([('current', np.int32), ('next', np.int32), ('link', np.int64),
+                     ('progress', np.float64), ('speed', np.float64), ('entered', np.int64),
+                     ('type_code', np.int8), ('key', np.uint64), ('destination', np.int32)])
+# Per-shard counters the coordinator sums into the city stats
+SUMMED_STATS = ('cars', 'buses', 'emergency_vehicles', 'pedestrians', 'arrivals', 'travel_ticks', 'trips')
+
+class SharedArrays:
+    # Named arrays in one shared memory block. The coordinator creates it;
+    # workers attach by name with the same specs and see the same memory.
+    def __init__(self, specs, name=None):
+        self.specs = specs
+        offsets = {}
+        size = 0
+        for key, (shape, dtype) in specs.items():
+            offsets[key] = size
+            size += -(-int(np.prod(shape)) * np.dtype(dtype).itemsize // 64) * 64
+        self.memory = shared_memory.SharedMemory(name=name, create=name is None, size=max(size, 1))
+        self.arrays = {key: np.ndarray(shape, dtype, buffer=self.memory.buf, offset=offsets[key])
+                       for key, (shape, dtype) in specs.items()}
+
+    def __getitem__(self, key):
+        return self.arrays[key]
+
+    def close(self, unlink=False):
+        self.arrays = {}
+        self.memory.close()
+        if unlink:
+            self.memory.unlink()
+
+class TileSolver:
+    # The incremental optimizer (signal_solver.IncrementalBackend) for one
+    # tile's intersections alone. A node's axis only depends on the
+    # emergency route and on the vehicles leaving it, all held by the
+    # tile's shard after an exchange, so the plan of every tile matches
+    # its rows of a whole-city solve while the work stays with the tile.
+    def __init__(self, topology, nodes, links):
+        self.topology = topology
+        self.nodes = nodes
+        self.links = links
+        self.source = np.searchsorted(nodes, topology.link_source[links])  # Tile position of each link's node
+        self.ew = topology.link_axis[links] == EW
+        self.axis = np.full(len(nodes), EW, dtype=np.int8)
+        self.required = np.full(len(nodes), NO_REQUIREMENT, dtype=np.int8)
+        self.route = ()
+
+    def solve(self, city):
+        # (NS green, EW green) of the tile's nodes, or None as the backend
+        route = tuple(city.emergency_route)
+        if route != self.route:
+            required = np.full(len(self.nodes), NO_REQUIREMENT, dtype=np.int8)
+            if len(route) > 1:
+                nodes = np.array([self.topology.index[name] for name in route], dtype=np.int64)
+                axes = self.topology.route_axes(nodes)
+                if axes is None:
+                    return None
+                position = np.searchsorted(self.nodes, nodes).clip(max=len(self.nodes) - 1)
+                mine = self.nodes[position] == nodes
+                required[position[mine]] = axes[mine]
+            self.required = required
+            self.route = route
+
+        # The busier axis wins and ties keep the current phase
+        queued = city.vehicles.link_count[self.links]
+        demand_ew = np.bincount(self.source, weights=queued * self.ew, minlength=len(self.nodes))
+        demand_ns = np.bincount(self.source, weights=queued * ~self.ew, minlength=len(self.nodes))
+        preferred = self.axis.copy()
+        preferred[demand_ns > demand_ew] = NS
+        preferred[demand_ew > demand_ns] = EW
+        self.axis = np.where(self.required != NO_REQUIREMENT, self.required, preferred).astype(np.int8)
+        return self.axis == NS, self.axis == EW
+
+class Shard:
+    # One tile of the city in a worker process. The worker simulates the
+    # vehicles it holds wherever they drive during a window; at the end of
+    # the window vehicles that left the tile are handed to its owner.
+    def __init__(self, index, config, shared):
+        self.index = index
+        self.shared = shared
+        # The road network is the coordinator's, read from shared memory
+        # rather than built again in every worker
+        topology = RoadTopology.from_arrays(config['names'], {name: shared[f'topology.{name}'] for name in ARRAYS},
+                                            config['path'])
+        city = self.city = CityGrid(topology, config['vehicle_speed'], config['spawn_probability'],
+                                    config['seed'], track_ids=False, track_metrics=False)
+        # Light stats are taken once, by the coordinator
+        city.update_traffic_light_stats = lambda: None
+        self.light_interval = config['light_interval']
+        if config['signal_plan'] is not None:
+            city.signal_plan = make_plan(config['signal_plan'], city, 2 * self.light_interval)
+        self.owner = city.topology.tiles(config['shards'])
+        self.nodes = np.flatnonzero(self.owner == index)
+        self.links = np.flatnonzero(self.owner[city.topology.link_source] == index)
+        # Lights of the tile's nodes, as CityGrid keeps them for the city
+        self.solver = TileSolver(city.topology, self.nodes, self.links)
+        self.light_ns = np.zeros(len(self.nodes), dtype=bool)
+        self.light_ew = np.zeros(len(self.nodes), dtype=bool)
+        self.light_timer = np.zeros(len(self.nodes), dtype=np.int32)
+        self.demand = None
+        if config['demand'] is not None:
+            # Every shard draws the city's trips and keeps those leaving its tile
+            from demand import make_demand
+            self.demand = make_demand(config['demand'], city, config['demand_hour'])
+            self.mine = self.owner == index
+
+    def setup(self):
+        # SimulationEngine.setup_simulation for this tile
+        city = self.city
+        self.spawn()
+        self.release()
+        if city.random.random() < 0.3:
+            start, end = city.random.sample(city.intersections, 2)
+            city.set_emergency_route(start, end)
+        self.publish()
+        self.publish_links()
+
+    def lights(self, tick):
+        # Lights of this tile's intersections for the window starting at
+        # `tick` (0 at setup): CityGrid.update_traffic_lights followed by
+        # TrafficOptimizer.optimize_lights, over the tile's nodes only
+        city = self.city
+        city.tick = max(tick - 1, 0)
+        if tick:
+            self.light_timer += 1
+            expired = self.light_timer >= self.light_interval
+            if expired.any():
+                self.light_timer[expired] = 0
+                was_ns = self.light_ns[expired]
+                self.light_ns[expired] = ~was_ns
+                self.light_ew[expired] = was_ns
+        plan = self.solver.solve(city)
+        if plan is not None:
+            self.light_ns[:], self.light_ew[:] = plan
+            self.light_timer[:] = 0
+        self.shared['light_ns'][self.nodes] = self.light_ns
+        self.shared['light_ew'][self.nodes] = self.light_ew
+
+    def advance(self, start, end):
+        # Ticks start..end of SimulationEngine.step for the vehicles held
+        # here. Lights do not change within a window and vehicles do not
+        # interact, so nothing needs exchanging until it ends.
+        city = self.city
+        fleet = city.fleet
+        plan = city.signal_plan
+        link_axis = city.topology.link_axis
+        light_ns, light_ew = self.shared['light_ns'], self.shared['light_ew']
+        for tick in range(start, end + 1):
+            city.tick = tick
+            count = fleet.count
+            if count:
+                current = fleet.current[:count]
+                moving_ew = link_axis[fleet.link[:count]] == EW
+                if plan is not None:
+                    can_move = moving_ew == plan.ew_green(tick - 1, current)
+                else:
+                    can_move = np.where(moving_ew, light_ew[current], light_ns[current])
+                arrived = fleet.advance(can_move)
+                if len(arrived):
+                    city.complete_segments(arrived)
+            self.release()
+            if tick % SPAWN_INTERVAL == 0:
+                self.spawn()
+        self.publish()
+
+    def spawn(self):
+        if self.demand is None:
+            self.city.add_random_vehicles(self.nodes)
+        self.city.add_random_pedestrians(self.nodes)
+
+    def release(self):
+        if self.demand is not None:
+            trips = self.demand.release(self.city.draw_key, self.city.tick, self.mine)
+            if len(trips['tick']):
+                self.city.add_trips(trips)
+
+    def publish(self):
+        stats = self.city.stats
+        self.shared['stats'][self.index] = [stats[key] for key in SUMMED_STATS]
+
+    def publish_links(self):
+        # Vehicles on the links leaving this tile's intersections; after an
+        # exchange this shard holds all of them
+        self.shared['link_count'][self.links] = self.city.vehicles.link_count[self.links]
+
+    def routes(self):
+        # Every shard takes the same route costs from the whole city's counts
+        self.city.update_route_costs(self.shared['link_count'])
+
+    def hand_off(self):
+        # Write vehicles now leaving another tile's intersections to this
+        # shard's outbox, grouped by owner; returns how many did not fit
+        fleet = self.city.fleet
+        ids = fleet.live_ids()
+        owners = self.owner[fleet.current[ids]]
+        leaving = owners != self.index
+        ids, owners = ids[leaving], owners[leaving]
+        outbox = self.shared['outbox'][self.index]
+        sent = min(len(ids), len(outbox))
+        order = np.argsort(owners, kind='stable')[:sent]
+        ids, owners = ids[order], owners[order]
+        for field in TRANSFER.names:
+            outbox[field][:sent] = getattr(fleet, field)[ids]
+        counts = np.bincount(owners, minlength=len(self.shared['offsets']))
+        self.shared['offsets'][self.index] = np.concatenate([[0], np.cumsum(counts)])
+        self.city.vehicles.remove_many(ids, fleet.current[ids], fleet.link[ids])
+        fleet.remove_many(ids)
+        return int(leaving.sum()) - sent
+
+    def receive(self):
+        offsets = self.shared['offsets']
+        outboxes = self.shared['outbox']
+        arriving = np.concatenate([outboxes[source][offsets[source, self.index]:offsets[source, self.index + 1]]
+                                   for source in range(len(offsets))])
+        if len(arriving):
+            fleet = self.city.fleet
+            ids = fleet.extend(arriving['type_code'], arriving['current'], arriving['next'],
+                               arriving['link'], arriving['speed'], 0, arriving['key'],
+                               arriving['destination'])
+            fleet.progress[ids] = arriving['progress']
+            fleet.entered[ids] = arriving['entered']
+            self.city.vehicles.insert_many(ids, arriving['current'], arriving['link'])
+        return len(arriving)
+
+def run_shard(connection, index, config, specs, name):
+    shared = SharedArrays(specs, name)
+    shard = Shard(index, config, shared)
+    try:
+        while True:
+            command, args = connection.recv()
+            if command == 'close':
+                break
+            connection.send(getattr(shard, command)(*args))
+    finally:
+        # The city's arrays include views of the shared block; collect its
+        # reference cycles so none are left when the block is closed
+        del shard
+        gc.collect()
+        shared.close()
+
+def stop_workers(connections, processes, shared):
+    for connection in connections:
+        try:
+            connection.send(('close', ()))
+        except (BrokenPipeError, OSError):
+            pass
+    for process in processes:
+        process.join()
+    shared.close(unlink=True)
+
+class ShardedEngine(SimulationEngine):
+    # Per-vehicle engine split over worker processes, one per rectangular
+    # tile of intersections. Vehicles only interact through the lights, and
+    # lights only change every light_interval ticks, so the workers run a
+    # whole light interval at a time. Between intervals each worker hands
+    # the vehicles that drove out of its tile to the tile's owner through
+    # shared memory, then solves the lights of its own intersections from
+    # the vehicles now leaving them and publishes them in a shared array
+    # that every worker gates its vehicles by. Link counts are shared the
+    # same way, so every worker derives the same route costs. All random
+    # draws are keyed by node, vehicle and tick (see counter_rng), so the
+    # results match SimulationEngine for the same seed whatever the number
+    # of shards.
+    mode = 'sharded'
+    track_ids = False
+    track_metrics = False  # Vehicles move in the workers, out of the coordinator's sight
+    reports_ticks = True
+
+    def __init__(self, grid_size, optimizer=DEFAULT_OPTIMIZER,
+                 light_interval=TRAFFIC_LIGHT_CHANGE_INTERVAL,
+                 spawn_probability=SPAWN_PROBABILITY, vehicle_speed=None, seed=None,
+                 setup=True, signal_plan=None, optimizer_budget=None, demand=None,
+                 demand_hour=DEMAND_HOUR, shards=None, outbox_capacity=OUTBOX_CAPACITY):
+        if optimizer_budget is not None:
+            raise ValueError("the sharded engine needs the synchronous optimizer")
+        if optimizer not in (DEFAULT_OPTIMIZER, 'incremental') and signal_plan is None:
+            raise ValueError("the sharded engine solves lights per tile with the incremental optimizer")
+        if seed is None:
+            # Every worker has to draw from the same streams
+            seed = int(np.random.SeedSequence().entropy)
+        super().__init__(grid_size, optimizer, light_interval, spawn_probability, vehicle_speed,
+                         seed, setup=False, signal_plan=signal_plan, demand=demand,
+                         demand_hour=demand_hour)
+        self.shards = shards = shards or os.cpu_count()
+        num_nodes = self.city.topology.num_nodes
+        specs = {
+            'light_ns': ((num_nodes,), bool),
+            'light_ew': ((num_nodes,), bool),
+            'stats': ((shards, len(SUMMED_STATS)), np.int64),
+            'outbox': ((shards, outbox_capacity), TRANSFER),
+            'offsets': ((shards, shards + 1), np.int64),
+            'link_count': ((self.city.topology.num_links,), np.int32),
+        }
+        topology = self.city.topology
+        for name, array in topology.arrays().items():
+            specs[f'topology.{name}'] = (array.shape, array.dtype)
+        self.shared = SharedArrays(specs)
+        for name, array in topology.arrays().items():
+            self.shared[f'topology.{name}'][:] = array
+        config = {
+            'names': topology.names, 'path': topology.path, 'light_interval': light_interval,
+            'spawn_probability': spawn_probability, 'vehicle_speed': self.city.vehicle_speed,
+            'seed': seed, 'signal_plan': signal_plan, 'shards': shards,
+            'demand': demand, 'demand_hour': demand_hour,
+        }
+        context = multiprocessing.get_context()
+        self.connections = []
+        self.processes = []
+        for index in range(shards):
+            parent, child = context.Pipe()
+            process = context.Process(target=run_shard, args=(child, index, config, specs, self.shared.memory.name),
+                                      daemon=True)
+            process.start()
+            self.connections.append(parent)
+            self.processes.append(process)
+        self._finalizer = weakref.finalize(self, stop_workers, self.connections, self.processes, self.shared)
+        if setup:
+            self.setup_simulation()
+
+    def _call(self, command, *args):
+        # Commands are tiny; vehicles and lights travel through shared memory
+        for connection in self.connections:
+            connection.send((command, args))
+        return [connection.recv() for connection in self.connections]
+
+    def setup_simulation(self):
+        city = self.city
+        self._call('setup')
+        if city.random.random() < 0.3:
+            start, end = city.random.sample(city.intersections, 2)
+            city.set_emergency_route(start, end)
+        if city.signal_plan is None:
+            self.solve_lights(0)
+        self._collect()
+
+    def step(self):
+        self.run(1)
+
+    def run(self, ticks):
+        end = self.time + ticks
+        while self.time < end:
+            stop = min(end, ((self.time + 1) // self.light_interval + 1) * self.light_interval - 1)
+            if self.profiler is None:
+                self._window(stop)
+            else:
+                self.profiler.time_ticks(stop - self.time, self._window, stop)
+        self._collect()
+        return self.city.stats
+
+    def _window(self, stop):
+        # Ticks up to `stop`, within one light interval
+        city = self.city
+        start = self.time + 1
+        if start % self.light_interval == 0:
+            if city.signal_plan is None:
+                self.solve_lights(start)
+            self._call('routes')
+        self.advance_shards(start, stop)
+        # The emergency vehicle is the same in every shard; follow it here
+        for tick in range(start, stop + 1):
+            city.tick = tick - 1
+            city.update_emergency_vehicle()
+        city.tick = stop
+        self.time = stop
+        self.exchange()
+
+    # Worker phases, named so the profiler can time them from here
+    def solve_lights(self, tick):
+        self._call('lights', tick)
+
+    def advance_shards(self, start, stop):
+        self._call('advance', start, stop)
+
+    def exchange(self):
+        while True:
+            remaining = sum(self._call('hand_off'))
+            self._call('receive')
+            if not remaining:
+                break
+        self._call('publish_links')
+
+    def _collect(self):
+        # Sum the shards' counters, take the vehicle counts from the links
+        # they published at the last exchange, and the light stats from the
+        # shared lights, or from the plan at the last tick
+        city = self.city
+        for key, total in zip(SUMMED_STATS, self.shared['stats'].sum(axis=0).tolist()):
+            city.stats[key] = total
+        city.stats['total_vehicles'] = city.stats['cars'] + city.stats['buses'] + city.stats['emergency_vehicles']
+        topology = city.topology
+        link_count = city.vehicles.link_count
+        link_count[:] = self.shared['link_count']
+        city.vehicles.node_count[:] = np.bincount(topology.link_source, weights=link_count,
+                                                  minlength=topology.num_nodes)
+        if city.signal_plan is not None:
+            city.tick = max(self.time - 1, 0)
+            city.update_traffic_lights()
+            city.tick = self.time
+        else:
+            city.light_ns[:] = self.shared['light_ns']
+            city.light_ew[:] = self.shared['light_ew']
+            city.update_traffic_light_stats()
+
+    def attach_telemetry(self, *args, **kwargs):
+        raise ValueError("the sharded engine does not record telemetry")
+
+    def close(self):
+        self._finalizer()
+        super().close()
@@ -0,0 +1,86 @@
+import numpy as np
+
+from topology import EW
+from vehicle_store import ARRIVAL_PROGRESS
+
+NO_PREEMPTION = -1
+PLAN_KINDS = ('fixed', 'green-wave')
+
+class SignalPlan:
+    # Fixed-time plan stored as per-intersection arrays. Within each cycle an
+    # intersection shows EW green for the first `split` ticks and NS green for
+    # the rest, and its phase at tick t is (t + offset) mod cycle, so the
+    # lights for any tick come from one vectorized evaluation with no timers.
+    # Nodes in `preempt` hold the given axis regardless of the plan, which is
+    # how emergency routes get their green.
+    def __init__(self, num_nodes, cycle=600, split=0.5):
+        self.cycle = np.full(num_nodes, cycle, dtype=np.int64)
+        self.split = np.full(num_nodes, int(round(cycle * split)), dtype=np.int64)
+        self.offset = np.zeros(num_nodes, dtype=np.int64)
+        self.preempt = np.full(num_nodes, NO_PREEMPTION, dtype=np.int8)
+        self.preempted = False
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        plan = cls(len(arrays['cycle']))
+        plan.cycle[:] = arrays['cycle']
+        plan.split[:] = arrays['split']
+        plan.offset[:] = arrays['offset']
+        plan.preempt[:] = arrays['preempt']
+        plan.preempted = bool((plan.preempt != NO_PREEMPTION).any())
+        return plan
+
+    def arrays(self):
+        return {'cycle': self.cycle, 'split': self.split, 'offset': self.offset,
+                'preempt': self.preempt}
+
+    def ew_green(self, tick, nodes=None):
+        # For every node, or only `nodes` (repeats allowed)
+        if nodes is None:
+            ew = (tick + self.offset) % self.cycle < self.split
+            preempt = self.preempt
+        else:
+            ew = (tick + self.offset[nodes]) % self.cycle[nodes] < self.split[nodes]
+            preempt = self.preempt[nodes]
+        if self.preempted:
+            ew = np.where(preempt == NO_PREEMPTION, ew, preempt == EW)
+        return ew
+
+    def coordinate(self, topology, link_ticks, axis=EW):
+        # Green-wave offsets for every corridor along `axis` at once. Each node
+        # gets the travel time from the head of its corridor, summed by pointer
+        # jumping over the upstream links, and its green for that axis starts
+        # that many ticks after the head's so a platoon meets green throughout.
+        upstream = topology.upstream_links(axis)
+        has_upstream = upstream >= 0
+        previous = np.where(has_upstream, topology.link_source[np.maximum(upstream, 0)],
+                            np.arange(topology.num_nodes))
+        arrival = np.where(has_upstream, np.asarray(link_ticks)[np.maximum(upstream, 0)], 0.0)
+        while (previous[previous] != previous).any():
+            arrival = arrival + arrival[previous]
+            previous = previous[previous]
+        green_start = 0 if axis == EW else self.split
+        self.offset[:] = (green_start - np.rint(arrival).astype(np.int64)) % self.cycle
+        return self.offset
+
+    def set_preemption(self, nodes, axes):
+        self.clear_preemption()
+        self.preempt[nodes] = axes
+        self.preempted = len(nodes) > 0
+
+    def clear_preemption(self):
+        self.preempt[:] = NO_PREEMPTION
+        self.preempted = False
+
+def make_plan(kind, city, cycle, split=0.5):
+    # 'fixed' runs every intersection in lockstep; 'green-wave' offsets the EW
+    # corridors by the free-flow travel time of a car on each link
+    if isinstance(kind, SignalPlan):
+        return kind
+    if kind not in PLAN_KINDS:
+        raise ValueError(f"Unknown signal plan: {kind!r}")
+    plan = SignalPlan(city.topology.num_nodes, cycle, split)
+    if kind == 'green-wave':
+        link_ticks = np.full(city.topology.num_links, ARRIVAL_PROGRESS / city.vehicle_speed)
+        plan.coordinate(city.topology, link_ticks, EW)
+    return plan
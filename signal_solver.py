@@ -0,0 +1,206 @@
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from topology import AXIS_NAMES, EW, NS
+
+NO_REQUIREMENT = -1
+SOLVE_CHUNK = 4096  # Nodes re-solved between deadline checks
+
+class SignalBackend:
+    # Optimizer backends turn the city state into a light plan: a pair of
+    # boolean arrays (NS green, EW green) indexed by node, or None when the
+    # active constraints cannot be satisfied. With a deadline (a
+    # time.perf_counter() value) a backend returns the best plan it has by
+    # then; backends that cannot stop early finish the solve regardless.
+    name = None
+
+    def solve(self, city, deadline=None):
+        raise NotImplementedError
+
+    def reset(self):
+        pass
+
+    def state(self):
+        # Solver state carried between calls, as (json metadata, arrays), so
+        # checkpoints resume with the same plans
+        return {}, {}
+
+    def load_state(self, topology, meta, arrays):
+        pass
+
+class ConstraintBackend(SignalBackend):
+    # Reference backend: re-solves the full CSP with python-constraint, which
+    # cannot be interrupted, so the deadline is not checked
+    name = 'constraint'
+
+    def solve(self, city, deadline=None):
+        from constraint import Problem
+        problem = Problem()
+
+        for intersection in city.intersections:
+            problem.addVariable(f"{intersection}_NS", ['red', 'green'])
+            problem.addVariable(f"{intersection}_EW", ['red', 'green'])
+
+        # Basic constraint: no conflicting green lights
+        for intersection in city.intersections:
+            problem.addConstraint(
+                lambda ns, ew: not (ns == 'green' and ew == 'green'),
+                (f"{intersection}_NS", f"{intersection}_EW")
+            )
+
+        # Emergency route priority: both ends of every road on the route show
+        # green for that road's approach group
+        route = city.emergency_route
+        if len(route) > 1:
+            topology = city.topology
+            links = [topology.link_between(topology.index[a], topology.index[b])
+                     for a, b in zip(route[:-1], route[1:])]
+            if min(links) < 0:
+                return None
+            for current, next_node, link in zip(route[:-1], route[1:], links):
+                axis = AXIS_NAMES[topology.link_axis[link]]
+                problem.addConstraint(lambda a: a == 'green', (f"{current}_{axis}",))
+                problem.addConstraint(lambda a: a == 'green', (f"{next_node}_{axis}",))
+
+        solution = problem.getSolution()
+        if not solution:
+            return None
+        ns = np.array([solution[f"{i}_NS"] == 'green' for i in city.intersections])
+        ew = np.array([solution[f"{i}_EW"] == 'green' for i in city.intersections])
+        return ns, ew
+
+class IncrementalBackend(SignalBackend):
+    # Dedicated solver for the signal problem. Each intersection shows green on
+    # exactly one axis, so NS and EW are never green together by construction.
+    # The axis is forced by the emergency route when the node is on it and
+    # otherwise follows demand. Between calls only nodes whose route
+    # requirement or preferred axis changed are re-solved. Past the deadline
+    # the remaining nodes keep their current axis and are re-solved first on
+    # the next call, so every returned plan is valid.
+    name = 'incremental'
+
+    def __init__(self, cache_size=64):
+        self.cache_size = cache_size
+        self.route_cache = OrderedDict()
+        self.reset()
+
+    def reset(self):
+        self.topology = None
+        self.route = ()
+        self.required = None
+        self.preferred = None
+        self.axis = None
+        self.pending = None
+
+    def _bind(self, topology):
+        self.topology = topology
+        self.route = ()
+        self.required = np.full(topology.num_nodes, NO_REQUIREMENT, dtype=np.int8)
+        self.preferred = np.full(topology.num_nodes, EW, dtype=np.int8)
+        self.axis = np.full(topology.num_nodes, EW, dtype=np.int8)
+        self.pending = np.zeros(topology.num_nodes, dtype=bool)
+        self.route_cache.clear()
+
+    def state(self):
+        if self.topology is None:
+            return {}, {}
+        arrays = {'axis': self.axis, 'preferred': self.preferred, 'required': self.required,
+                  'pending': self.pending}
+        return {'route': list(self.route)}, arrays
+
+    def load_state(self, topology, meta, arrays):
+        if not arrays:
+            self.reset()
+            return
+        self._bind(topology)
+        self.route = tuple(meta['route'])
+        self.axis[:] = arrays['axis']
+        self.preferred[:] = arrays['preferred']
+        self.required[:] = arrays['required']
+        if 'pending' in arrays:
+            self.pending[:] = arrays['pending']
+
+    def route_requirements(self, city, route):
+        # Node ids and required axes of a route (see RoadTopology.route_axes),
+        # cached per route since the same route is re-optimized every cycle
+        cached = self.route_cache.get(route)
+        if cached is not None:
+            self.route_cache.move_to_end(route)
+            return cached
+        topology = self.topology
+        nodes = np.array([topology.index[name] for name in route], dtype=np.int64)
+        axes = topology.route_axes(nodes)
+        cached = None if axes is None else (nodes, axes)
+        self.route_cache[route] = cached
+        if len(self.route_cache) > self.cache_size:
+            self.route_cache.popitem(last=False)
+        return cached
+
+    def demand_preference(self, city):
+        # Vehicles waiting on each approach, which the city's traffic metrics
+        # keep per node and axis; cities without metrics (mesoscopic and
+        # sharded runs) have them summed from the per-link vehicle counts.
+        # The busier axis wins and ties keep the current phase.
+        topology = self.topology
+        if city.metrics is not None:
+            demand = city.metrics.approach_counts()
+            demand_ns, demand_ew = demand[:, NS], demand[:, EW]
+        else:
+            queued = city.vehicles.link_count
+            ew = topology.link_axis == EW
+            demand_ew = np.bincount(topology.link_source, weights=queued * ew, minlength=topology.num_nodes)
+            demand_ns = np.bincount(topology.link_source, weights=queued * ~ew, minlength=topology.num_nodes)
+        preferred = self.axis.copy()
+        preferred[demand_ns > demand_ew] = NS
+        preferred[demand_ew > demand_ns] = EW
+        return preferred
+
+    def solve(self, city, deadline=None):
+        if self.topology is not city.topology:
+            self._bind(city.topology)
+            dirty = np.ones(self.topology.num_nodes, dtype=bool)
+        else:
+            dirty = self.pending.copy()
+
+        route = tuple(city.emergency_route)
+        if route != self.route:
+            required = np.full(self.topology.num_nodes, NO_REQUIREMENT, dtype=np.int8)
+            if len(route) > 1:
+                constraint = self.route_requirements(city, route)
+                if constraint is None:
+                    return None
+                nodes, axes = constraint
+                required[nodes] = axes
+            dirty |= required != self.required
+            self.required = required
+            self.route = route
+
+        preferred = self.demand_preference(city)
+        dirty |= preferred != self.preferred
+        self.preferred = preferred
+
+        changed = np.flatnonzero(dirty)
+        self.pending[:] = False
+        for start in range(0, len(changed), SOLVE_CHUNK):
+            if deadline is not None and start and time.perf_counter() > deadline:
+                self.pending[changed[start:]] = True
+                break
+            chunk = changed[start:start + SOLVE_CHUNK]
+            forced = self.required[chunk]
+            self.axis[chunk] = np.where(forced != NO_REQUIREMENT, forced, preferred[chunk])
+        return self.axis == NS, self.axis == EW
+
+BACKENDS = {
+    IncrementalBackend.name: IncrementalBackend,
+    ConstraintBackend.name: ConstraintBackend,
+}
+
+def make_backend(backend):
+    if isinstance(backend, SignalBackend):
+        return backend
+    try:
+        return BACKENDS[backend]()
+    except KeyError:
+        raise ValueError(f"Unknown optimizer backend: {backend!r}") from None
@@ -0,0 +1,173 @@
+import argparse
+import csv
+import itertools
+import os
+import statistics
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from traffic_signal import (DEFAULT_OPTIMIZER, FPS, GRID_SIZE, SPAWN_PROBABILITY,
+                            TRAFFIC_LIGHT_CHANGE_INTERVAL, VEHICLE_SPEED, ENGINE_MODES, engine_class)
+
+PARAMETERS = ('light_interval', 'spawn_probability', 'vehicle_speed')
+METRICS = ('vehicles', 'arrivals', 'throughput_per_min', 'mean_travel_ticks', 'emergency_ticks')
+FIELDS = ('run_id', 'replicate', 'seed', 'status') + PARAMETERS + ('ticks',) + METRICS
+MAX_ATTEMPTS = 3  # Runs lost to a crashed worker are retried this many times
+
+def scenario_runs(grid, replicates, base_seed):
+    # One run per parameter combination and replicate, each with its own seed
+    # so the sweep is reproducible and any single run can be repeated
+    runs = []
+    for combo_index, values in enumerate(itertools.product(*(grid[name] for name in PARAMETERS))):
+        for replicate in range(replicates):
+            params = dict(zip(PARAMETERS, values))
+            params['replicate'] = replicate
+            params['seed'] = base_seed + combo_index * 100003 + replicate
+            params['run_id'] = '|'.join(f"{name}={params[name]}" for name in PARAMETERS) + f"|r{replicate}"
+            runs.append(params)
+    return runs
+
+def run_scenario(params, ticks, grid_size=GRID_SIZE, optimizer=DEFAULT_OPTIMIZER, mode='tick'):
+    engine = engine_class(mode)(grid_size, optimizer,
+                                light_interval=params['light_interval'],
+                                spawn_probability=params['spawn_probability'],
+                                vehicle_speed=params['vehicle_speed'],
+                                seed=params['seed'])
+    engine.run(ticks)
+    row = {name: params[name] for name in ('run_id', 'replicate', 'seed') + PARAMETERS}
+    row.update(engine.metrics())
+    row['status'] = 'ok'
+    return row
+
+def load_completed(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, newline='') as f:
+        return {row['run_id']: row for row in csv.DictReader(f) if row['status'] == 'ok'}
+
+def run_sweep(grid, replicates, ticks, out_path, grid_size=GRID_SIZE,
+              optimizer=DEFAULT_OPTIMIZER, workers=None, base_seed=0, mode='tick'):
+    # Results are appended to out_path as each run finishes, so an interrupted
+    # sweep resumes by skipping the run ids already recorded there
+    completed = load_completed(out_path)
+    pending = [run for run in scenario_runs(grid, replicates, base_seed)
+               if run['run_id'] not in completed]
+    attempts = {run['run_id']: 0 for run in pending}
+    new_file = not os.path.exists(out_path) or os.path.getsize(out_path) == 0
+
+    with open(out_path, 'a', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        if new_file:
+            writer.writeheader()
+
+        def record(row):
+            writer.writerow({name: row.get(name) for name in FIELDS})
+            f.flush()
+            if row['status'] == 'ok':
+                completed[row['run_id']] = row
+
+        def settle(future, run, isolated):
+            # A run lost to a broken pool is only charged an attempt when it
+            # ran alone, since otherwise any run in the pool may have broken it
+            try:
+                record(future.result())
+            except BrokenProcessPool:
+                if isolated:
+                    attempts[run['run_id']] += 1
+                if attempts[run['run_id']] >= MAX_ATTEMPTS:
+                    record(dict(run, status='crashed'))
+                else:
+                    suspects.append(run)
+            except Exception as exc:
+                record(dict(run, status=f'error: {exc}'))
+
+        max_workers = workers or os.cpu_count()
+        suspects = []  # Runs in a pool that broke before they finished
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            futures = {pool.submit(run_scenario, run, ticks, grid_size, optimizer, mode): run
+                       for run in pending}
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    settle(future, futures.pop(future), isolated=False)
+
+        # A worker that dies breaks the whole pool, so whatever did not finish
+        # is rerun one run per pool, to find the run that crashed and finish
+        # the others without using up their attempts
+        while suspects:
+            queue, suspects = suspects, []
+            active = {}
+            while queue or active:
+                while queue and len(active) < max_workers:
+                    run = queue.pop(0)
+                    single = ProcessPoolExecutor(max_workers=1)
+                    active[single.submit(run_scenario, run, ticks, grid_size, optimizer, mode)] = (run, single)
+                done, _ = wait(active, return_when=FIRST_COMPLETED)
+                for future in done:
+                    run, single = active.pop(future)
+                    single.shutdown()
+                    settle(future, run, isolated=True)
+    return completed
+
+def summarize(rows):
+    # Mean and standard deviation of every metric over the replicates of each
+    # parameter combination
+    groups = {}
+    for row in rows:
+        key = tuple(float(row[name]) for name in PARAMETERS)
+        groups.setdefault(key, []).append(row)
+    summary = []
+    for key in sorted(groups):
+        entry = dict(zip(PARAMETERS, key))
+        entry['replicates'] = len(groups[key])
+        for metric in METRICS:
+            values = [float(row[metric]) for row in groups[key] if row[metric] not in (None, '')]
+            entry[f'{metric}_mean'] = statistics.fmean(values) if values else None
+            entry[f'{metric}_std'] = statistics.stdev(values) if len(values) > 1 else 0.0 if values else None
+        summary.append(entry)
+    return summary
+
+def write_summary(summary, path):
+    if not summary:
+        return
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(summary[0]))
+        writer.writeheader()
+        writer.writerows(summary)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Parallel parameter sweep of headless simulations")
+    parser.add_argument('--light-interval', type=int, nargs='+', default=[TRAFFIC_LIGHT_CHANGE_INTERVAL])
+    parser.add_argument('--spawn-probability', type=float, nargs='+', default=[SPAWN_PROBABILITY])
+    parser.add_argument('--vehicle-speed', type=float, nargs='+', default=[VEHICLE_SPEED])
+    parser.add_argument('--replicates', type=int, default=3)
+    parser.add_argument('--ticks', type=int, default=FPS * 600)
+    parser.add_argument('--grid-size', type=int, default=GRID_SIZE)
+    parser.add_argument('--optimizer', default=DEFAULT_OPTIMIZER)
+    parser.add_argument('--workers', type=int, default=None,
+                        help="worker processes (default: one per CPU)")
+    parser.add_argument('--seed', type=int, default=0, help="base seed for the sweep")
+    # Sweeps already run one scenario per process, so no sharding within runs
+    parser.add_argument('--engine', choices=[mode for mode in ENGINE_MODES if mode != 'sharded'], default='tick',
+                        help="event mode gives the same results faster; meso models link densities")
+    parser.add_argument('--out', default='sweep_results.csv',
+                        help="per-run results; rerunning with the same file resumes the sweep")
+    args = parser.parse_args(argv)
+
+    grid = {
+        'light_interval': args.light_interval,
+        'spawn_probability': args.spawn_probability,
+        'vehicle_speed': args.vehicle_speed,
+    }
+    completed = run_sweep(grid, args.replicates, args.ticks, args.out, args.grid_size,
+                          args.optimizer, args.workers, args.seed, args.engine)
+    summary = summarize(completed.values())
+    summary_path = os.path.splitext(args.out)[0] + '_summary.csv'
+    write_summary(summary, summary_path)
+    print(f"{len(completed)} runs in {args.out}, summary in {summary_path}")
+    for entry in summary:
+        print("  " + ", ".join(f"{name}={entry[name]}" for name in PARAMETERS) +
+              f": throughput {entry['throughput_per_min_mean']:.1f}/min")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+import csv
+import os
+import queue
+import threading
+
+import numpy as np
+
+TELEMETRY_INTERVAL = 60  # Ticks between records, one simulated second
+TELEMETRY_CAPACITY = 4096  # Rows kept in memory, when they fit in TELEMETRY_BYTES
+TELEMETRY_BYTES = 64 << 20  # Memory for buffered rows; at least one batch is kept
+TELEMETRY_BATCH = 256  # Rows handed to the writer at a time
+
+class ColumnarRingBuffer:
+    # Fixed-size columns preallocated up front. Rows are written in place and
+    # the oldest rows are overwritten once the buffer wraps.
+    def __init__(self, schema, capacity):
+        self.capacity = capacity
+        self.columns = {name: np.zeros((capacity,) + shape, dtype=dtype)
+                        for name, (dtype, shape) in schema.items()}
+        self.written = 0  # Rows appended since creation
+
+    def append(self, row):
+        slot = self.written % self.capacity
+        for name, value in row.items():
+            self.columns[name][slot] = value
+        self.written += 1
+
+    def slice(self, start, end):
+        # Copy of rows [start, end) counted from creation; must still be held
+        if end - start > self.capacity or start < self.written - self.capacity:
+            raise ValueError("Rows have already been overwritten")
+        slots = np.arange(start, end) % self.capacity
+        return {name: column[slots] for name, column in self.columns.items()}
+
+    def recent(self, count):
+        count = min(count, self.written, self.capacity)
+        return self.slice(self.written - count, self.written)
+
+class CsvChunkWriter:
+    # One CSV file; vector columns are flattened to name_0, name_1, ...
+    def __init__(self, path):
+        self.file = open(path, 'w', newline='')
+        self.writer = csv.writer(self.file)
+        self.header_written = False
+
+    def write(self, batch):
+        names = list(batch)
+        rows = len(batch[names[0]])
+        flat = [batch[name].reshape(rows, -1) for name in names]
+        if not self.header_written:
+            header = []
+            for name, values in zip(names, flat):
+                if batch[name].ndim == 1:
+                    header.append(name)
+                else:
+                    header.extend(f"{name}_{i}" for i in range(values.shape[1]))
+            self.writer.writerow(header)
+            self.header_written = True
+        self.writer.writerows(np.concatenate([values.astype(object) for values in flat], axis=1).tolist())
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class NpzChunkWriter:
+    # A directory of numbered .npz chunks, one per batch, each holding every
+    # column as its own array
+    def __init__(self, path):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.chunks = 0
+
+    def write(self, batch):
+        np.savez(os.path.join(self.path, f"chunk_{self.chunks:06d}.npz"), **batch)
+        self.chunks += 1
+
+    def close(self):
+        pass
+
+class ParquetWriter:
+    # Requires pyarrow; each batch becomes a row group
+    def __init__(self, path):
+        import pyarrow  # noqa: F401  (fail early when pyarrow is missing)
+        self.path = path
+        self.writer = None
+
+    def write(self, batch):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        arrays = {}
+        for name, values in batch.items():
+            if values.ndim == 1:
+                arrays[name] = pa.array(values)
+            else:
+                width = int(np.prod(values.shape[1:]))
+                arrays[name] = pa.FixedSizeListArray.from_arrays(pa.array(values.reshape(-1)), width)
+        table = pa.table(arrays)
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.path, table.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+WRITERS = {
+    'csv': CsvChunkWriter,
+    'npz': NpzChunkWriter,
+    'parquet': ParquetWriter,
+}
+
+class TelemetryRecorder:
+    # Samples the engine every `interval` ticks into a ColumnarRingBuffer.
+    # Full batches go to a background writer thread and to any stream()
+    # consumers, so the tick loop only pays for copying a few arrays. Rows
+    # grow with the network, so unless `capacity` gives the rows the buffer
+    # holds TELEMETRY_CAPACITY of them or as many as fit in `buffer_bytes`.
+    def __init__(self, city, path=None, fmt='csv', interval=TELEMETRY_INTERVAL, capacity=None,
+                 buffer_bytes=TELEMETRY_BYTES, batch_size=TELEMETRY_BATCH, max_pending=16):
+        topology = city.topology
+        schema = {
+            'tick': (np.int64, ()),
+            'vehicles': (np.int64, ()),
+            'arrivals': (np.int64, ()),
+            'emergency_active': (np.bool_, ()),
+            'emergency_progress': (np.float64, ()),
+            'light_ns': (np.bool_, (topology.num_nodes,)),
+            'light_ew': (np.bool_, (topology.num_nodes,)),
+            'link_occupancy': (np.int32, (topology.num_links,)),
+        }
+        if capacity is None:
+            row_bytes = sum(np.dtype(dtype).itemsize * int(np.prod(shape)) for dtype, shape in schema.values())
+            capacity = max(batch_size, min(TELEMETRY_CAPACITY, buffer_bytes // row_bytes))
+        if batch_size > capacity:
+            raise ValueError("batch_size cannot exceed the buffer capacity")
+        self.interval = interval
+        self.batch_size = batch_size
+        self.buffer = ColumnarRingBuffer(schema, capacity)
+        self.flushed = 0
+        self.last_arrivals = city.stats['arrivals']
+        self.dropped = 0  # Batches discarded because the writer fell behind
+        self.subscribers = []
+
+        self.writer = WRITERS[fmt](path) if path else None
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.thread = None
+        if self.writer is not None:
+            self.thread = threading.Thread(target=self._write_loop, name='telemetry-writer', daemon=True)
+            self.thread.start()
+
+    def record(self, engine):
+        city = engine.city
+        route = city.emergency_route
+        arrivals = city.stats['arrivals']
+        self.buffer.append({
+            'tick': engine.time,
+            'vehicles': city.stats['total_vehicles'],
+            'arrivals': arrivals - self.last_arrivals,
+            'emergency_active': bool(route),
+            'emergency_progress': min(city.emergency_vehicle_pos / (len(route) - 1), 1.0) if len(route) > 1 else 0.0,
+            'light_ns': city.light_ns,
+            'light_ew': city.light_ew,
+            'link_occupancy': city.vehicles.link_count,
+        })
+        self.last_arrivals = arrivals
+        if self.buffer.written - self.flushed >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer.written == self.flushed:
+            return
+        batch = self.buffer.slice(self.flushed, self.buffer.written)
+        self.flushed = self.buffer.written
+        for subscriber in self.subscribers:
+            self._offer(subscriber, batch)
+        if self.writer is not None:
+            self._offer(self.pending, batch)
+
+    def _offer(self, target, batch):
+        try:
+            target.put_nowait(batch)
+        except queue.Full:
+            self.dropped += 1
+
+    def _write_loop(self):
+        while True:
+            batch = self.pending.get()
+            if batch is None:
+                break
+            self.writer.write(batch)
+
+    def stream(self, max_pending=16):
+        # Generator of batches (dicts of column arrays) as they are flushed;
+        # ends when the recorder is closed
+        subscriber = queue.Queue(maxsize=max_pending)
+        self.subscribers.append(subscriber)
+        def batches():
+            while True:
+                batch = subscriber.get()
+                if batch is None:
+                    return
+                yield batch
+        return batches()
+
+    def close(self):
+        self.flush()
+        for subscriber in self.subscribers:
+            # Make room for the end marker even if the consumer stopped reading
+            while True:
+                try:
+                    subscriber.put_nowait(None)
+                    break
+                except queue.Full:
+                    subscriber.get_nowait()
+        if self.thread is not None:
+            self.pending.put(None)
+            self.thread.join()
+            self.writer.close()
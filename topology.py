@@ -0,0 +1,162 @@
+import numpy as np
+
+# Signal axis of a link, used to pick the NS or EW light that gates it
+NS, EW = 0, 1
+AXIS_NAMES = ('NS', 'EW')
+
+# Arrays that make up a topology, as stored in road network files
+ARRAYS = ('node_xy', 'edges', 'edge_length', 'edge_lanes', 'link_source', 'link_target',
+          'link_edge', 'link_axis', 'degree', 'indptr')
+
+class RoadTopology:
+    # Integer-indexed road network built once per city. Neighbours are stored
+    # CSR-style: the links leaving node n are indptr[n]:indptr[n+1], and each
+    # link carries its target node, undirected road id and signal axis, the
+    # approach group whose light gates it. Screen-style coordinates: x grows
+    # east and y grows south, as grid rows do.
+    def __init__(self, names, node_xy, edges, edge_length=None, edge_lanes=None):
+        self.names = list(names)
+        self.path = None  # Road network file the topology was loaded from
+        self._index = None
+        self.node_xy = np.asarray(node_xy, dtype=np.float64).reshape(-1, 2)
+        self.edges = np.asarray(edges, dtype=np.int32).reshape(-1, 2)
+        self.num_nodes = len(self.names)
+        self.num_edges = len(self.edges)
+        if edge_length is None:
+            edge_length = np.linalg.norm(self.node_xy[self.edges[:, 1]] - self.node_xy[self.edges[:, 0]], axis=1)
+        self.edge_length = np.asarray(edge_length, dtype=np.float64)
+        self.edge_lanes = (np.ones(self.num_edges, dtype=np.int8) if edge_lanes is None
+                           else np.asarray(edge_lanes, dtype=np.int8))
+
+        # Every road is two directed links
+        source = np.concatenate([self.edges[:, 0], self.edges[:, 1]])
+        target = np.concatenate([self.edges[:, 1], self.edges[:, 0]])
+        road = np.concatenate([np.arange(self.num_edges)] * 2).astype(np.int32)
+        order = np.lexsort((target, source))
+        self.link_source = source[order].astype(np.int32)
+        self.link_target = target[order].astype(np.int32)
+        self.link_edge = road[order]
+        self.num_links = len(self.link_target)
+        self.degree = np.bincount(self.link_source, minlength=self.num_nodes).astype(np.int32)
+        self.indptr = np.zeros(self.num_nodes + 1, dtype=np.int64)
+        np.cumsum(self.degree, out=self.indptr[1:])
+
+        # Links that run mostly sideways are gated by the EW light
+        delta = self.node_xy[self.link_target] - self.node_xy[self.link_source]
+        self.link_axis = np.where(np.abs(delta[:, 0]) >= np.abs(delta[:, 1]), EW, NS).astype(np.int8)
+        self._derive()
+
+    def _derive(self):
+        self.edge_axis = np.zeros(self.num_edges, dtype=np.int8)
+        self.edge_axis[self.link_edge] = self.link_axis
+        self.link_length = self.edge_length[self.link_edge]
+        self.link_lanes = self.edge_lanes[self.link_edge]
+        # The two directed links of every road
+        self.edge_links = np.argsort(self.link_edge, kind='stable').reshape(-1, 2)
+
+    @classmethod
+    def from_arrays(cls, names, arrays, path=None):
+        # Wrap stored arrays (e.g. memory-mapped from a road network file)
+        # without recomputing the links
+        topology = cls.__new__(cls)
+        topology.names = names
+        topology.path = path
+        topology._index = None
+        for name in ARRAYS:
+            setattr(topology, name, arrays[name])
+        topology.num_nodes = len(topology.node_xy)
+        topology.num_edges = len(topology.edges)
+        topology.num_links = len(topology.link_target)
+        topology._derive()
+        return topology
+
+    def arrays(self):
+        return {name: getattr(self, name) for name in ARRAYS}
+
+    @property
+    def index(self):
+        # Node id by name, built on first use
+        if self._index is None:
+            self._index = {name: i for i, name in enumerate(self.names)}
+        return self._index
+
+    @classmethod
+    def grid(cls, rows, cols=None):
+        cols = rows if cols is None else cols
+        names = [f'I{i+1}' for i in range(rows * cols)]
+        node = np.arange(rows * cols).reshape(rows, cols)
+        node_xy = np.stack([node % cols, node // cols], axis=-1).reshape(-1, 2)
+        # Same road order as the original grid builder: all east-west roads
+        # row by row, then all north-south roads column by column
+        horizontal = np.stack([node[:, :-1].ravel(), node[:, 1:].ravel()], axis=-1)
+        vertical = np.stack([node[:-1, :].T.ravel(), node[1:, :].T.ravel()], axis=-1)
+        return cls(names, node_xy, np.concatenate([horizontal, vertical]))
+
+    def neighbors(self, node):
+        return self.link_target[self.indptr[node]:self.indptr[node + 1]]
+
+    def link_between(self, source, target):
+        start, end = self.indptr[source], self.indptr[source + 1]
+        offset = np.searchsorted(self.link_target[start:end], target)
+        if offset < end - start and self.link_target[start + offset] == target:
+            return start + offset
+        return -1
+
+    def route_axes(self, nodes):
+        # Axis each node on a route must show: the axis of the link the route
+        # leaves by, or for the last node the link it arrives on. None when two
+        # consecutive nodes are not connected.
+        nodes = np.asarray(nodes, dtype=np.int64)
+        links = np.array([self.link_between(a, b) for a, b in zip(nodes[:-1], nodes[1:])],
+                         dtype=np.int64)
+        if (links < 0).any():
+            return None
+        axes = self.link_axis[links]
+        return np.append(axes, axes[-1]).astype(np.int8)
+
+    def upstream_links(self, axis):
+        # For every node, the link of the given axis arriving from the negative
+        # side (from the west for EW, from the north for NS), or -1 at the head
+        # of a corridor
+        delta = self.node_xy[self.link_target] - self.node_xy[self.link_source]
+        forward = (self.link_axis == axis) & (delta[:, 0 if axis == EW else 1] > 0)
+        upstream = np.full(self.num_nodes, -1, dtype=np.int64)
+        links = np.flatnonzero(forward)
+        upstream[self.link_target[links]] = links
+        return upstream
+
+    def tiles(self, count):
+        # Tile of every node: the bounding box is cut into columns x rows
+        # tiles, as square as the count allows, at node-count quantiles so
+        # tiles hold about the same number of nodes
+        rows = max(r for r in range(1, int(count ** 0.5) + 1) if count % r == 0)
+        columns = count // rows
+        x, y = self.node_xy[:, 0], self.node_xy[:, 1]
+        column = np.searchsorted(np.quantile(x, np.linspace(0, 1, columns + 1)[1:-1]), x, side='right')
+        row = np.searchsorted(np.quantile(y, np.linspace(0, 1, rows + 1)[1:-1]), y, side='right')
+        return (row * columns + column).astype(np.int32)
+
+    def random_links(self, nodes, rng):
+        # One uniformly chosen outgoing link per node in a single array op
+        return self.pick_links(nodes, rng.random(len(nodes)))
+
+    def pick_links(self, nodes, draws):
+        # Outgoing link of each node chosen by a uniform draw in [0, 1)
+        choice = (draws * self.degree[nodes]).astype(np.int64)
+        return self.indptr[nodes] + choice
+
+    def road_names(self):
+        return [(self.names[a], self.names[b]) for a, b in self.edges.tolist()]
+
+    def layout(self, width, height):
+        # Screen position of every node, spaced like the original grid layout
+        # with the typical road length as the grid step
+        unit = float(np.median(self.edge_length)) if self.num_edges else 1.0
+        xy = self.node_xy / (unit or 1.0)
+        lo = xy.min(axis=0)
+        span = xy.max(axis=0) - lo
+        step_x = width // (span[0] + 2)
+        step_y = height // (span[1] + 2)
+        xs = step_x * (xy[:, 0] - lo[0] + 1)
+        ys = step_y * (xy[:, 1] - lo[1] + 1)
+        return [(int(x), int(y)) for x, y in zip(xs, ys)]
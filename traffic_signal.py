@@ -1,20 +1,63 @@
-import pygame
+import argparse
 import random
-import networkx as nx
+import time
 from collections import defaultdict
-from constraint import Problem
+from collections.abc import Mapping
 
-# Initialize pygame
-pygame.init()
+import numpy as np
+
+from counter_rng import BULK, PEDESTRIANS, ROUTE, SPAWN, VEHICLE, hash64, uniform
+from metrics import TrafficMetrics
+from render_cache import CachedLayer, GlyphCache
+from road_network import make_topology
+from routing import NO_LINK, RouteCache
+from signal_plan import PLAN_KINDS, make_plan
+from signal_solver import BACKENDS, make_backend
+from topology import AXIS_NAMES, EW
+from vehicle_index import VehicleCounts, VehicleIndex
+from vehicle_store import ARRIVAL_PROGRESS, NO_DESTINATION, SPEED_FACTORS, TYPE_CODES, VEHICLE_TYPES, VehicleStore
+from viewport import DETAIL_SPACING, DETAIL_VEHICLES, INDEX_CELL, ZOOM_STEP, SpatialIndex, Viewport, rasterize_segments
+
+# pygame and python-constraint are imported on first use so the headless
+# engine runs on machines without a display or those packages
+pygame = None
+
+def load_pygame():
+    global pygame
+    if pygame is None:
+        import pygame as _pygame
+        _pygame.init()
+        pygame = _pygame
+    return pygame
 
 # Constants
 SCREEN_WIDTH, SCREEN_HEIGHT = 1920, 1080
+MAP_WIDTH = SCREEN_WIDTH - 300  # The stats panel takes the rest
 GRID_SIZE = 4  # For a 4x4 grid (16 intersections)
 INTERSECTION_SIZE = 60
 ROAD_WIDTH = 25
 FPS = 60
 VEHICLE_SPEED = 2  # Normalized speed
+EMERGENCY_SPEEDUP = 1.5  # Emergency vehicles drive this much faster than the others
 TRAFFIC_LIGHT_CHANGE_INTERVAL = 300  # 5 seconds at 60 FPS
+SPAWN_INTERVAL = 600  # 10 seconds at 60 FPS
+SPAWN_PROBABILITY = 0.1  # Chance per intersection to add vehicles on a spawn tick
+SPAWN_POOL = np.array([TYPE_CODES['car']] * 5 + [TYPE_CODES['bus']] * 2 + [TYPE_CODES['ambulance']])
+PEDESTRIAN_PROBABILITY = 0.2
+DEMAND_HOUR = 7  # Time of day at tick 0 with origin-destination demand, just before the morning peak
+DEFAULT_OPTIMIZER = 'incremental'  # 'constraint' selects the python-constraint reference
+OPTIMIZER_BUDGET = 0.005  # Seconds per background solve in the GUI, a third of a frame
+# 'event' jumps between events (event_engine), 'meso' models link densities
+# instead of individual vehicles (meso_engine), 'sharded' splits the city
+# over worker processes (sharded_engine)
+ENGINE_MODES = ('tick', 'event', 'meso', 'sharded')
+TYPE_STATS = {'car': 'cars', 'bus': 'buses', 'ambulance': 'emergency_vehicles'}
+PROFILE_TRACE = 'traffic_profile.prof'  # cProfile trace written by F4 in the GUI
+PROFILE_TRACE_TICKS = 600
+HEAT_CELL = 4  # Screen pixels per heatmap cell when zoomed out
+HEAT_SATURATION = 2.0  # Vehicles per lane at which a road shows fully red
+DIRTY_RECT_LIMIT = 1024  # More changed areas than this and the whole display is flipped
+PANEL_SIGNALS = 8  # Active signals listed in the stats panel
 
 # Colors
 WHITE = (255, 255, 255)
@@ -28,19 +71,75 @@ LIGHT_BLUE = (200, 230, 255)
 GREEN_WAVE = (0, 200, 0, 100)
 DARK_GREEN = (0, 150, 0)
 BRIGHT_RED = (255, 50, 50)
+HEAT_KEY = (255, 0, 255)  # Colour key of heatmap cells without a road
+NS_TILE = (0, 80, 200)  # Light-state tiles: which axis shows green
+EW_TILE = (255, 140, 0)
+
+class TrafficLightState:
+    # Dict-style view of one intersection's lights, backed by the city's arrays
+    __slots__ = ('city', 'index')
+    
+    def __init__(self, city, index):
+        self.city = city
+        self.index = index
+    
+    def __getitem__(self, key):
+        if key == 'timer':
+            return int(self.city.light_timer[self.index])
+        return 'green' if self.city.light_array(key)[self.index] else 'red'
+    
+    def __setitem__(self, key, value):
+        if key == 'timer':
+            self.city.light_timer[self.index] = value
+        else:
+            self.city.light_array(key)[self.index] = value == 'green'
+
+class TrafficLights(Mapping):
+    def __init__(self, city):
+        self.city = city
+    
+    def __getitem__(self, intersection):
+        return TrafficLightState(self.city, self.city.node_index[intersection])
+    
+    def __iter__(self):
+        return iter(self.city.intersections)
+    
+    def __len__(self):
+        return len(self.city.intersections)
 
 class CityGrid:
-    def __init__(self):
-        self.size = GRID_SIZE
-        self.intersections = [f'I{i+1}' for i in range(self.size*self.size)]
-        self.roads = self._create_road_network()
-        self.traffic_lights = {i: {'NS': 'red', 'EW': 'red', 'timer': 0} for i in self.intersections}
-        self.vehicles = defaultdict(list)
-        self.vehicle_positions = {}  # Track vehicle positions between intersections
-        self.vehicle_routes = {}
+    # size is the side of a square grid, or a road network: a RoadTopology or
+    # the path of a road network file or GeoJSON/CSV edge list (road_network)
+    def __init__(self, size=GRID_SIZE, vehicle_speed=None, spawn_probability=SPAWN_PROBABILITY,
+                 seed=None, track_ids=True, track_metrics=True):
+        self.size = size
+        self.vehicle_speed = VEHICLE_SPEED if vehicle_speed is None else vehicle_speed
+        self.spawn_probability = spawn_probability
+        self.tick = 0
+        self.topology = make_topology(size)
+        self.intersections = self.topology.names
+        self._roads = None
+        self._signal_labels = None
+        self._router = None
+        # Light states live in arrays so the whole fleet can be gated at once
+        self.light_ns = np.zeros(len(self.intersections), dtype=bool)
+        self.light_ew = np.zeros(len(self.intersections), dtype=bool)
+        self.light_timer = np.zeros(len(self.intersections), dtype=np.int32)
+        self.traffic_lights = TrafficLights(self)
+        self.signal_plan = None  # Fixed-time plan; None leaves lights to the optimizer
+        # Vehicle ids bucketed by the intersection they are leaving and by link;
+        # without track_ids only the counts are kept
+        index = VehicleIndex if track_ids else VehicleCounts
+        self.vehicles = index(self.topology.num_nodes, self.topology.num_links)
+        self.fleet = VehicleStore()  # Track vehicle positions between intersections
+        # Rolling queue, delay and throughput figures (see metrics), fed as
+        # vehicles enter and leave links and as lights change
+        self.metrics = TrafficMetrics(self.topology) if track_metrics else None
+        self.seed_rng(seed)
         self.pedestrians = defaultdict(int)
         self.emergency_route = []
         self.emergency_vehicle_pos = 0
+        self.emergency_started = 0
         self.stats = {
             'total_vehicles': 0,
             'cars': 0,
@@ -50,195 +149,499 @@ class CityGrid:
             'green_lights': 0,
             'red_lights': 0,
             'emergency_active': False,
-            'active_signals': []
+            'active_signals': [],
+            'arrivals': 0,  # Vehicles that completed a road segment
+            'travel_ticks': 0,  # Total ticks spent on completed segments
+            'trips': 0,  # Vehicles that reached their destination and left
+            'emergency_trips': 0,
+            'emergency_ticks': 0  # Total ticks taken by completed emergency routes
         }
         
     def _create_road_network(self):
-        roads = []
-        for row in range(self.size):
-            for col in range(self.size-1):
-                roads.append((f'I{row*self.size + col + 1}', f'I{row*self.size + col + 2}'))
-        for col in range(self.size):
-            for row in range(self.size-1):
-                roads.append((f'I{row*self.size + col + 1}', f'I{(row+1)*self.size + col + 1}'))
-        return roads
-    
-    def add_random_vehicles(self):
-        for intersection in self.intersections:
-            if random.random() < 0.1:  # 10% chance to add vehicles
-                vehicle_types = ['car']*5 + ['bus']*2 + ['ambulance']*1
-                vehicles = random.sample(vehicle_types, random.randint(1, 2))
-                self.vehicles[intersection].extend(vehicles)  # Use extend instead of direct assignment
-                
-                for vehicle in vehicles:
-                    vehicle_id = f"{intersection}_{vehicle}_{len([v for v in self.vehicles[intersection] if v == vehicle])}"
-                    possible_routes = [road for road in self.roads if intersection in road]
-                    if possible_routes:
-                        route = random.choice(possible_routes)
-                        next_intersection = route[0] if route[1] == intersection else route[1]
-                        self.vehicle_routes[vehicle_id] = (intersection, next_intersection)
-                        # Initialize vehicle positions
-                        self.vehicle_positions[vehicle_id] = {
-                            'current': intersection,
-                            'next': next_intersection,
-                            'progress': 0,
-                            'speed': VEHICLE_SPEED * (0.8 if vehicle == 'bus' else 1.2 if vehicle == 'ambulance' else 1.0)
-                        }
-                
-                self.stats['cars'] += vehicles.count('car')
-                self.stats['buses'] += vehicles.count('bus')
-                self.stats['emergency_vehicles'] += vehicles.count('ambulance')
-                self.stats['total_vehicles'] = self.stats['cars'] + self.stats['buses'] + self.stats['emergency_vehicles']
-    
-    def add_random_pedestrians(self):
-        for intersection in self.intersections:
-            if random.random() < 0.2:
-                pedestrians = random.randint(1, 3)
-                self.pedestrians[intersection] = pedestrians
-                self.stats['pedestrians'] += pedestrians
+        return self.topology.road_names()
+    
+    # Name-based views are built on first use, so large networks start fast
+    @property
+    def node_index(self):
+        return self.topology.index
+    
+    @property
+    def roads(self):
+        if self._roads is None:
+            self._roads = self._create_road_network()
+        return self._roads
+    
+    @property
+    def signal_labels(self):
+        if self._signal_labels is None:
+            self._signal_labels = np.array([[f"{name} NS", f"{name} EW"] for name in self.intersections],
+                                           dtype=object)
+        return self._signal_labels
+    
+    @property
+    def router(self):
+        # Shortest-path trees for vehicles with a destination and emergency routes
+        if self._router is None:
+            self._router = RouteCache(self.topology)
+        return self._router
+    
+    def update_route_costs(self, link_count=None):
+        # Congestion-weighted route costs from the vehicles on each link
+        self.router.update_costs(self.vehicles.link_count if link_count is None else link_count)
+    
+    def seed_rng(self, seed=None):
+        # Independent streams per simulation: one for emergencies, one for
+        # the vectorized draws of bulk spawns and the mesoscopic engine, and
+        # the key of the counter-based draws for spawning, pedestrians and
+        # routing. seed=None draws fresh entropy.
+        spawn_seed, route_seed, draw_seed = np.random.SeedSequence(seed).spawn(3)
+        self.seed = seed
+        self.random = random.Random(int(spawn_seed.generate_state(1, np.uint64)[0]))
+        self.np_random = np.random.default_rng(route_seed)
+        self.draw_key = int(draw_seed.generate_state(1, np.uint64)[0])
+    
+    def draws(self, stream, *counters):
+        # Uniform draws keyed by counters such as (node, tick), so they do not
+        # depend on which other nodes or vehicles drew before
+        return uniform(self.draw_key, stream, *counters)
+    
+    def light_array(self, direction):
+        return self.light_ns if direction == 'NS' else self.light_ew
+    
+    def random_links(self, nodes):
+        return self.topology.random_links(nodes, self.np_random)
+    
+    def queue_length(self, intersection, direction=None):
+        # Vehicles waiting to leave an intersection, optionally on one axis
+        node = self.node_index[intersection]
+        if direction is None:
+            return int(self.vehicles.node_count[node])
+        links = slice(self.topology.indptr[node], self.topology.indptr[node + 1])
+        on_axis = self.topology.link_axis[links] == AXIS_NAMES.index(direction)
+        return int(self.vehicles.link_count[links][on_axis].sum())
+    
+    def add_random_vehicles(self, nodes=None):
+        # Each intersection (of `nodes`, default all) adds one or two vehicles
+        # with the spawn probability, sampled without replacement from a pool
+        # of 5 cars, 2 buses and 1 ambulance. The draws are keyed by node and
+        # tick, so spawning part of the city gives the same vehicles there.
+        topology = self.topology
+        if nodes is None:
+            nodes = np.arange(topology.num_nodes)
+        draws = self.draws(SPAWN, np.asarray(nodes)[:, None], self.tick, np.arange(6))
+        spawning = draws[:, 0] < self.spawn_probability  # 10% chance by default
+        nodes, draws = np.asarray(nodes)[spawning], draws[spawning]
+        if not len(nodes):
+            return
+        
+        first = (draws[:, 2] * len(SPAWN_POOL)).astype(np.int64)
+        second = (draws[:, 3] * (len(SPAWN_POOL) - 1)).astype(np.int64)
+        second += second >= first
+        picked = SPAWN_POOL[np.stack([first, second], axis=1)]
+        wanted = np.stack([np.ones(len(nodes), dtype=bool), draws[:, 1] < 0.5], axis=1)
+        type_codes = picked[wanted]
+        self.count_vehicles(type_codes)
+        
+        # Vehicles at nodes without roads count as spawned but never move
+        rank = np.broadcast_to(np.arange(2), wanted.shape)[wanted]
+        vehicle_nodes = np.repeat(nodes, wanted.sum(axis=1))
+        link_draws = draws[:, 4:][wanted]
+        on_road = topology.degree[vehicle_nodes] > 0
+        vehicle_nodes, rank, type_codes = vehicle_nodes[on_road], rank[on_road], type_codes[on_road]
+        links = topology.pick_links(vehicle_nodes, link_draws[on_road])
+        keys = hash64(self.draw_key, VEHICLE, vehicle_nodes, self.tick, rank)
+        vehicle_ids = self.fleet.extend(type_codes, vehicle_nodes, topology.link_target[links], links,
+                                        self.vehicle_speed * SPEED_FACTORS[type_codes], self.tick, keys)
+        self.vehicles.insert_many(vehicle_ids, vehicle_nodes, links)
+        if self.metrics is not None:
+            self.metrics.enter(links, type_codes, self.tick + 1)
+    
+    def spawn_vehicles(self, nodes, type_codes):
+        # Bulk spawn: one vehicle per entry, each leaving its node on a random link
+        nodes = np.asarray(nodes, dtype=np.int64)
+        type_codes = np.asarray(type_codes, dtype=np.int8)
+        has_road = self.topology.degree[nodes] > 0
+        nodes, type_codes = nodes[has_road], type_codes[has_road]
+        links = self.random_links(nodes)
+        speeds = self.vehicle_speed * SPEED_FACTORS[type_codes]
+        keys = hash64(self.draw_key, BULK, nodes, self.tick, np.arange(len(nodes)))
+        vehicle_ids = self.fleet.extend(type_codes, nodes, self.topology.link_target[links], links,
+                                        speeds, self.tick, keys)
+        self.vehicles.insert_many(vehicle_ids, nodes, links)
+        if self.metrics is not None:
+            self.metrics.enter(links, type_codes, self.tick + 1)
+        self.count_vehicles(type_codes)
+        return self.fleet.handles(vehicle_ids)
+    
+    def add_trips(self, trips):
+        # Bulk insertion of the trips a DemandModel released this tick (see
+        # demand): each vehicle starts on its drawn first link and keeps its
+        # destination
+        type_codes = trips['type_code']
+        links = trips['link']
+        vehicle_ids = self.fleet.extend(type_codes, trips['origin'], self.topology.link_target[links], links,
+                                        self.vehicle_speed * SPEED_FACTORS[type_codes], self.tick, trips['key'],
+                                        trips['destination'])
+        self.vehicles.insert_many(vehicle_ids, trips['origin'], links)
+        if self.metrics is not None:
+            self.metrics.enter(links, type_codes, self.tick + 1)
+        self.count_vehicles(type_codes)
+    
+    def count_vehicles(self, type_codes, sign=1):
+        # Vehicle counts are of vehicles on the map: spawning adds them, and
+        # sign=-1 takes off vehicles that finished their trip or were despawned
+        counts = np.bincount(type_codes, minlength=len(VEHICLE_TYPES))
+        for vehicle_type, count in zip(VEHICLE_TYPES, counts.tolist()):
+            self.stats[TYPE_STATS[vehicle_type]] += sign * count
+        self.stats['total_vehicles'] = self.stats['cars'] + self.stats['buses'] + self.stats['emergency_vehicles']
+    
+    def despawn_vehicle(self, handle):
+        # Take a vehicle off the map; its handle stops resolving afterwards
+        fleet = self.fleet
+        vehicle_id = fleet.resolve(handle)
+        self.vehicles.remove(vehicle_id, int(fleet.current[vehicle_id]), int(fleet.link[vehicle_id]))
+        if self.metrics is not None:
+            self.metrics.leave(fleet.link[vehicle_id:vehicle_id + 1], fleet.type_code[vehicle_id:vehicle_id + 1],
+                               self.tick + 1, completed=False)
+        self.count_vehicles(fleet.type_code[vehicle_id:vehicle_id + 1], -1)
+        fleet.remove(vehicle_id)
+    
+    def add_random_pedestrians(self, nodes=None):
+        if nodes is None:
+            nodes = np.arange(self.topology.num_nodes)
+        draws = self.draws(PEDESTRIANS, np.asarray(nodes)[:, None], self.tick, np.arange(2))
+        walking = draws[:, 0] < PEDESTRIAN_PROBABILITY
+        counts = 1 + (draws[walking, 1] * 3).astype(np.int64)
+        for node, pedestrians in zip(np.asarray(nodes)[walking].tolist(), counts.tolist()):
+            self.pedestrians[self.intersections[node]] = pedestrians
+        self.stats['pedestrians'] += int(counts.sum())
     
     def set_emergency_route(self, start, end):
-        G = nx.Graph()
-        G.add_edges_from(self.roads)
-        try:
-            self.emergency_route = nx.shortest_path(G, start, end)
+        nodes = self.router.route(self.node_index[start], self.node_index[end])
+        self.emergency_route = [self.intersections[node] for node in nodes]
+        if self.emergency_route:
             self.emergency_vehicle_pos = 0
+            self.emergency_started = self.tick
             self.stats['emergency_active'] = True
-        except nx.NetworkXNoPath:
-            self.emergency_route = []
+        else:
             self.stats['emergency_active'] = False
+        if self.signal_plan is not None:
+            self.preempt_signal_plan()
+    
+    def preempt_signal_plan(self):
+        # Hold the emergency route's axes green on top of the fixed-time plan
+        self.signal_plan.clear_preemption()
+        if len(self.emergency_route) > 1:
+            nodes = [self.node_index[name] for name in self.emergency_route]
+            axes = self.topology.route_axes(nodes)
+            if axes is not None:
+                self.signal_plan.set_preemption(nodes, axes)
+    
+    @property
+    def emergency_step(self):
+        # Route nodes the emergency vehicle covers per tick; other vehicles
+        # take ARRIVAL_PROGRESS / vehicle_speed ticks per road
+        return self.vehicle_speed * EMERGENCY_SPEEDUP / ARRIVAL_PROGRESS
     
     def update_emergency_vehicle(self):
         if self.emergency_route and self.emergency_vehicle_pos < len(self.emergency_route)-1:
-            self.emergency_vehicle_pos += VEHICLE_SPEED * 1.5  # Emergency vehicles are faster
+            self.emergency_vehicle_pos += self.emergency_step
+            if self.emergency_vehicle_pos >= len(self.emergency_route)-1:
+                self.stats['emergency_trips'] += 1
+                self.stats['emergency_ticks'] += self.tick - self.emergency_started + 1
     
     def update_vehicle_positions(self):
-        vehicles_to_remove = []
+        self.tick += 1
+        fleet = self.fleet
+        if not fleet.count:
+            return
+        current = fleet.current[:fleet.count]
         
-        for vehicle_id, pos_info in list(self.vehicle_positions.items()):
-            current = pos_info['current']
-            next_intersection = pos_info['next']
-            
-            # Check if the traffic light allows movement
-            can_move = True
-            if current in self.traffic_lights:
-                # Determine direction
-                current_idx = self.intersections.index(current)
-                next_idx = self.intersections.index(next_intersection)
-                
-                if next_idx == current_idx + 1:  # Moving east
-                    can_move = self.traffic_lights[current]['EW'] == 'green'
-                elif next_idx == current_idx - 1:  # Moving west
-                    can_move = self.traffic_lights[current]['EW'] == 'green'
-                elif next_idx == current_idx + self.size:  # Moving south
-                    can_move = self.traffic_lights[current]['NS'] == 'green'
-                elif next_idx == current_idx - self.size:  # Moving north
-                    can_move = self.traffic_lights[current]['NS'] == 'green'
-            
-            if can_move:
-                pos_info['progress'] += pos_info['speed']
-                
-                # If vehicle reached next intersection
-                if pos_info['progress'] >= 100:
-                    vehicles_to_remove.append((vehicle_id, current, next_intersection))
-                    
-                    # Assign new route
-                    possible_routes = [road for road in self.roads if next_intersection in road]
-                    if possible_routes:
-                        route = random.choice(possible_routes)
-                        new_next = route[0] if route[1] == next_intersection else route[1]
-                        self.vehicle_routes[vehicle_id] = (next_intersection, new_next)
-                        self.vehicle_positions[vehicle_id] = {
-                            'current': next_intersection,
-                            'next': new_next,
-                            'progress': 0,
-                            'speed': pos_info['speed']
-                        }
-        
-        # Process vehicle movements after iteration to avoid modifying dict during iteration
-        for vehicle_id, current, next_intersection in vehicles_to_remove:
-            vehicle_type = vehicle_id.split('_')[1]
-            if vehicle_type in self.vehicles[current]:
-                self.vehicles[current].remove(vehicle_type)
-            self.vehicles[next_intersection].append(vehicle_type)
-    
-    def update_traffic_lights(self):
-        for intersection, lights in self.traffic_lights.items():
-            lights['timer'] += 1
-            if lights['timer'] >= TRAFFIC_LIGHT_CHANGE_INTERVAL:
-                lights['timer'] = 0
-                # Simple alternating pattern
-                if lights['NS'] == 'green':
-                    lights['NS'] = 'red'
-                    lights['EW'] = 'green'
-                else:
-                    lights['NS'] = 'green'
-                    lights['EW'] = 'red'
+        moving_ew = self.topology.link_axis[fleet.link[:fleet.count]] == EW
+        can_move = np.where(moving_ew, self.light_ew[current], self.light_ns[current])
+        arrived = fleet.advance(can_move)
+        if len(arrived):
+            self.complete_segments(arrived)
+    
+    def complete_segments(self, arrived):
+        # Vehicles (ascending ids) that reached their next intersection this
+        # tick: record the segment, take vehicles that reached their
+        # destination off the map and send the others on, along their route
+        # or, without a destination, a random link
+        fleet = self.fleet
+        departed = fleet.current[arrived]
+        old_links = fleet.link[arrived]
+        reached = fleet.next[arrived]
+        self.stats['arrivals'] += len(arrived)
+        self.stats['travel_ticks'] += int((self.tick - fleet.entered[arrived]).sum())
+        metrics = self.metrics
+        if metrics is not None:
+            type_codes = fleet.type_code[arrived]
+            metrics.leave(old_links, type_codes, self.tick + 1)
+        destinations = fleet.destination[arrived]
+        finished = destinations == reached
+        if finished.any():
+            self.stats['trips'] += int(finished.sum())
+            self.count_vehicles(fleet.type_code[arrived[finished]], -1)
+            self.vehicles.remove_many(arrived[finished], departed[finished], old_links[finished])
+            fleet.remove_many(arrived[finished])
+            going = ~finished
+            arrived, departed, old_links = arrived[going], departed[going], old_links[going]
+            reached, destinations = reached[going], destinations[going]
+            if metrics is not None:
+                type_codes = type_codes[going]
+        # Keyed by vehicle and tick, so the choice does not depend on which
+        # other vehicles arrived this tick
+        links = self.topology.pick_links(reached, self.draws(ROUTE, fleet.key[arrived], self.tick))
+        routed = np.flatnonzero(destinations != NO_DESTINATION)
+        if len(routed):
+            next_links = self.router.next_links(reached[routed], destinations[routed])
+            # Vehicles that cannot reach their destination keep wandering
+            known = next_links != NO_LINK
+            links[routed[known]] = next_links[known]
+        fleet.reroute(arrived, self.topology.link_target[links], links, self.tick)
+        self.vehicles.move_many(arrived, departed, old_links, reached, links)
+        if metrics is not None:
+            metrics.enter(links, type_codes, self.tick + 1)
+    
+    def update_traffic_lights(self, interval=TRAFFIC_LIGHT_CHANGE_INTERVAL):
+        if self.signal_plan is not None:
+            # Closed-form plan evaluation; stats only change at phase boundaries
+            ew = self.signal_plan.ew_green(self.tick)
+            if not np.array_equal(ew, self.light_ew):
+                self.light_ew[:] = ew
+                np.logical_not(ew, out=self.light_ns)
+                self.update_traffic_light_stats()
+            return
+        
+        self.light_timer += 1
+        expired = self.light_timer >= interval
+        if expired.any():
+            self.light_timer[expired] = 0
+            # Simple alternating pattern
+            was_ns = self.light_ns[expired]
+            self.light_ns[expired] = ~was_ns
+            self.light_ew[expired] = was_ns
         
         self.update_traffic_light_stats()
     
     def update_traffic_light_stats(self):
-        green = 0
-        red = 0
-        active_signals = []
-        for intersection in self.intersections:
-            if self.traffic_lights[intersection]['NS'] == 'green':
-                green += 1
-                active_signals.append(f"{intersection} NS")
-            else:
-                red += 1
-            if self.traffic_lights[intersection]['EW'] == 'green':
-                green += 1
-                active_signals.append(f"{intersection} EW")
-            else:
-                red += 1
-        self.stats['green_lights'] = green
-        self.stats['red_lights'] = red
-        self.stats['active_signals'] = active_signals
+        green = np.stack([self.light_ns, self.light_ew], axis=1)
+        self.stats['green_lights'] = int(green.sum())
+        self.stats['red_lights'] = green.size - self.stats['green_lights']
+        # Row-major order lists each intersection's NS signal before its EW one
+        self.stats['active_signals'] = self.signal_labels[green].tolist()
+        if self.metrics is not None:
+            # Lights take effect on the next tick's moves
+            self.metrics.set_lights(self.light_ns, self.light_ew, self.tick + 1)
 
 class TrafficOptimizer:
-    def __init__(self, city):
+    # Applies light plans from a pluggable backend (see signal_solver)
+    def __init__(self, city, backend=DEFAULT_OPTIMIZER):
         self.city = city
+        self.backend = make_backend(backend)
     
     def optimize_lights(self):
-        problem = Problem()
-        
-        for intersection in self.city.intersections:
-            problem.addVariable(f"{intersection}_NS", ['red', 'green'])
-            problem.addVariable(f"{intersection}_EW", ['red', 'green'])
-        
-        # Basic constraint: no conflicting green lights
-        for intersection in self.city.intersections:
-            problem.addConstraint(
-                lambda ns, ew: not (ns == 'green' and ew == 'green'),
-                (f"{intersection}_NS", f"{intersection}_EW")
-            )
-        
-        # Emergency route priority
-        if self.city.emergency_route:
-            for i in range(len(self.city.emergency_route)-1):
-                current = self.city.emergency_route[i]
-                next_node = self.city.emergency_route[i+1]
-                if int(next_node[1:]) - int(current[1:]) == 1:  # Moving east-west
-                    problem.addConstraint(lambda a: a == 'green', (f"{current}_EW",))
-                    problem.addConstraint(lambda a: a == 'green', (f"{next_node}_EW",))
-                else:  # Moving north-south
-                    problem.addConstraint(lambda a: a == 'green', (f"{current}_NS",))
-                    problem.addConstraint(lambda a: a == 'green', (f"{next_node}_NS",))
-        
-        solution = problem.getSolution()
-        if solution:
-            for intersection in self.city.intersections:
-                self.city.traffic_lights[intersection]['NS'] = solution[f"{intersection}_NS"]
-                self.city.traffic_lights[intersection]['EW'] = solution[f"{intersection}_EW"]
-                self.city.traffic_lights[intersection]['timer'] = 0  # Reset timer
-            
-            self.city.update_traffic_light_stats()
-            return True
+        return self.apply(self.backend.solve(self.city))
+    
+    def apply(self, plan):
+        if plan is None:
+            return False
+        
+        ns, ew = plan
+        self.city.light_ns[:] = ns
+        self.city.light_ew[:] = ew
+        self.city.light_timer[:] = 0  # Reset timer
+        self.city.update_traffic_light_stats()
+        return True
+    
+    # Plans are applied as soon as they are solved; AsyncTrafficOptimizer
+    # (async_optimizer) overrides these to hand over background results
+    def poll(self):
         return False
+    
+    def wait(self, timeout=None):
+        return False
+    
+    def close(self):
+        pass
+
+class SimulationEngine:
+    # Steps the city model without any display, as fast as the CPU allows
+    mode = 'tick'
+    track_ids = True  # Whether the city indexes which vehicles are where
+    track_metrics = True  # Whether the city keeps rolling traffic metrics
+    reports_ticks = False  # Whether run() reports its ticks to the profiler rather than going through step()
+    
+    def __init__(self, grid_size=GRID_SIZE, optimizer=DEFAULT_OPTIMIZER,
+                 light_interval=TRAFFIC_LIGHT_CHANGE_INTERVAL,
+                 spawn_probability=SPAWN_PROBABILITY, vehicle_speed=None, seed=None,
+                 setup=True, signal_plan=None, optimizer_budget=None, demand=None,
+                 demand_hour=DEMAND_HOUR):
+        self.city = CityGrid(grid_size, vehicle_speed, spawn_probability, seed, self.track_ids,
+                             self.track_metrics)
+        if optimizer_budget is None:
+            self.optimizer = TrafficOptimizer(self.city, optimizer)
+        else:
+            # Solves run on a worker thread and land on a later tick, so runs
+            # are no longer reproducible from the seed alone
+            from async_optimizer import AsyncTrafficOptimizer
+            self.optimizer = AsyncTrafficOptimizer(self.city, optimizer, optimizer_budget)
+        self.light_interval = light_interval
+        if signal_plan is not None:
+            # One cycle of a fixed-time plan spans two legacy light intervals
+            self.city.signal_plan = make_plan(signal_plan, self.city, 2 * light_interval)
+        self.demand = None
+        if demand is not None:
+            # Origin-destination trips released every tick replace the
+            # random spawns (see demand)
+            from demand import make_demand
+            self.demand = make_demand(demand, self.city, demand_hour)
+        self.time = 0
+        self.telemetry = None
+        self.profiler = None
+        if setup:
+            self.setup_simulation()
+    
+    def setup_simulation(self):
+        self.spawn_traffic()
+        self.release_demand()
+        
+        if self.city.random.random() < 0.3:
+            start, end = self.city.random.sample(self.city.intersections, 2)
+            self.city.set_emergency_route(start, end)
+        
+        if self.city.signal_plan is not None:
+            self.city.update_traffic_lights()
+        else:
+            self.optimizer.optimize_lights()
+            self.optimizer.wait()  # Start with a plan even when solving in the background
+    
+    def step(self):
+        self.time += 1
+        
+        # A signal plan is evaluated every tick; otherwise lights are updated
+        # and re-optimized at regular intervals
+        if self.city.signal_plan is not None:
+            self.city.update_traffic_lights()
+        else:
+            self.optimizer.poll()
+            if self.time % self.light_interval == 0:
+                self.city.update_traffic_lights(self.light_interval)
+                self.optimizer.optimize_lights()
+        if self.time % self.light_interval == 0:
+            # Routes follow congestion at the pace of the lights
+            self.city.update_route_costs()
+        
+        self.city.update_emergency_vehicle()
+        self.advance_traffic()
+        self.release_demand()
+        
+        if self.time % SPAWN_INTERVAL == 0:
+            self.spawn_traffic()
+        
+        if self.telemetry is not None and self.time % self.telemetry.interval == 0:
+            self.telemetry.record(self)
+    
+    def advance_traffic(self):
+        # Vehicle movement for one tick; other engines model traffic differently
+        self.city.update_vehicle_positions()
+    
+    def spawn_traffic(self):
+        if self.demand is None:
+            self.city.add_random_vehicles()
+        self.city.add_random_pedestrians()
+    
+    def release_demand(self):
+        if self.demand is not None:
+            trips = self.demand.release(self.city.draw_key, self.city.tick)
+            if len(trips['tick']):
+                self.add_trips(trips)
+    
+    def add_trips(self, trips):
+        self.city.add_trips(trips)
+    
+    def attach_telemetry(self, path=None, fmt='csv', **options):
+        from telemetry import TelemetryRecorder
+        self.telemetry = TelemetryRecorder(self.city, path, fmt, **options)
+        return self.telemetry
+    
+    def attach_profiler(self, profiler=None):
+        # Phase timers are wrapped around this engine's methods; without a
+        # profiler step() runs unwrapped
+        from profiler import Profiler
+        self.profiler = (profiler or Profiler()).attach(self)
+        return self.profiler
+    
+    def run(self, ticks):
+        for _ in range(ticks):
+            self.step()
+        return self.city.stats
+    
+    def close(self):
+        # Stop background workers, if the engine or its optimizer has any
+        self.optimizer.close()
+    
+    def metrics(self):
+        # Summary of a run for comparing scenarios
+        stats = self.city.stats
+        minutes = self.time / (FPS * 60)
+        return {
+            'ticks': self.time,
+            'vehicles': stats['total_vehicles'],
+            'arrivals': stats['arrivals'],
+            'throughput_per_min': stats['arrivals'] / minutes if minutes else 0.0,
+            'mean_travel_ticks': stats['travel_ticks'] / stats['arrivals'] if stats['arrivals'] else None,
+            'emergency_ticks': (stats['emergency_ticks'] / stats['emergency_trips']
+                                if stats['emergency_trips'] else None),
+        }
+
+def engine_class(mode='tick'):
+    if mode == 'event':
+        from event_engine import EventDrivenEngine
+        return EventDrivenEngine
+    if mode == 'meso':
+        from meso_engine import MesoscopicEngine
+        return MesoscopicEngine
+    if mode == 'sharded':
+        from sharded_engine import ShardedEngine
+        return ShardedEngine
+    if mode != 'tick':
+        raise ValueError(f"Unknown engine mode: {mode!r}")
+    return SimulationEngine
 
 class Simulation:
-    def __init__(self):
+    def __init__(self, grid_size=GRID_SIZE, optimizer=DEFAULT_OPTIMIZER, seed=None, profile=False,
+                 signal_plan=None, optimizer_budget=OPTIMIZER_BUDGET, demand=None, demand_hour=DEMAND_HOUR,
+                 engine=None):
+        load_pygame()
+        self.grid_size = grid_size
+        self.optimizer_name = optimizer
+        self.optimizer_budget = optimizer_budget
+        self.signal_plan = signal_plan
+        self.demand = demand
+        self.demand_hour = demand_hour
+        self.seed = seed
+        self.speed = 1  # Simulated seconds per second
+        self.layout_topology = None
+        self.node_array = None  # World position of every node
+        self.node_lookup = {}
+        # Pan and zoom, and what is in view, found through spatial indexes
+        self.viewport = Viewport(MAP_WIDTH, SCREEN_HEIGHT)
+        self.node_grid = None
+        self.edge_grid = None
+        self.spacing = 1.0  # Typical road length in world pixels
+        self.visible_nodes = np.empty(0, dtype=np.int64)
+        self.visible_edges = np.empty(0, dtype=np.int64)
+        self.detail = True  # Full intersections and vehicle icons, or the heatmap
+        self.dragging = False
+        self.dirty = []  # Screen areas drawn over the background last frame
+        self.drawn_key = None  # Background under the last frame
+        # Empty road grey through green and yellow to red; index 0 is no road
+        share = np.linspace(0, 1, 255)
+        stops = [0, 0.05, 0.5, 1]
+        heat = [np.interp(share, stops, channel) for channel in zip(GRAY, DARK_GREEN, YELLOW, RED)]
+        self.heat_colors = np.concatenate([[HEAT_KEY], np.stack(heat, axis=1)]).astype(np.uint8)
         self.screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
         pygame.display.set_caption("Smart City Traffic Simulation")
         self.clock = pygame.time.Clock()
@@ -246,57 +649,128 @@ class Simulation:
         self.big_font = pygame.font.SysFont('Arial', 28)
         self.vehicle_font = pygame.font.SysFont('Segoe UI Emoji', 24)
         self.signal_font = pygame.font.SysFont('Arial', 14, bold=True)
-        self.city = CityGrid()
-        self.optimizer = TrafficOptimizer(self.city)
-        self.time = 0
+        self.pulse_fonts = [pygame.font.SysFont('Segoe UI Emoji', size) for size in (24, 28)]
+        # Static parts of the frame are drawn once and blitted every frame
+        self.glyphs = GlyphCache()
+        self.background = CachedLayer(self.build_background)
+        self.route_surface = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT), pygame.SRCALPHA)
+        self.stats_panel = CachedLayer(self.build_stats_panel)
+        # The optimizer solves on a worker thread so frames never wait on it.
+        # An engine passed in, e.g. by the benchmark, is displayed instead.
+        if engine is None:
+            engine = SimulationEngine(grid_size, optimizer, seed=seed, signal_plan=signal_plan,
+                                      optimizer_budget=optimizer_budget, demand=demand,
+                                      demand_hour=demand_hour)
+        self.engine = engine
+        # Ticks run on their own thread; frames draw the snapshots it publishes
+        self.loop = self.make_loop()
+        self.frame = self.loop.current
+        self.profiler = None
+        if profile:
+            self.toggle_profiler()
         self.running = True
-        self.setup_simulation()
     
-    def setup_simulation(self):
-        self.city.add_random_vehicles()
-        self.city.add_random_pedestrians()
+    @property
+    def city(self):
+        return self.engine.city
+    
+    @property
+    def optimizer(self):
+        return self.engine.optimizer
+    
+    @property
+    def time(self):
+        return self.engine.time
+    
+    def make_loop(self):
+        from render_loop import SimulationLoop
+        return SimulationLoop(self.engine, self.speed)
+    
+    def toggle_profiler(self):
+        # Phase timers and the timing overlay; off means no wrapped methods.
+        # The engine's timers are attached on the simulation thread
+        if self.profiler is None:
+            from profiler import Profiler
+            self.profiler = Profiler().attach_simulation(self)
+            self.loop.call(self.engine.attach_profiler, self.profiler)
+        else:
+            self.loop.call(self.detach_profiler, self.engine, self.profiler)
+            self.profiler = None
+        return self.profiler
+    
+    def detach_profiler(self, engine, profiler):
+        profiler.detach()
+        engine.profiler = None
+    
+    def start_trace(self, path, ticks):
+        # cProfile only sees the thread that enables it, so the trace starts
+        # on the simulation thread
+        if self.profiler is None:
+            self.toggle_profiler()
+        self.loop.call(self.profiler.start_trace, path, ticks)
+    
+    def build_background(self):
+        # Sky, and in detail the visible roads, emergency route and
+        # intersection boxes; rebuilt only when the topology, the emergency
+        # route, the view or the level of detail changes
+        surface = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT)).convert()
+        surface.fill((220, 230, 240))
+        pygame.draw.rect(surface, (200, 220, 235), (0, 0, SCREEN_WIDTH, SCREEN_HEIGHT//2))
+        if not self.detail:
+            return surface
         
-        if random.random() < 0.3:
-            start, end = random.sample(self.city.intersections, 2)
-            self.city.set_emergency_route(start, end)
+        edges = self.frame.topology.edges
+        for start, end in edges[self.visible_edges].tolist():
+            self.draw_road(self.get_node_position(start), self.get_node_position(end), surface)
         
-        self.optimizer.optimize_lights()
+        self.draw_emergency_route_overlay(surface)
+        
+        for node in self.visible_nodes.tolist():
+            x, y = self.get_node_position(node)
+            self.draw_intersection_box(x, y, self.frame.intersections[node], surface)
+        return surface
     
-    def draw_intersection(self, x, y, intersection_id):
-        pygame.draw.rect(self.screen, LIGHT_BLUE, 
+    def draw_intersection_box(self, x, y, intersection_id, surface):
+        pygame.draw.rect(surface, LIGHT_BLUE, 
                          (x - INTERSECTION_SIZE//2, y - INTERSECTION_SIZE//2, 
                           INTERSECTION_SIZE, INTERSECTION_SIZE), border_radius=5)
-        pygame.draw.rect(self.screen, BLUE, 
+        pygame.draw.rect(surface, BLUE, 
                          (x - INTERSECTION_SIZE//2, y - INTERSECTION_SIZE//2, 
                           INTERSECTION_SIZE, INTERSECTION_SIZE), 2, border_radius=5)
         
-        label = self.big_font.render(intersection_id[1:], True, BLACK)
-        self.screen.blit(label, (x - label.get_width()//2, y - label.get_height()//2))
-        
+        # Grid intersections show their number; imported ones keep their name
+        grid_name = intersection_id[:1] == 'I' and intersection_id[1:].isdigit()
+        label = self.big_font.render(intersection_id[1:] if grid_name else intersection_id, True, BLACK)
+        surface.blit(label, (x - label.get_width()//2, y - label.get_height()//2))
+    
+    def draw_intersection(self, x, y, node):
+        ns_green = self.frame.light_ns[node]
+        ew_green = self.frame.light_ew[node]
         light_offset = INTERSECTION_SIZE//2 + 10
-        pygame.draw.rect(self.screen, BLACK, (x - 8, y - light_offset, 16, 25), border_radius=3)
+        drawn = [pygame.draw.rect(self.screen, BLACK, (x - 8, y - light_offset, 16, 25), border_radius=3)]
         pygame.draw.circle(self.screen, 
-                          DARK_GREEN if self.city.traffic_lights[intersection_id]['NS'] == 'green' else BRIGHT_RED,
+                          DARK_GREEN if ns_green else BRIGHT_RED,
                           (x, y - light_offset + 12), 8)
         
-        pygame.draw.rect(self.screen, BLACK, (x + light_offset - 20, y - 8, 25, 16), border_radius=3)
+        drawn.append(pygame.draw.rect(self.screen, BLACK, (x + light_offset - 20, y - 8, 25, 16), border_radius=3))
         pygame.draw.circle(self.screen, 
-                          DARK_GREEN if self.city.traffic_lights[intersection_id]['EW'] == 'green' else BRIGHT_RED,
+                          DARK_GREEN if ew_green else BRIGHT_RED,
                           (x + light_offset - 8, y), 8)
         
-        if self.city.traffic_lights[intersection_id]['NS'] == 'green':
-            text = self.signal_font.render("NS GREEN", True, DARK_GREEN)
-            self.screen.blit(text, (x - text.get_width()//2, y - light_offset - 20))
+        if ns_green:
+            text = self.glyphs.render(self.signal_font, "NS GREEN", DARK_GREEN)
+            drawn.append(self.screen.blit(text, (x - text.get_width()//2, y - light_offset - 20)))
         
-        if self.city.traffic_lights[intersection_id]['EW'] == 'green':
-            text = self.signal_font.render("EW GREEN", True, DARK_GREEN)
-            self.screen.blit(text, (x + light_offset + 5, y - text.get_height()//2))
+        if ew_green:
+            text = self.glyphs.render(self.signal_font, "EW GREEN", DARK_GREEN)
+            drawn.append(self.screen.blit(text, (x + light_offset + 5, y - text.get_height()//2)))
+        self.mark(drawn)
     
-    def draw_road(self, start_pos, end_pos):
-        pygame.draw.line(self.screen, GRAY, start_pos, end_pos, ROAD_WIDTH)
-        pygame.draw.line(self.screen, WHITE, start_pos, end_pos, 2)
+    def draw_road(self, start_pos, end_pos, surface):
+        pygame.draw.line(surface, GRAY, start_pos, end_pos, ROAD_WIDTH)
+        pygame.draw.line(surface, WHITE, start_pos, end_pos, 2)
     
-    def draw_vehicle(self, x, y, vehicle_type, destination=None, progress=0):
+    def draw_vehicle(self, x, y, vehicle_type, heading=None):
         if vehicle_type == 'car':
             icon = "🚗"
         elif vehicle_type == 'bus':
@@ -304,49 +778,50 @@ class Simulation:
         elif vehicle_type == 'ambulance':
             icon = "🚑"
         
-        text = self.vehicle_font.render(icon, True, BLACK)
-        shadow = self.vehicle_font.render(icon, True, (100, 100, 100))
-        self.screen.blit(shadow, (x - text.get_width()//2 + 2, y - text.get_height()//2 + 2))
-        self.screen.blit(text, (x - text.get_width()//2, y - text.get_height()//2))
+        text = self.glyphs.render(self.vehicle_font, icon, BLACK)
+        shadow = self.glyphs.render(self.vehicle_font, icon, (100, 100, 100))
+        drawn = [self.screen.blit(shadow, (x - text.get_width()//2 + 2, y - text.get_height()//2 + 2)),
+                 self.screen.blit(text, (x - text.get_width()//2, y - text.get_height()//2))]
         
-        if destination:
-            dest_pos = self.get_intersection_position(destination)
-            dx = dest_pos[0] - x
-            dy = dest_pos[1] - y
+        if heading is not None:
+            # Arrow towards the screen position the vehicle is heading for
+            dx = heading[0] - x
+            dy = heading[1] - y
             angle = pygame.math.Vector2(dx, dy).angle_to((1, 0))
             
             arrow_length = 30
             end_x = x + arrow_length * pygame.math.Vector2(1, 0).rotate(-angle).x
             end_y = y + arrow_length * pygame.math.Vector2(1, 0).rotate(-angle).y
             
-            pygame.draw.line(self.screen, GREEN, (x, y), (end_x, end_y), 2)
-            pygame.draw.circle(self.screen, GREEN, (int(end_x), int(end_y)), 4)
-    
-    def draw_moving_vehicle(self, vehicle_id, vehicle_type, start_pos, end_pos, progress):
-        x = start_pos[0] + (end_pos[0] - start_pos[0]) * (progress / 100)
-        y = start_pos[1] + (end_pos[1] - start_pos[1]) * (progress / 100)
-        self.draw_vehicle(x, y, vehicle_type)
+            drawn.append(pygame.draw.line(self.screen, GREEN, (x, y), (end_x, end_y), 2))
+            drawn.append(pygame.draw.circle(self.screen, GREEN, (int(end_x), int(end_y)), 4))
+        self.mark(drawn)
     
     def draw_pedestrians(self, x, y, count):
+        drawn = []
         for i in range(count):
             row = i // 2
             col = i % 2
             ped_x = x - 20 + col * 25
             ped_y = y + 20 + row * 25
-            text = self.vehicle_font.render("🚶", True, BLACK)
-            shadow = self.vehicle_font.render("🚶", True, (100, 100, 100))
-            self.screen.blit(shadow, (ped_x - text.get_width()//2 + 1, ped_y - text.get_height()//2 + 1))
-            self.screen.blit(text, (ped_x - text.get_width()//2, ped_y - text.get_height()//2))
+            text = self.glyphs.render(self.vehicle_font, "🚶", BLACK)
+            shadow = self.glyphs.render(self.vehicle_font, "🚶", (100, 100, 100))
+            drawn.append(self.screen.blit(shadow, (ped_x - text.get_width()//2 + 1, ped_y - text.get_height()//2 + 1)))
+            drawn.append(self.screen.blit(text, (ped_x - text.get_width()//2, ped_y - text.get_height()//2)))
+        self.mark(drawn)
     
-    def draw_emergency_route(self):
-        if not self.city.emergency_route:
+    def draw_emergency_route_overlay(self, surface):
+        route = self.frame.emergency_route
+        if not route:
             return
         
-        route_surface = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT), pygame.SRCALPHA)
+        # The translucent overlay surface is reused between rebuilds
+        route_surface = self.route_surface
+        route_surface.fill((0, 0, 0, 0))
         
-        for i in range(len(self.city.emergency_route)-1):
-            start_pos = self.get_intersection_position(self.city.emergency_route[i])
-            end_pos = self.get_intersection_position(self.city.emergency_route[i+1])
+        for i in range(len(route)-1):
+            start_pos = self.get_intersection_position(route[i])
+            end_pos = self.get_intersection_position(route[i+1])
             
             dx = end_pos[0] - start_pos[0]
             dy = end_pos[1] - start_pos[1]
@@ -363,68 +838,101 @@ class Simulation:
                                    (end_pos[0] + offset_x, end_pos[1] + offset_y), 
                                    3)
         
-        self.screen.blit(route_surface, (0, 0))
+        surface.blit(route_surface, (0, 0))
+    
+    def draw_emergency_route(self, previous=None, alpha=1.0):
+        route = self.frame.emergency_route
+        if not route:
+            return
         
-        if self.city.emergency_vehicle_pos < len(self.city.emergency_route):
-            idx = int(self.city.emergency_vehicle_pos)
-            progress = self.city.emergency_vehicle_pos - idx
+        position = self.frame.emergency_position(previous, alpha)
+        if position < len(route):
+            idx = int(position)
+            progress = position - idx
             
-            if idx < len(self.city.emergency_route)-1:
-                start_pos = self.get_intersection_position(self.city.emergency_route[idx])
-                end_pos = self.get_intersection_position(self.city.emergency_route[idx+1])
+            if idx < len(route)-1:
+                start_pos = self.get_intersection_position(route[idx])
+                end_pos = self.get_intersection_position(route[idx+1])
                 
                 vehicle_x = start_pos[0] + (end_pos[0] - start_pos[0]) * progress
                 vehicle_y = start_pos[1] + (end_pos[1] - start_pos[1]) * progress
                 
                 pulse = int(pygame.time.get_ticks() / 200) % 2
-                size = 28 if pulse else 24
-                font = pygame.font.SysFont('Segoe UI Emoji', size)
-                text = font.render("🚑", True, (255, 50, 50))
-                self.screen.blit(text, (vehicle_x - text.get_width()//2, vehicle_y - text.get_height()//2))
+                text = self.glyphs.render(self.pulse_fonts[pulse], "🚑", (255, 50, 50))
+                self.mark([self.screen.blit(text, (vehicle_x - text.get_width()//2, vehicle_y - text.get_height()//2))])
                 
-                route_text = self.font.render(f"Emergency Route: {self.city.emergency_route[idx]} → {self.city.emergency_route[idx+1]}", True, BRIGHT_RED)
-                self.screen.blit(route_text, (20, SCREEN_HEIGHT - 30))
+                route_text = self.glyphs.render(self.font, f"Emergency Route: {route[idx]} → {route[idx+1]}", BRIGHT_RED)
+                self.mark([self.screen.blit(route_text, (20, SCREEN_HEIGHT - 30))])
+    
+    def update_layout(self):
+        # World positions, the spatial indexes and the zoom range are set up
+        # once per topology; the whole city fits the map area at zoom 1
+        topology = self.frame.topology
+        if self.layout_topology is not topology:
+            self.node_array = np.array(topology.layout(MAP_WIDTH, SCREEN_HEIGHT), dtype=np.float64).reshape(-1, 2)
+            self.node_lookup = topology.index
+            ends = self.node_array[topology.edges]
+            lengths = np.linalg.norm(ends[:, 1] - ends[:, 0], axis=1)
+            self.spacing = float(np.median(lengths)) if len(lengths) else float(MAP_WIDTH)
+            cell = INDEX_CELL * max(self.spacing, 1.0)
+            self.node_grid = SpatialIndex(np.concatenate([self.node_array, self.node_array], axis=1), cell)
+            self.edge_grid = SpatialIndex(np.concatenate([ends.min(axis=1), ends.max(axis=1)], axis=1), cell)
+            self.viewport.fit(self.spacing)
+            self.layout_topology = topology
+    
+    def get_node_position(self, node):
+        self.update_layout()
+        x, y = self.viewport.to_screen(self.node_array[node])
+        return int(x), int(y)
     
     def get_intersection_position(self, intersection_id):
-        idx = self.city.intersections.index(intersection_id)
-        row = idx // self.city.size
-        col = idx % self.city.size
+        self.update_layout()
+        return self.get_node_position(self.node_lookup[intersection_id])
+    
+    def mark(self, drawn):
+        # Remember the area of one drawn item so the next frame can restore it
+        if drawn:
+            self.dirty.append(drawn[0].unionall(drawn[1:]))
+    
+    def build_stats_panel(self):
+        panel_width = 260
+        panel_height = SCREEN_HEIGHT - 40
+        surface = pygame.Surface((panel_width, panel_height), pygame.SRCALPHA)
         
-        x = (SCREEN_WIDTH - 300) // (self.city.size + 1) * (col + 1)
-        y = SCREEN_HEIGHT // (self.city.size + 1) * (row + 1)
+        pygame.draw.rect(surface, (245, 245, 245), (0, 0, panel_width, panel_height), border_radius=10)
+        pygame.draw.rect(surface, (70, 70, 70), (0, 0, panel_width, panel_height), 2, border_radius=10)
         
-        return (x, y)
+        title = self.big_font.render("Traffic Stats", True, (0, 80, 150))
+        pygame.draw.rect(surface, (220, 230, 240), 
+                         (panel_width//2 - title.get_width()//2 - 10, 5, 
+                          title.get_width() + 20, title.get_height() + 10), border_radius=5)
+        surface.blit(title, (panel_width//2 - title.get_width()//2, 10))
+        return surface
     
     def draw_stats_panel(self):
         panel_x = SCREEN_WIDTH - 280
         panel_y = 20
         panel_width = 260
-        panel_height = SCREEN_HEIGHT - 40
         
-        pygame.draw.rect(self.screen, (245, 245, 245), (panel_x, panel_y, panel_width, panel_height), border_radius=10)
-        pygame.draw.rect(self.screen, (70, 70, 70), (panel_x, panel_y, panel_width, panel_height), 2, border_radius=10)
-        
-        title = self.big_font.render("Traffic Stats", True, (0, 80, 150))
-        pygame.draw.rect(self.screen, (220, 230, 240), 
-                         (panel_x + panel_width//2 - title.get_width()//2 - 10, panel_y + 5, 
-                          title.get_width() + 20, title.get_height() + 10), border_radius=5)
-        self.screen.blit(title, (panel_x + panel_width//2 - title.get_width()//2, panel_y + 10))
+        self.mark([self.screen.blit(self.stats_panel.get(None), (panel_x, panel_y))])
         
+        city_stats = self.frame.stats
+        now = self.frame.time
         y_offset = 60
         stats = [
-            ("Time", f"{self.time//3600:02d}:{(self.time%3600)//60:02d}:{self.time%60:02d}"),
-            ("Total Vehicles", self.city.stats['total_vehicles']),
-            ("Cars", self.city.stats['cars']),
-            ("Buses", self.city.stats['buses']),
-            ("Ambulances", self.city.stats['emergency_vehicles']),
-            ("Pedestrians", self.city.stats['pedestrians']),
-            ("Green Lights", self.city.stats['green_lights']),
-            ("Red Lights", self.city.stats['red_lights']),
-            ("Emergency", "ACTIVE" if self.city.stats['emergency_active'] else "None")
+            ("Time", f"{now//3600:02d}:{(now%3600)//60:02d}:{now%60:02d}"),
+            ("Total Vehicles", city_stats['total_vehicles']),
+            ("Cars", city_stats['cars']),
+            ("Buses", city_stats['buses']),
+            ("Ambulances", city_stats['emergency_vehicles']),
+            ("Pedestrians", city_stats['pedestrians']),
+            ("Green Lights", city_stats['green_lights']),
+            ("Red Lights", city_stats['red_lights']),
+            ("Emergency", "ACTIVE" if city_stats['emergency_active'] else "None")
         ]
         
         for label, value in stats:
-            label_text = self.font.render(f"{label}:", True, (0, 0, 0))
+            label_text = self.glyphs.render(self.font, f"{label}:", (0, 0, 0))
             self.screen.blit(label_text, (panel_x + 15, panel_y + y_offset))
             
             color = (0, 100, 0) if label == "Green Lights" else \
@@ -432,23 +940,49 @@ class Simulation:
                    (200, 0, 0) if label == "Emergency" and value == "ACTIVE" else \
                    (0, 0, 0)
             
-            value_text = self.font.render(str(value), True, color)
+            value_text = self.glyphs.render(self.font, str(value), color)
             self.screen.blit(value_text, (panel_x + panel_width - 15 - value_text.get_width(), panel_y + y_offset))
             
             y_offset += 32
         
+        traffic = self.frame.metrics
+        if traffic is not None:
+            y_offset += 20
+            traffic_title = self.glyphs.render(self.font, "Last Minute:", (0, 80, 150))
+            self.screen.blit(traffic_title, (panel_x + 15, panel_y + y_offset))
+            y_offset += 30
+            
+            mean_wait = traffic['mean_wait']
+            rows = [
+                ("Waiting at Red", str(traffic['queued'])),
+                ("Red Wait/Vehicle", "-" if mean_wait is None else f"{mean_wait / FPS:.1f}s"),
+                ("Throughput/min", f"{traffic['throughput_per_min']:.0f}"),
+                ("Ambulance Delay", f"{traffic['emergency_delay'] / FPS:.0f}s"),
+            ]
+            for label, value in rows:
+                self.screen.blit(self.glyphs.render(self.font, label, BLACK), (panel_x + 20, panel_y + y_offset))
+                value_text = self.glyphs.render(self.font, value, BLACK)
+                self.screen.blit(value_text, (panel_x + panel_width - 15 - value_text.get_width(), panel_y + y_offset))
+                y_offset += 25
+        
         y_offset += 20
-        signals_title = self.font.render("Active Signals:", True, (0, 80, 150))
+        signals_title = self.glyphs.render(self.font, "Active Signals:", (0, 80, 150))
         self.screen.blit(signals_title, (panel_x + 15, panel_y + y_offset))
         y_offset += 30
         
-        for signal in self.city.stats['active_signals']:
-            signal_text = self.font.render(signal, True, DARK_GREEN)
+        # Large cities list only as many signals as a small grid has
+        signals = city_stats['active_signals']
+        for signal in signals[:PANEL_SIGNALS]:
+            signal_text = self.glyphs.render(self.font, signal, DARK_GREEN)
             self.screen.blit(signal_text, (panel_x + 20, panel_y + y_offset))
             y_offset += 25
+        if len(signals) > PANEL_SIGNALS:
+            more_text = self.glyphs.render(self.font, f"... and {len(signals) - PANEL_SIGNALS} more", DARK_GREEN)
+            self.screen.blit(more_text, (panel_x + 20, panel_y + y_offset))
+            y_offset += 25
         
         y_offset += 20
-        legend_title = self.font.render("Vehicle Legend:", True, (0, 80, 150))
+        legend_title = self.glyphs.render(self.font, "Vehicle Legend:", (0, 80, 150))
         self.screen.blit(legend_title, (panel_x + 15, panel_y + y_offset))
         y_offset += 30
         
@@ -466,119 +1000,350 @@ class Simulation:
                                (panel_x + 40, panel_y + y_offset + 10), 2)
                 pygame.draw.circle(self.screen, GREEN, (panel_x + 45, panel_y + y_offset + 10), 4)
             else:
-                icon_text = self.vehicle_font.render(icon, True, BLACK)
+                icon_text = self.glyphs.render(self.vehicle_font, icon, BLACK)
                 self.screen.blit(icon_text, (panel_x + 20, panel_y + y_offset))
             
-            text_text = self.font.render(text, True, BLACK)
+            text_text = self.glyphs.render(self.font, text, BLACK)
             self.screen.blit(text_text, (panel_x + 50, panel_y + y_offset))
             
             y_offset += 35
     
+    def draw_timings(self):
+        # Profiler overlay in its own box at the bottom left of the map, as
+        # the stats panel has no room left for it
+        timings = sorted(self.profiler.per_frame().items(), key=lambda item: -item[1])
+        width = 260
+        height = 45 + 22 * len(timings)
+        x, y = 15, SCREEN_HEIGHT - height - 15
+        self.mark([pygame.draw.rect(self.screen, (245, 245, 245), (x, y, width, height), border_radius=5)])
+        pygame.draw.rect(self.screen, (70, 70, 70), (x, y, width, height), 2, border_radius=5)
+        
+        timing_title = self.glyphs.render(self.font, "Frame Timing (ms):", (0, 80, 150))
+        self.screen.blit(timing_title, (x + 10, y + 10))
+        y += 40
+        for phase, ms in timings:
+            phase_text = self.glyphs.render(self.font, phase, BLACK)
+            self.screen.blit(phase_text, (x + 15, y))
+            ms_text = self.font.render(f"{ms:.2f}", True, BLACK)
+            self.screen.blit(ms_text, (x + width - 10 - ms_text.get_width(), y))
+            y += 22
+    
     def draw_time(self):
-        hours = self.time // 3600
-        minutes = (self.time % 3600) // 60
-        seconds = self.time % 60
+        now = self.frame.time
+        hours = now // 3600
+        minutes = (now % 3600) // 60
+        seconds = now % 60
         time_text = f"{hours:02d}:{minutes:02d}:{seconds:02d}"
         
-        pygame.draw.rect(self.screen, (230, 240, 255), (15, 15, 150, 40), border_radius=5)
+        self.mark([pygame.draw.rect(self.screen, (230, 240, 255), (15, 15, 150, 40), border_radius=5)])
         pygame.draw.rect(self.screen, (0, 80, 150), (15, 15, 150, 40), 2, border_radius=5)
         
-        text = self.big_font.render(time_text, True, (0, 80, 150))
+        text = self.glyphs.render(self.big_font, time_text, (0, 80, 150))
         self.screen.blit(text, (20, 20))
     
     def handle_events(self):
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 self.running = False
+            elif event.type == pygame.MOUSEWHEEL:
+                x, y = pygame.mouse.get_pos()
+                self.viewport.zoom_at(x, y, ZOOM_STEP ** event.y)
+            elif event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
+                self.dragging = event.pos[0] < MAP_WIDTH
+            elif event.type == pygame.MOUSEBUTTONUP and event.button == 1:
+                self.dragging = False
+            elif event.type == pygame.MOUSEMOTION and self.dragging:
+                self.viewport.pan(*event.rel)
             elif event.type == pygame.KEYDOWN:
                 if event.key == pygame.K_r:
-                    self.city = CityGrid()
-                    self.optimizer = TrafficOptimizer(self.city)
-                    self.setup_simulation()
-                    self.time = 0
+                    self.loop.stop()
+                    self.optimizer.close()
+                    self.engine = SimulationEngine(self.grid_size, self.optimizer_name, seed=self.seed,
+                                                   signal_plan=self.signal_plan,
+                                                   optimizer_budget=self.optimizer_budget,
+                                                   demand=self.demand, demand_hour=self.demand_hour)
+                    self.loop = self.make_loop()
+                    if self.profiler is not None:
+                        self.profiler.detach()
+                        self.profiler.attach_simulation(self)
+                        self.loop.call(self.engine.attach_profiler, self.profiler)
+                    self.loop.start()
+                elif event.key == pygame.K_F3:
+                    self.toggle_profiler()
+                elif event.key == pygame.K_F4:
+                    self.start_trace(PROFILE_TRACE, PROFILE_TRACE_TICKS)
                 elif event.key == pygame.K_SPACE:
-                    self.running = not self.running
-                elif event.key == pygame.K_UP:
-                    global VEHICLE_SPEED
-                    VEHICLE_SPEED = min(5, VEHICLE_SPEED + 0.5)
-                elif event.key == pygame.K_DOWN:
-                    VEHICLE_SPEED = max(0.5, VEHICLE_SPEED - 0.5)
-    
-    def update(self):
-        if self.running:
-            self.time += 1
-            
-            # Update traffic lights at regular intervals
-            if self.time % TRAFFIC_LIGHT_CHANGE_INTERVAL == 0:
-                self.city.update_traffic_lights()
-                self.optimizer.optimize_lights()
-            
-            self.city.update_emergency_vehicle()
-            self.city.update_vehicle_positions()
-            
-            if self.time % 600 == 0:  # Every 10 seconds
-                self.city.add_random_vehicles()
-                self.city.add_random_pedestrians()
+                    self.loop.paused = not self.loop.paused
+                elif event.key == pygame.K_HOME:
+                    self.viewport.reset()
+                elif event.key in (pygame.K_UP, pygame.K_DOWN):
+                    # Faster runs more ticks per frame instead of moving
+                    # vehicles further per tick
+                    from render_loop import SIMULATION_SPEEDS
+                    step = 1 if event.key == pygame.K_UP else -1
+                    index = SIMULATION_SPEEDS.index(self.speed) + step
+                    self.speed = SIMULATION_SPEEDS[min(max(index, 0), len(SIMULATION_SPEEDS) - 1)]
+                    self.loop.speed = self.speed
     
     def draw(self):
-        self.screen.fill((220, 230, 240))
-        pygame.draw.rect(self.screen, (200, 220, 235), (0, 0, SCREEN_WIDTH, SCREEN_HEIGHT//2))
+        # The latest two snapshots, with vehicles placed between them
+        previous, frame, alpha = self.loop.latest()
+        self.frame = frame
+        self.update_layout()
+        topology = frame.topology
+        viewport = self.viewport
         
-        # Draw roads
-        for road in self.city.roads:
-            start_pos = self.get_intersection_position(road[0])
-            end_pos = self.get_intersection_position(road[1])
-            self.draw_road(start_pos, end_pos)
+        # Only what is in view is drawn. Intersections get a margin so lights
+        # and queues just off screen still show. Zoomed out, or with too many
+        # vehicles in view, the roads become a density heatmap
+        self.visible_nodes = self.node_grid.query(*viewport.world_rect(INTERSECTION_SIZE))
+        self.visible_edges = self.edge_grid.query(*viewport.world_rect(ROAD_WIDTH))
+        in_view = int(frame.edge_counts(self.visible_edges).sum())
+        self.detail = self.spacing * viewport.zoom >= DETAIL_SPACING and in_view <= DETAIL_VEHICLES
         
-        self.draw_emergency_route()
+        # Roads, the emergency route and intersection boxes come from the
+        # cache. While it is unchanged only the areas drawn over last frame
+        # are restored and sent to the display
+        background_key = (topology, frame.emergency_route, viewport.key, self.detail)
+        background = self.background.get(background_key)
+        partial = self.detail and background_key == self.drawn_key
+        if partial:
+            for rect in self.dirty:
+                self.screen.blit(background, rect, rect)
+        else:
+            self.screen.blit(background, (0, 0))
+        restored, self.dirty = self.dirty, []
         
-        # Draw intersections and vehicles
-        for intersection in self.city.intersections:
-            x, y = self.get_intersection_position(intersection)
-            self.draw_intersection(x, y, intersection)
-            
-            # Draw vehicles at intersections
-            for i, vehicle in enumerate(self.city.vehicles[intersection]):
-                vehicle_id = f"{intersection}_{vehicle}_{i}"
-                offset_x = -20 + (i % 2) * 40
-                offset_y = -20 + (i // 2) * 40
-                
-                destination = None
-                if vehicle_id in self.city.vehicle_routes:
-                    _, destination = self.city.vehicle_routes[vehicle_id]
-                
-                self.draw_vehicle(x + offset_x, y + offset_y, vehicle, destination)
-            
-            # Draw moving vehicles between intersections
-            for vehicle_id, pos_info in self.city.vehicle_positions.items():
-                if pos_info['current'] == intersection:
-                    start_pos = self.get_intersection_position(pos_info['current'])
-                    end_pos = self.get_intersection_position(pos_info['next'])
-                    self.draw_moving_vehicle(vehicle_id, vehicle_id.split('_')[1], 
-                                           start_pos, end_pos, pos_info['progress'])
-            
-            # Draw pedestrians
-            if self.city.pedestrians[intersection] > 0:
-                self.draw_pedestrians(x, y, self.city.pedestrians[intersection])
+        if not self.detail:
+            self.draw_heatmap()
+        self.draw_emergency_route(previous, alpha)
+        if self.detail:
+            # Vehicles are looked up by link, on the roads in view only
+            vehicles = frame.on_links(topology.edge_links[self.visible_edges].ravel())
+            self.draw_details(vehicles, previous, alpha)
         
         self.draw_stats_panel()
         self.draw_time()
+        if self.profiler is not None:
+            self.draw_timings()
         
-        # Display current speed
-        speed_text = self.font.render(f"Speed: {VEHICLE_SPEED:.1f}x (UP/DOWN to adjust)", True, BLACK)
-        self.screen.blit(speed_text, (20, 70))
+        # Display the simulation speed
+        paused = " - PAUSED" if self.loop.paused else ""
+        speed_text = self.glyphs.render(self.font, f"Speed: {self.speed:g}x (UP/DOWN to adjust){paused}", BLACK)
+        self.mark([self.screen.blit(speed_text, (20, 70))])
         
-        pygame.display.flip()
+        if partial and len(restored) + len(self.dirty) <= DIRTY_RECT_LIMIT:
+            pygame.display.update(restored + self.dirty)
+        else:
+            pygame.display.flip()
+        self.drawn_key = background_key
     
-    def run(self):
-        while self.running:
-            self.handle_events()
-            self.update()
-            self.draw()
-            self.clock.tick(FPS)
+    def draw_details(self, vehicles, previous, alpha):
+        # Lights, queues, vehicle icons and pedestrians of what is in view
+        frame = self.frame
+        viewport = self.viewport
+        nodes = self.visible_nodes
+        screen_xy = viewport.to_screen(self.node_array[nodes]).astype(np.int64)
+        for node, (x, y) in zip(nodes.tolist(), screen_xy.tolist()):
+            self.draw_intersection(x, y, node)
+        
+        # Vehicles leaving each intersection queue up beside it, with an arrow
+        # to where they are heading, and also drive along their road
+        current = frame.current[vehicles]
+        order = np.argsort(current, kind='stable')
+        leaving = current[order]
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order)) - np.searchsorted(leaving, leaving)
+        queued = viewport.to_screen(self.node_array[current])
+        queued += np.stack([-20 + (rank % 2) * 40, -20 + (rank // 2) * 40], axis=1)
+        heading = viewport.to_screen(self.node_array[frame.next[vehicles]])
+        moving = viewport.to_screen(frame.vehicle_positions(self.node_array, previous, alpha, vehicles))
+        for i, type_code in enumerate(frame.type_code[vehicles].tolist()):
+            vehicle_type = VEHICLE_TYPES[type_code]
+            x, y = queued[i]
+            self.draw_vehicle(x, y, vehicle_type, heading[i])
+            x, y = moving[i]
+            self.draw_vehicle(x, y, vehicle_type)
+        
+        for node, (x, y) in zip(nodes.tolist(), screen_xy.tolist()):
+            count = frame.pedestrians.get(frame.intersections[node], 0)
+            if count > 0:
+                self.draw_pedestrians(x, y, count)
+    
+    def draw_heatmap(self):
+        # Roads in view coloured by vehicles per lane, on a grid of HEAT_CELL
+        # pixel cells, with a tile per intersection showing which axis is
+        # green once intersections are far enough apart. The work follows
+        # the cells and the roads in view, not the size of the city
+        frame = self.frame
+        topology = frame.topology
+        viewport = self.viewport
+        shape = (MAP_WIDTH // HEAT_CELL, SCREEN_HEIGHT // HEAT_CELL)
+        edges = self.visible_edges
+        ends = viewport.to_screen(self.node_array[topology.edges[edges]])
+        density = frame.edge_counts(edges) / (2 * topology.edge_lanes[edges])
+        grid = rasterize_segments(ends[:, 0], ends[:, 1], density, shape, HEAT_CELL)
+        level = np.where(grid < 0, 0, 1 + np.minimum(grid / HEAT_SATURATION, 1) * 254)
+        cells = self.heat_colors[level.astype(np.int64)]
+        
+        tile = int(self.spacing * viewport.zoom / (3 * HEAT_CELL))
+        if tile >= 1:
+            nodes = self.visible_nodes
+            centre = (viewport.to_screen(self.node_array[nodes]) // HEAT_CELL).astype(np.int64)
+            offsets = np.arange(tile) - tile // 2
+            xs = np.broadcast_to(centre[:, 0, None, None] + offsets[:, None], (len(nodes), tile, tile))
+            ys = np.broadcast_to(centre[:, 1, None, None] + offsets, (len(nodes), tile, tile))
+            colors = np.where(frame.light_ns[nodes][:, None], NS_TILE, EW_TILE).astype(np.uint8)
+            colors = np.broadcast_to(colors[:, None, None], (len(nodes), tile, tile, 3))
+            inside = (xs >= 0) & (xs < shape[0]) & (ys >= 0) & (ys < shape[1])
+            cells[xs[inside], ys[inside]] = colors[inside]
+        
+        surface = pygame.surfarray.make_surface(cells)
+        surface.set_colorkey(HEAT_KEY)
+        surface = pygame.transform.scale(surface, (shape[0] * HEAT_CELL, shape[1] * HEAT_CELL))
+        self.mark([self.screen.blit(surface, (0, 0))])
+        
+        route = frame.emergency_route
+        if len(route) > 1:
+            points = viewport.to_screen(self.node_array[[self.node_lookup[name] for name in route]])
+            self.mark([pygame.draw.lines(self.screen, DARK_GREEN, False, points.tolist(), 3)])
         
-        pygame.quit()
+        legend = self.glyphs.render(self.font, "Road colour: vehicles per lane; tiles: blue NS green, orange EW green "
+                                    "(scroll to zoom, drag to pan, HOME to reset)", BLACK)
+        self.mark([self.screen.blit(legend, (20, 100))])
+    
+    def run(self):
+        self.loop.start()
+        try:
+            while self.running:
+                self.handle_events()
+                if self.loop.error is not None:
+                    raise self.loop.error
+                self.draw()
+                self.clock.tick(FPS)
+        finally:
+            self.loop.stop()
+            self.optimizer.close()
+            pygame.quit()
+
+def run_headless(ticks, seed=None, grid_size=GRID_SIZE, optimizer=DEFAULT_OPTIMIZER,
+                 resume=None, checkpoint=None, telemetry=None, telemetry_format='csv',
+                 telemetry_interval=FPS, profile=False, profile_trace=None,
+                 profile_ticks=PROFILE_TRACE_TICKS, signal_plan=None, mode=None,
+                 optimizer_budget=None, shards=None, demand=None, demand_hour=DEMAND_HOUR):
+    if resume:
+        from checkpoint import load_checkpoint
+        # A seed given with a checkpoint branches the run with fresh RNG streams
+        engine = load_checkpoint(resume, reseed=seed, engine=engine_class(mode) if mode else None)
+    else:
+        options = {'shards': shards} if mode == 'sharded' else {}
+        engine = engine_class(mode or 'tick')(grid_size, optimizer, seed=seed, signal_plan=signal_plan,
+                                              optimizer_budget=optimizer_budget, demand=demand,
+                                              demand_hour=demand_hour, **options)
+    if telemetry:
+        engine.attach_telemetry(telemetry, telemetry_format, interval=telemetry_interval)
+    if profile or profile_trace:
+        engine.attach_profiler()
+        if profile_trace:
+            engine.profiler.start_trace(profile_trace, profile_ticks)
+    start = time.perf_counter()
+    stats = engine.run(ticks)
+    elapsed = time.perf_counter() - start
+    engine.close()
+    if telemetry:
+        engine.telemetry.close()
+    if engine.profiler is not None:
+        engine.profiler.stop_trace()
+        engine.profiler.detach()
+    
+    if checkpoint:
+        from checkpoint import save_checkpoint
+        save_checkpoint(engine, checkpoint)
+        print(f"Checkpoint at tick {engine.time} written to {checkpoint}")
+    
+    print(f"Simulated {ticks} ticks ({ticks / FPS:.0f}s of traffic) in {elapsed:.2f}s "
+          f"({ticks / max(elapsed, 1e-9):.0f} ticks/s)")
+    for key in ('total_vehicles', 'cars', 'buses', 'emergency_vehicles', 'pedestrians',
+                'green_lights', 'red_lights', 'emergency_active'):
+        print(f"  {key}: {stats[key]}")
+    if engine.city.metrics is not None:
+        print("Last simulated minute:")
+        for key, value in engine.city.metrics.summary(engine.city.tick + 1).items():
+            print(f"  {key}: {value:.2f}" if isinstance(value, float) else f"  {key}: {value}")
+    if profile:
+        print(engine.profiler.report())
+    if profile_trace:
+        print(f"cProfile trace written to {profile_trace}")
+    return stats
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Smart City Traffic Simulation")
+    parser.add_argument('--headless', action='store_true',
+                        help="run the simulation without a display")
+    parser.add_argument('--ticks', type=int, default=FPS * 3600,
+                        help="number of ticks to simulate in headless mode")
+    parser.add_argument('--seed', type=int, default=None,
+                        help="random seed for reproducible runs")
+    parser.add_argument('--grid-size', type=int, default=GRID_SIZE,
+                        help="number of intersections along each side of the grid")
+    parser.add_argument('--network', metavar='PATH', default=None,
+                        help="road network to simulate instead of a grid: a .graph file written by "
+                             "road_network.py, or a GeoJSON/CSV edge list imported on start")
+    parser.add_argument('--optimizer', choices=sorted(BACKENDS), default=DEFAULT_OPTIMIZER,
+                        help="traffic light optimizer backend")
+    parser.add_argument('--resume', metavar='PATH', default=None,
+                        help="start a headless run from a checkpoint file")
+    parser.add_argument('--checkpoint', metavar='PATH', default=None,
+                        help="write a checkpoint at the end of a headless run")
+    parser.add_argument('--telemetry', metavar='PATH', default=None,
+                        help="stream telemetry records of a headless run to PATH")
+    parser.add_argument('--telemetry-format', choices=('csv', 'npz', 'parquet'), default='csv',
+                        help="csv file, directory of npz chunks, or parquet (needs pyarrow)")
+    parser.add_argument('--telemetry-interval', type=int, default=FPS,
+                        help="ticks between telemetry records")
+    parser.add_argument('--profile', action='store_true',
+                        help="time each phase of a tick (and frame) and report per-phase ms/frame")
+    parser.add_argument('--profile-trace', metavar='PATH', default=None,
+                        help="write a cProfile trace of the first --profile-ticks ticks to PATH")
+    parser.add_argument('--profile-ticks', type=int, default=PROFILE_TRACE_TICKS,
+                        help="ticks covered by --profile-trace")
+    parser.add_argument('--signal-plan', choices=PLAN_KINDS, default=None,
+                        help="fixed-time signal plan instead of the adaptive optimizer "
+                             "('green-wave' coordinates east-west corridors)")
+    parser.add_argument('--engine', choices=ENGINE_MODES, default=None,
+                        help="headless engine: per-vehicle every tick (default), per-vehicle event "
+                             "by event, mesoscopic link densities, or per-vehicle split over worker "
+                             "processes; resumed runs default to the checkpoint's engine")
+    parser.add_argument('--shards', type=int, default=None,
+                        help="worker processes of --engine sharded (default: one per CPU)")
+    parser.add_argument('--optimizer-budget', type=float, metavar='SECONDS', default=None,
+                        help="solve lights on a background thread, SECONDS per solve; the GUI "
+                             f"always does (default {OPTIMIZER_BUDGET}), headless runs only with "
+                             "this flag since results then depend on timing")
+    parser.add_argument('--demand', metavar='PROFILE', default=None,
+                        help="spawn vehicles from origin-destination demand instead of random spawn "
+                             "ticks: 'uniform', 'peak' (morning and evening rush hours) or an .npz "
+                             "file of OD matrices (see demand.py)")
+    parser.add_argument('--demand-hour', type=float, default=DEMAND_HOUR,
+                        help="time of day at the start of a --demand run")
+    args = parser.parse_args(argv)
+    if args.engine == 'sharded' and (args.checkpoint or args.resume):
+        parser.error("sharded runs cannot write or resume checkpoints")
+    
+    size = args.network or args.grid_size
+    if args.headless:
+        run_headless(args.ticks, args.seed, size, args.optimizer,
+                     args.resume, args.checkpoint, args.telemetry,
+                     args.telemetry_format, args.telemetry_interval,
+                     args.profile, args.profile_trace, args.profile_ticks, args.signal_plan,
+                     args.engine, args.optimizer_budget, args.shards, args.demand, args.demand_hour)
+    else:
+        budget = OPTIMIZER_BUDGET if args.optimizer_budget is None else args.optimizer_budget
+        simulation = Simulation(size, args.optimizer, args.seed, args.profile,
+                                args.signal_plan, budget, args.demand, args.demand_hour)
+        if args.profile_trace:
+            simulation.start_trace(args.profile_trace, args.profile_ticks)
+        simulation.run()
 
 if __name__ == "__main__":
-    simulation = Simulation()
-    simulation.run()
\ No newline at end of file
+    main()
\ No newline at end of file
@@ -0,0 +1,86 @@
+import numpy as np
+
+class VehicleIndex:
+    # Buckets of vehicle ids per node (the intersection a vehicle is leaving)
+    # and per directed link, i.e. per approach. Buckets are dicts used as
+    # ordered sets, so insert and remove are O(1); the count arrays allow
+    # vectorized queries over all buckets.
+    def __init__(self, num_nodes, num_links):
+        self.nodes = [dict() for _ in range(num_nodes)]
+        self.links = [dict() for _ in range(num_links)]
+        self.node_count = np.zeros(num_nodes, dtype=np.int32)
+        self.link_count = np.zeros(num_links, dtype=np.int32)
+
+    def insert(self, vehicle_id, node, link):
+        self.nodes[node][vehicle_id] = None
+        self.links[link][vehicle_id] = None
+        self.node_count[node] += 1
+        self.link_count[link] += 1
+
+    def insert_many(self, vehicle_ids, nodes, links):
+        for vehicle_id, node, link in zip(vehicle_ids.tolist(), nodes.tolist(), links.tolist()):
+            self.nodes[node][vehicle_id] = None
+            self.links[link][vehicle_id] = None
+        np.add.at(self.node_count, nodes, 1)
+        np.add.at(self.link_count, links, 1)
+
+    def remove(self, vehicle_id, node, link):
+        del self.nodes[node][vehicle_id]
+        del self.links[link][vehicle_id]
+        self.node_count[node] -= 1
+        self.link_count[link] -= 1
+
+    def remove_many(self, vehicle_ids, nodes, links):
+        for vehicle_id, node, link in zip(vehicle_ids.tolist(), nodes.tolist(), links.tolist()):
+            del self.nodes[node][vehicle_id]
+            del self.links[link][vehicle_id]
+        np.subtract.at(self.node_count, nodes, 1)
+        np.subtract.at(self.link_count, links, 1)
+
+    def move_many(self, vehicle_ids, old_nodes, old_links, new_nodes, new_links):
+        nodes = self.nodes
+        links = self.links
+        for vehicle_id, old_node, old_link, new_node, new_link in zip(
+                vehicle_ids.tolist(), old_nodes.tolist(), old_links.tolist(),
+                new_nodes.tolist(), new_links.tolist()):
+            del nodes[old_node][vehicle_id]
+            del links[old_link][vehicle_id]
+            nodes[new_node][vehicle_id] = None
+            links[new_link][vehicle_id] = None
+        np.subtract.at(self.node_count, old_nodes, 1)
+        np.subtract.at(self.link_count, old_links, 1)
+        np.add.at(self.node_count, new_nodes, 1)
+        np.add.at(self.link_count, new_links, 1)
+
+    def at_node(self, node):
+        return self.nodes[node].keys()
+
+    def on_link(self, link):
+        return self.links[link].keys()
+
+class VehicleCounts:
+    # Count-only stand-in for VehicleIndex where nothing asks which vehicles
+    # are where, only how many, e.g. in the workers of the sharded engine
+    def __init__(self, num_nodes, num_links):
+        self.node_count = np.zeros(num_nodes, dtype=np.int32)
+        self.link_count = np.zeros(num_links, dtype=np.int32)
+
+    def insert(self, vehicle_id, node, link):
+        self.node_count[node] += 1
+        self.link_count[link] += 1
+
+    def insert_many(self, vehicle_ids, nodes, links):
+        np.add.at(self.node_count, nodes, 1)
+        np.add.at(self.link_count, links, 1)
+
+    def remove(self, vehicle_id, node, link):
+        self.node_count[node] -= 1
+        self.link_count[link] -= 1
+
+    def remove_many(self, vehicle_ids, nodes, links):
+        np.subtract.at(self.node_count, nodes, 1)
+        np.subtract.at(self.link_count, links, 1)
+
+    def move_many(self, vehicle_ids, old_nodes, old_links, new_nodes, new_links):
+        self.remove_many(vehicle_ids, old_nodes, old_links)
+        self.insert_many(vehicle_ids, new_nodes, new_links)
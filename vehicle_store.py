@@ -0,0 +1,186 @@
+import numpy as np
+
+# Vehicle type codes used by the struct-of-arrays store
+VEHICLE_TYPES = ('car', 'bus', 'ambulance')
+TYPE_CODES = {name: code for code, name in enumerate(VEHICLE_TYPES)}
+SPEED_FACTORS = np.array([1.0, 0.8, 1.2])  # Buses are slower, ambulances faster
+
+ARRIVAL_PROGRESS = 100
+
+FIELDS = ('current', 'next', 'link', 'progress', 'speed', 'entered', 'type_code',
+          'key', 'destination', 'generation', 'alive')
+NO_DESTINATION = -1
+SLOT_BITS = 32
+SLOT_MASK = (1 << SLOT_BITS) - 1
+
+class Vehicle:
+    # Read-only view of one vehicle's record, backed by the store's arrays
+    __slots__ = ('fleet', 'slot', 'handle')
+
+    def __init__(self, fleet, slot, handle):
+        self.fleet = fleet
+        self.slot = slot
+        self.handle = handle
+
+    @property
+    def type(self):
+        return VEHICLE_TYPES[self.fleet.type_code[self.slot]]
+
+    @property
+    def current(self):
+        return int(self.fleet.current[self.slot])
+
+    @property
+    def next(self):
+        return int(self.fleet.next[self.slot])
+
+    @property
+    def link(self):
+        return int(self.fleet.link[self.slot])
+
+    @property
+    def progress(self):
+        return float(self.fleet.progress[self.slot])
+
+class VehicleStore:
+    # One array per field so the whole fleet can be advanced in a single step.
+    # Internally a vehicle is its slot in the arrays; link is the topology link
+    # it is travelling along and entered the tick it started on that link.
+    # key identifies the vehicle in counter-based draws (see counter_rng);
+    # destination is the node a demand trip heads for, or NO_DESTINATION.
+    # Despawned slots go on a free list and are reused by later spawns, so
+    # slots below `count` may be empty (alive False, speed 0, never arriving).
+    # Code outside the simulation refers to vehicles by handle: the slot in
+    # the low 32 bits and the slot's generation above it. The generation is
+    # bumped on despawn, so handles to a vehicle that is gone stop resolving
+    # instead of silently pointing at whichever vehicle reuses the slot.
+    def __init__(self, capacity=1024):
+        self.count = 0  # Slots in use or on the free list
+        self.free = []
+        self.current = np.zeros(capacity, dtype=np.int32)
+        self.next = np.zeros(capacity, dtype=np.int32)
+        self.link = np.zeros(capacity, dtype=np.int64)
+        self.progress = np.zeros(capacity, dtype=np.float64)
+        self.speed = np.zeros(capacity, dtype=np.float64)
+        self.entered = np.zeros(capacity, dtype=np.int64)
+        self.type_code = np.zeros(capacity, dtype=np.int8)
+        self.key = np.zeros(capacity, dtype=np.uint64)
+        self.destination = np.full(capacity, NO_DESTINATION, dtype=np.int32)
+        self.generation = np.zeros(capacity, dtype=np.uint32)
+        self.alive = np.zeros(capacity, dtype=bool)
+
+    def __len__(self):
+        return self.count - len(self.free)
+
+    def _reserve(self, extra):
+        needed = self.count + extra
+        capacity = len(self.current)
+        if needed <= capacity:
+            return
+        capacity = max(capacity, 16)
+        while capacity < needed:
+            capacity *= 2
+        for name in FIELDS:
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:self.count] = old[:self.count]
+            setattr(self, name, new)
+
+    def _take_slots(self, wanted):
+        # Reuse despawned slots first, then grow past the high-water mark
+        reused = min(len(self.free), wanted)
+        slots = np.empty(wanted, dtype=np.int64)
+        if reused:
+            slots[:reused] = self.free[-reused:]
+            del self.free[-reused:]
+        fresh = wanted - reused
+        if fresh:
+            self._reserve(fresh)
+            slots[reused:] = np.arange(self.count, self.count + fresh)
+            self.count += fresh
+        return slots
+
+    def add(self, vehicle_type, current, next_node, link, speed, tick=0, key=0):
+        if self.free:
+            vehicle_id = self.free.pop()
+        else:
+            self._reserve(1)
+            vehicle_id = self.count
+            self.count += 1
+        self.current[vehicle_id] = current
+        self.next[vehicle_id] = next_node
+        self.link[vehicle_id] = link
+        self.progress[vehicle_id] = 0
+        self.speed[vehicle_id] = speed
+        self.entered[vehicle_id] = tick
+        self.type_code[vehicle_id] = TYPE_CODES[vehicle_type]
+        self.key[vehicle_id] = key
+        self.destination[vehicle_id] = NO_DESTINATION
+        self.alive[vehicle_id] = True
+        return vehicle_id
+
+    def extend(self, type_codes, current, next_nodes, links, speeds, tick=0, keys=0,
+               destinations=NO_DESTINATION):
+        slots = self._take_slots(len(type_codes))
+        self.current[slots] = current
+        self.next[slots] = next_nodes
+        self.link[slots] = links
+        self.progress[slots] = 0
+        self.speed[slots] = speeds
+        self.entered[slots] = tick
+        self.type_code[slots] = type_codes
+        self.key[slots] = keys
+        self.destination[slots] = destinations
+        self.alive[slots] = True
+        return slots
+
+    def remove(self, vehicle_id):
+        # Free the slot; zero speed keeps it out of advance() until reused
+        self.alive[vehicle_id] = False
+        self.generation[vehicle_id] += 1
+        self.progress[vehicle_id] = 0
+        self.speed[vehicle_id] = 0
+        self.free.append(int(vehicle_id))
+
+    def remove_many(self, vehicle_ids):
+        self.alive[vehicle_ids] = False
+        self.generation[vehicle_ids] += 1
+        self.progress[vehicle_ids] = 0
+        self.speed[vehicle_ids] = 0
+        self.free.extend(vehicle_ids.tolist())
+
+    def handle(self, vehicle_id):
+        return (int(self.generation[vehicle_id]) << SLOT_BITS) | int(vehicle_id)
+
+    def handles(self, vehicle_ids):
+        return (self.generation[vehicle_ids].astype(np.int64) << SLOT_BITS) | vehicle_ids
+
+    def resolve(self, handle):
+        # Slot of a live vehicle; KeyError once it has been despawned
+        slot = handle & SLOT_MASK
+        if slot >= self.count or not self.alive[slot] or self.generation[slot] != handle >> SLOT_BITS:
+            raise KeyError(handle)
+        return slot
+
+    def get(self, handle):
+        return Vehicle(self, self.resolve(handle), handle)
+
+    def vehicle_type(self, vehicle_id):
+        return VEHICLE_TYPES[self.type_code[vehicle_id]]
+
+    def live_ids(self):
+        return np.flatnonzero(self.alive[:self.count])
+
+    def advance(self, can_move):
+        # Move every vehicle whose light is green; returns the ids that reached
+        # their next intersection this step
+        progress = self.progress[:self.count]
+        np.add(progress, self.speed[:self.count], out=progress, where=can_move)
+        return np.flatnonzero(progress >= ARRIVAL_PROGRESS)
+
+    def reroute(self, vehicle_ids, new_next, new_links, tick=0):
+        self.current[vehicle_ids] = self.next[vehicle_ids]
+        self.next[vehicle_ids] = new_next
+        self.link[vehicle_ids] = new_links
+        self.progress[vehicle_ids] = 0
+        self.entered[vehicle_ids] = tick
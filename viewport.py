@@ -0,0 +1,127 @@
+import numpy as np
+
+ZOOM_STEP = 1.25  # Zoom factor per mouse wheel notch
+MIN_ZOOM = 0.5  # At zoom 1 the whole city fits the map area
+MAX_SPACING = 600  # Screen pixels between neighbouring intersections at the closest zoom
+DETAIL_SPACING = 120  # Screen spacing from which intersections and vehicles are drawn in full
+DETAIL_VEHICLES = 400  # Most vehicles drawn as icons; more switch to the heatmap
+INDEX_CELL = 4  # Spatial index cell size, in typical road lengths
+
+class SpatialIndex:
+    # Uniform grid over axis-aligned boxes (x0, y0, x1, y1), points being
+    # boxes of size zero. Each box is listed under every cell it overlaps,
+    # CSR-style, so a query costs the cells it covers plus the boxes in them,
+    # however big the whole map is.
+    def __init__(self, boxes, cell):
+        self.boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        self.cell = float(cell)
+        count = len(self.boxes)
+        self.origin = self.boxes[:, :2].min(axis=0) if count else np.zeros(2)
+        self.extent = self.boxes[:, 2:].max(axis=0) if count else np.zeros(2)
+        lo = ((self.boxes[:, :2] - self.origin) // self.cell).astype(np.int64)
+        hi = ((self.boxes[:, 2:] - self.origin) // self.cell).astype(np.int64)
+        self.shape = hi.max(axis=0) + 1 if count else np.ones(2, dtype=np.int64)
+        spans = hi - lo + 1
+        covered = spans[:, 0] * spans[:, 1]
+        item = np.repeat(np.arange(count), covered)
+        offset = np.arange(covered.sum()) - np.repeat(np.cumsum(covered) - covered, covered)
+        column = lo[item, 0] + offset % spans[item, 0]
+        row = lo[item, 1] + offset // spans[item, 0]
+        cells = row * self.shape[0] + column
+        self.items = item[np.argsort(cells, kind='stable')]
+        self.indptr = np.zeros(int(self.shape.prod()) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(cells, minlength=len(self.indptr) - 1), out=self.indptr[1:])
+
+    def query(self, x0, y0, x1, y1):
+        # Ids of the boxes overlapping the rectangle, ascending
+        boxes = self.boxes
+        if not len(boxes) or x1 < self.origin[0] or y1 < self.origin[1] \
+                or x0 > self.extent[0] or y0 > self.extent[1]:
+            return np.empty(0, dtype=np.int64)
+        if x0 <= self.origin[0] and y0 <= self.origin[1] and x1 >= self.extent[0] and y1 >= self.extent[1]:
+            return np.arange(len(boxes))
+        last = self.shape - 1
+        c0 = np.clip(((np.array([x0, y0]) - self.origin) // self.cell).astype(np.int64), 0, last)
+        c1 = np.clip(((np.array([x1, y1]) - self.origin) // self.cell).astype(np.int64), 0, last)
+        cells = (np.arange(c0[1], c1[1] + 1)[:, None] * self.shape[0]
+                 + np.arange(c0[0], c1[0] + 1)).ravel()
+        starts = self.indptr[cells]
+        counts = self.indptr[cells + 1] - starts
+        heads = np.cumsum(counts) - counts
+        ids = np.unique(self.items[np.repeat(starts - heads, counts) + np.arange(counts.sum())])
+        found = boxes[ids]
+        inside = (found[:, 0] <= x1) & (found[:, 2] >= x0) & (found[:, 1] <= y1) & (found[:, 3] >= y0)
+        return ids[inside]
+
+class Viewport:
+    # Pan and zoom over the map area. World positions are the city laid out
+    # to fit the map area, so zoom 1 shows the whole city; (x, y) is the
+    # world position at the top left corner of the map area.
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.max_zoom = 1.0
+        self.reset()
+
+    def reset(self):
+        self.zoom = 1.0
+        self.x = 0.0
+        self.y = 0.0
+
+    def fit(self, spacing):
+        # New layout with neighbouring intersections `spacing` apart at zoom 1
+        self.max_zoom = max(1.0, MAX_SPACING / spacing) if spacing > 0 else 1.0
+        self.reset()
+
+    @property
+    def key(self):
+        return (self.zoom, self.x, self.y)
+
+    def world_rect(self, margin=0):
+        # Visible world rectangle, grown by `margin` screen pixels
+        pad = margin / self.zoom
+        return (self.x - pad, self.y - pad,
+                self.x + self.width / self.zoom + pad, self.y + self.height / self.zoom + pad)
+
+    def to_screen(self, xy):
+        return (np.asarray(xy, dtype=np.float64) - (self.x, self.y)) * self.zoom
+
+    def zoom_at(self, sx, sy, factor):
+        # Zoom keeping the world point under the screen position in place
+        zoom = min(max(self.zoom * factor, MIN_ZOOM), self.max_zoom)
+        self.x += sx / self.zoom - sx / zoom
+        self.y += sy / self.zoom - sy / zoom
+        self.zoom = zoom
+        self.clamp()
+
+    def pan(self, dx, dy):
+        self.x -= dx / self.zoom
+        self.y -= dy / self.zoom
+        self.clamp()
+
+    def clamp(self):
+        # Keep the centre of the view over the city
+        half_w = self.width / (2 * self.zoom)
+        half_h = self.height / (2 * self.zoom)
+        self.x = min(max(self.x, -half_w), self.width - half_w)
+        self.y = min(max(self.y, -half_h), self.height - half_h)
+
+def rasterize_segments(start, end, values, shape, cell):
+    # Grid of `shape` cells of `cell` screen pixels holding, per cell, the
+    # largest value of the segments crossing it, or -1 where none does.
+    # Segments are sampled about once per cell along their length, so the
+    # cost follows the cells covered, not the pixels.
+    grid = np.full(shape, -1.0)
+    if not len(values):
+        return grid
+    start = np.asarray(start, dtype=np.float64) / cell
+    end = np.asarray(end, dtype=np.float64) / cell
+    samples = np.minimum(np.ceil(np.abs(end - start).max(axis=1)), max(shape)).astype(np.int64) + 1
+    segment = np.repeat(np.arange(len(values)), samples)
+    step = np.arange(samples.sum()) - np.repeat(np.cumsum(samples) - samples, samples)
+    share = (step / np.maximum(samples - 1, 1)[segment])[:, None]
+    points = np.floor(start[segment] + (end - start)[segment] * share).astype(np.int64)
+    inside = ((points >= 0) & (points < shape)).all(axis=1)
+    points, segment = points[inside], segment[inside]
+    np.maximum.at(grid, (points[:, 0], points[:, 1]), values[segment])
+    return grid